@@ -0,0 +1,207 @@
+import json
+import resource
+import subprocess
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+import numpy as np
+from utils import CommandLineParser, GLOBALS
+from simulator import TelloSimulator
+from tello import DroneController
+
+"""
+    End-to-end benchmarks against a local TelloSimulator. Results are written as JSON so runs of different versions
+    can be compared with --compare.
+"""
+
+
+def percentiles(samples: List[float], scale: float = 1000.) -> Dict[str, float]:
+    """
+        Summary of a list of durations in seconds, reported in milliseconds by default.
+    """
+    if not samples:
+        return {}
+    values = np.asarray(samples) * scale
+    return {'count': len(values), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+            'max': float(values.max())}
+
+
+def measure_memory(stage: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+        Run a stage and add its Python heap peak (tracemalloc) and process max RSS growth to its results.
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    try:
+        results = stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    results['python_peak_kb'] = peak // 1024
+    results['max_rss_growth_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    return results
+
+
+QUERIES = ('speed?', 'battery?', 'time?', 'height?', 'temp?', 'attitude?', 'baro?', 'acceleration?', 'tof?', 'wifi?')
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Benchmark(CommandLineParser):
+    """
+        python3 benchmark.py --commands 500 --video recordings/stream_xxx.h264 --output bench.json
+        Simulator behaviour is set with defines, e.g. -D sim_latency=0.01 sim_loss=0.02 (see simulator.py).
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello benchmarks")
+        self.add_argument('--commands', type=int, default=200, help="number of commands per command benchmark")
+        self.add_argument('--video', type=str, default=None, help="H.264 file to stream, skips video if not given")
+        self.add_argument('--duration', type=float, default=10., help="seconds of video to measure")
+        self.add_argument('--port', type=int, default=18889, help="simulator command port")
+        self.add_argument('--output', type=str, default=None, help="write the results as JSON")
+        self.add_argument('--compare', type=str, default=None, help="previous results to compare against")
+        self.parse_args()
+        self.options = dict(GLOBALS)
+        self.options.setdefault('sim_realtime_moves', False)
+        self.options['command_rate_limits'] = {}  # measure the transport, not the scheduler's limits
+        self.simulator = None
+        self.drone = None
+
+    def setup(self):
+        video_port = self.args.port + 2
+        self.simulator = TelloSimulator(('127.0.0.1', self.args.port), sim_video=self.args.video,
+                                        state_port=self.args.port + 1, video_port=video_port,
+                                        **self.options).start()
+        self.drone = DroneController(None, tello_address=self.simulator.address,
+                                     local_address=('127.0.0.1', 0), state_address=('127.0.0.1', self.args.port + 1),
+                                     vs_udp_port=video_port, **self.options)
+        self.drone.arm()
+
+    def teardown(self):
+        if self.drone is not None:
+            self.drone.end()
+            self.drone.shutdown()
+        if self.simulator is not None:
+            self.simulator.stop()
+
+    def _check_received(self, before: int) -> int:
+        """
+            Every benchmarked command must have reached the simulator: none coalesced or skipped by the scheduler
+            (retries after a simulated loss add to the count).
+        """
+        received = self.simulator.commands_received - before
+        if received < self.args.commands or (received != self.args.commands and not self.options.get('sim_loss')):
+            raise RuntimeError(f"the simulator received {received} of {self.args.commands} commands")
+        return received
+
+    def bench_command_rtt(self) -> Dict[str, Any]:
+        samples = []
+        before = self.simulator.commands_received
+        for i in range(self.args.commands):
+            start = time.perf_counter()
+            self.drone._send_command(QUERIES[i % len(QUERIES)], wait=True)
+            samples.append(time.perf_counter() - start)
+        return {'rtt_ms': percentiles(samples), 'received': self._check_received(before)}
+
+    def bench_command_pipeline(self) -> Dict[str, Any]:
+        before = self.simulator.commands_received
+        start = time.perf_counter()
+        # consecutive queries differ, so the scheduler can't merge any of them
+        futures = [self.drone.channel.submit(QUERIES[i % len(QUERIES)]) for i in range(self.args.commands)]
+        failed = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+        elapsed = time.perf_counter() - start
+        return {'commands_per_sec': self.args.commands / elapsed, 'failed': failed,
+                'received': self._check_received(before)}
+
+    def bench_telemetry(self) -> Dict[str, Any]:
+        samples = []
+        for _ in range(self.args.commands):
+            start = time.perf_counter()
+            self.drone.get_battery()
+            samples.append(time.perf_counter() - start)
+        return {'get_battery_ms': percentiles(samples), 'state_samples': self.drone.telemetry.buffer.count}
+
+    def bench_video(self) -> Dict[str, Any]:
+        self.drone.capture_stream()
+        cursor = self.drone.stream.cursor()
+        # derived streams are only computed while read, so read them all alongside
+        stream_cursors = [self.drone.stream.cursor(stream=name) for name in self.drone.stream.pipeline.streams]
+        latencies = []
+        consumed = 0
+        first_sequence = self.drone.stream.ring.head
+        start = time.time()
+        while time.time() - start < self.args.duration:
+            frame = cursor.wait(timeout=1.)
+            if frame is None:
+                continue
+            latencies.append(time.time() - frame.timestamp)
+            consumed += 1
+            for stream_cursor in stream_cursors:
+                while stream_cursor.poll() is not None:
+                    pass  # until it asks for the next frame
+        elapsed = time.time() - start
+        decoded = self.drone.stream.ring.head - first_sequence
+        return {'decoded_fps': decoded / elapsed, 'consumed_fps': consumed / elapsed,
+                'capture_to_consumer_ms': percentiles(latencies),
+                'decoder': self.drone.stream.decoder_stats(self.args.duration),
+                'pipeline': self.drone.stream.pipeline.stats()}
+
+    def run(self) -> Dict[str, Any]:
+        stages = {'command_rtt': self.bench_command_rtt, 'command_pipeline': self.bench_command_pipeline,
+                  'telemetry': self.bench_telemetry}
+        if self.args.video:
+            stages['video'] = self.bench_video
+        results = {}
+        self.setup()
+        try:
+            time.sleep(0.5)  # let the first state packets arrive
+            for name, stage in stages.items():
+                self.logger.info(f"running {name}")
+                results[name] = measure_memory(stage)
+        finally:
+            self.teardown()
+        return {'version': git_version(), 'timestamp': time.time(),
+                'config': {'commands': self.args.commands, 'duration': self.args.duration, 'video': self.args.video,
+                           'video_decoder': self.options.get('video_decoder', 'opencv'),
+                           **{key: val for key, val in self.options.items() if key.startswith('sim_')}},
+                'results': results}
+
+    @staticmethod
+    def compare(current: Dict[str, Any], previous: Dict[str, Any], prefix: str = "") -> List[str]:
+        lines = []
+        for key, val in current.items():
+            other = previous.get(key) if isinstance(previous, dict) else None
+            if isinstance(val, dict):
+                lines.extend(Benchmark.compare(val, other or {}, f"{prefix}{key}."))
+            elif isinstance(val, (int, float)) and isinstance(other, (int, float)) and other:
+                lines.append(f"{prefix}{key}: {other:.3f} -> {val:.3f} ({(val - other) / other * 100:+.1f}%)")
+        return lines
+
+    def main(self):
+        report = self.run()
+        print(json.dumps(report['results'], indent=2))
+        if self.args.output:
+            with open(self.args.output, 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+        if self.args.compare:
+            with open(self.args.compare) as previous_file:
+                previous = json.load(previous_file)
+            print(f"compared to {previous.get('version')}:")
+            print('\n'.join(self.compare(report['results'], previous['results'])))
+
+
+if __name__ == "__main__":
+    Benchmark().main()
@@ -0,0 +1,203 @@
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin, CommandLineParser, GLOBALS
+
+"""
+    Camera calibration from the checkerboard images in calibration_images/. Corner detection is the slow part, so it
+    runs in a process pool and its result is cached per image (keyed by path, size and modification time) next to the
+    output, rerunning after adding images only detects the new ones.
+    Writes the OpenCV XML file LSD-SLAM reads (see lsd_slam/calibration.xml) and an .npz with the undistortion maps,
+    so consumers can rectify frames with a single cv2.remap instead of recomputing them.
+"""
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOARD_SIZE = (19, 13)  # inner corners of the board in calibration_images/
+CORNER_CACHE = "corners.npz"
+MAPS_FILE = "undistort_maps.npz"
+IMAGE_PATTERNS = ('*.jpeg', '*.jpg', '*.png')
+
+
+def detect_corners(path: str, board: Tuple[int, int]) -> Tuple[bool, Optional[np.ndarray], Tuple[int, int]]:
+    """
+        Find the board's inner corners in one image, returns (found, corners (N, 2), image size (w, h)).
+        Runs in a worker process.
+    """
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return False, None, (0, 0)
+    size = (image.shape[1], image.shape[0])
+    found, corners = cv2.findChessboardCornersSB(image, board, flags=cv2.CALIB_CB_EXHAUSTIVE | cv2.CALIB_CB_ACCURACY)
+    if not found:
+        found, corners = cv2.findChessboardCorners(image, board, flags=cv2.CALIB_CB_ADAPTIVE_THRESH |
+                                                   cv2.CALIB_CB_NORMALIZE_IMAGE)
+        if found:
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+            corners = cv2.cornerSubPix(image, corners, (11, 11), (-1, -1), criteria)
+    return found, corners.reshape(-1, 2).astype(np.float32) if found else None, size
+
+
+def image_key(path: str) -> str:
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+class CornerCache(logger_mixin()):
+    """
+        Detected corners per image, saved as a single .npz. An image whose size or modification time changed is
+        detected again; a different board invalidates the whole cache.
+    """
+
+    def __init__(self, path: str, board: Tuple[int, int]):
+        self.path = path
+        self.board = tuple(board)
+        self.entries: Dict[str, Tuple[bool, Optional[np.ndarray], Tuple[int, int]]] = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with np.load(self.path) as cache:
+            if tuple(cache['board']) != self.board:
+                self.logger.info(f"board changed from {tuple(cache['board'])}, ignoring {self.path}")
+                return
+            for key, found, corners, size in zip(cache['keys'], cache['found'], cache['corners'], cache['sizes']):
+                self.entries[str(key)] = bool(found), corners if found else None, tuple(int(x) for x in size)
+
+    def save(self):
+        count = self.board[0] * self.board[1]
+        keys = list(self.entries)
+        corners = np.zeros((len(keys), count, 2), dtype=np.float32)
+        for i, key in enumerate(keys):
+            if self.entries[key][0]:
+                corners[i] = self.entries[key][1]
+        np.savez(self.path, board=np.array(self.board), keys=np.array(keys, dtype=str),
+                 found=np.array([self.entries[key][0] for key in keys], dtype=bool), corners=corners,
+                 sizes=np.array([self.entries[key][2] for key in keys], dtype=np.int32).reshape(-1, 2))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __getitem__(self, key: str):
+        return self.entries[key]
+
+    def __setitem__(self, key: str, value):
+        self.entries[key] = value
+
+
+class Calibrator(logger_mixin()):
+    """
+        Detects the board in every image (new images only, in parallel) and solves the camera intrinsics.
+        Options: calibration_board (inner corners, default 19x13), calibration_square (square size, only scales
+        the extrinsics), calibration_workers (default: all cores), calibration_alpha (0 crops the rectified image to
+        valid pixels, 1 keeps every source pixel).
+    """
+
+    def __init__(self, image_dir: str, output_dir: str, **kwargs):
+        self.image_dir = image_dir
+        self.output_dir = output_dir
+        self.board = tuple(kwargs.get('calibration_board', BOARD_SIZE))
+        self.square = float(kwargs.get('calibration_square', 1.))
+        self.workers = kwargs.get('calibration_workers', None)
+        self.alpha = float(kwargs.get('calibration_alpha', 0.))
+        self.cache = CornerCache(os.path.join(output_dir, CORNER_CACHE), self.board)
+        self.camera_matrix = None
+        self.distortion = None
+        self.image_size = None
+        self.rms = None
+
+    def images(self):
+        return sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(self.image_dir, pattern)))
+
+    def detect(self, force: bool = False) -> Dict[str, Tuple[bool, Optional[np.ndarray], Tuple[int, int]]]:
+        keys = {path: image_key(path) for path in self.images()}
+        todo = [path for path, key in keys.items() if force or key not in self.cache]
+        self.logger.info(f"{len(keys)} images, {len(todo)} to process")
+        if todo:
+            with ProcessPoolExecutor(self.workers) as pool:
+                for path, result in zip(todo, pool.map(detect_corners, todo, [self.board] * len(todo))):
+                    if not result[0]:
+                        self.logger.warning(f"no board found in {path}")
+                    self.cache[keys[path]] = result
+            self.cache.save()
+        return {path: self.cache[key] for path, key in keys.items()}
+
+    def calibrate(self, force: bool = False) -> float:
+        detections = [result for result in self.detect(force).values() if result[0]]
+        if len(detections) < 3:
+            raise ValueError(f"found the board in {len(detections)} images, need at least 3")
+        sizes = {size for _, _, size in detections}
+        if len(sizes) > 1:
+            raise ValueError(f"images of different sizes: {sizes}")
+        self.image_size = sizes.pop()
+        board_points = np.zeros((self.board[0] * self.board[1], 3), np.float32)
+        board_points[:, :2] = np.mgrid[0:self.board[0], 0:self.board[1]].T.reshape(-1, 2) * self.square
+        self.rms, self.camera_matrix, self.distortion, _, _ = cv2.calibrateCamera(
+            [board_points] * len(detections), [corners for _, corners, _ in detections], self.image_size, None, None)
+        self.logger.info(f"calibrated from {len(detections)} images, rms reprojection error {self.rms:.3f}px")
+        return self.rms
+
+    def write_calibration(self, path: str):
+        """
+            The same layout as lsd_slam/calibration.xml.
+        """
+        storage = cv2.FileStorage(path, cv2.FILE_STORAGE_WRITE)
+        storage.write('image_Width', self.image_size[0])
+        storage.write('image_Height', self.image_size[1])
+        storage.write('Camera_Matrix', self.camera_matrix)
+        storage.write('Distortion_Coefficients', self.distortion.reshape(-1, 1))
+        storage.release()
+        self.logger.info(f"wrote {path}")
+
+    def write_maps(self, path: str):
+        new_matrix, roi = cv2.getOptimalNewCameraMatrix(self.camera_matrix, self.distortion, self.image_size,
+                                                        self.alpha, self.image_size)
+        map1, map2 = cv2.initUndistortRectifyMap(self.camera_matrix, self.distortion, None, new_matrix,
+                                                 self.image_size, cv2.CV_16SC2)
+        np.savez(path, map1=map1, map2=map2, camera_matrix=self.camera_matrix, distortion=self.distortion,
+                 new_camera_matrix=new_matrix, roi=np.array(roi), image_size=np.array(self.image_size))
+        self.logger.info(f"wrote {path}")
+
+
+class Undistorter:
+    """
+        Rectifies frames with the maps saved by the calibration tool, into a preallocated output if given.
+    """
+
+    def __init__(self, path: str):
+        with np.load(path) as maps:
+            self.map1 = maps['map1']
+            self.map2 = maps['map2']
+            self.camera_matrix = maps['new_camera_matrix']
+            self.image_size = tuple(int(x) for x in maps['image_size'])
+
+    def __call__(self, image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        return cv2.remap(image, self.map1, self.map2, cv2.INTER_LINEAR, dst=out)
+
+
+class Main(CommandLineParser):
+    """
+        python3 calibration.py [--images calibration_images] [--output lsd_slam] [--force]
+        -D calibration_board=(19,13) calibration_workers=4
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello camera calibration")
+        self.add_argument('--images', type=str, default=os.path.join(ROOT_DIR, 'calibration_images'))
+        self.add_argument('--output', type=str, default=os.path.join(ROOT_DIR, 'lsd_slam'),
+                          help="directory for calibration.xml, the undistortion maps and the corner cache")
+        self.add_flag('--force')
+        self.parse_args()
+
+    def main(self):
+        os.makedirs(self.args.output, exist_ok=True)
+        calibrator = Calibrator(self.args.images, self.args.output, **GLOBALS)
+        calibrator.calibrate(self.args.force)
+        calibrator.write_calibration(os.path.join(self.args.output, "calibration.xml"))
+        calibrator.write_maps(os.path.join(self.args.output, MAPS_FILE))
+
+
+if __name__ == "__main__":
+    Main().main()
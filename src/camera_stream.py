@@ -1,85 +1,217 @@
 import cv2
-from threading import Thread
-from typing import Optional
+from threading import Thread, current_thread
+from typing import Optional, Tuple
 from datetime import datetime
 import time
-import os
-from utils import logger_mixin, RUN_ID
+import numpy as np
+from utils import logger_mixin, FLIGHT_LOG
+from frame_ring import FrameRing, FrameCursor, Frame, LATEST
+from frame_writer import FrameWriterPool
+from capture_policy import make_capture_policy
+from instrumentation import TRACER
+from flight_recorder import RECORDER
+from ring_buffer import TimeSeriesRing
+from video_decoder import make_decoder
+from frame_pipeline import FramePipeline
+
+ALWAYS = 'always'  # decode every frame
+ON_DEMAND = 'on_demand'  # keep grabbing, decode only what a consumer or a due capture asks for
+DECODE_POLICIES = (ALWAYS, ON_DEMAND)
+
+DECODE_STATS_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('wait_time', 'f4'),  # s, see video_decoder
+    ('decode_time', 'f4'),
+    ('queue_depth', 'i4'),
+])
 
 
 class CameraStream(logger_mixin()):
-"""
-    Camera stream controller.
-"""
+    """
+        Camera stream controller.
+        Decoded frames are published to a FrameRing; consumers take a cursor (`cursor()`) and read read-only views
+        of the ring slots instead of sharing a single frame attribute.
+        With the `on_demand` decode policy every packet is still grabbed, so the stream never backs up, but a frame
+        is only converted and published when a consumer asked for one (see FrameRing.request), a capture is due or
+        the preview window is open - consumers always get the freshest frame and idle streams cost little.
+        The decoder backend is chosen with `video_decoder` (opencv or pyav, see video_decoder.py); the decode time and
+        queue depth of every published frame are kept in `decode_stats`.
+        Conversions consumers need (grayscale, resized, undistorted...) are declared as derived streams with
+        `frame_streams` and computed once per frame off this thread, see frame_pipeline.py; `cursor(stream=name)`
+        subscribes to one.
+    """
     def __init__(self, device: Optional[str] = None, **kwargs):
         self.device = device  # the address of the drone cam
         self.show_cam = kwargs.get('show_cam', False)  # display a the video stream in a window
-        self.video_capture = cv2.VideoCapture(device) if device else None
+        self.options = kwargs
+        self.decoder = make_decoder(device, **kwargs) if device else None  # opened by the stream thread
         self.capture_frames = kwargs.get('capture_frames', False)  # flag: save the captured frames
         self.capture_frame_dir = kwargs.get('frame_dir', 'frames')  # path to dir where frames are saved
-        self.capture_rate = float(kwargs.get('frame_capture_rate', 0.1))  # capture every `capture_rate` seconds
+        self.capture_policy = make_capture_policy(**kwargs)  # which frames are worth writing, see capture_policy.py
+        self.ring = FrameRing(int(kwargs.get('frame_ring_size', 8)))  # decoded frames, shared by all consumers
+        self.pipeline = FramePipeline(self.ring, **kwargs)  # derived streams, see frame_pipeline.py
+        self.decode_policy = kwargs.get('decode_policy', ALWAYS)
+        if self.decode_policy not in DECODE_POLICIES:
+            raise ValueError(f"Unknown decode policy: {self.decode_policy}")
+        self.grabs = 0
+        self.decodes = 0
+        self.decode_stats = TimeSeriesRing(DECODE_STATS_DTYPE, int(kwargs.get('decode_stats_history', 1000)))
+        self.writer = FrameWriterPool(self.capture_frame_dir, **kwargs) if self.capture_frames else None
         self.running = False
         self.grabbed = None
-        self.frame = None
         self.thread = Thread(target=self.update_frame, args=())
 
+    @property
+    def frame(self) -> Optional[np.ndarray]:
+        latest = self.ring.latest()
+        return None if latest is None else latest.image
+
     def set_video_capture(self, device: str):
         if self.device:
             raise ValueError("device already open")
         self.device = device
-        self.video_capture = cv2.VideoCapture(device)
+        self.decoder = make_decoder(device, **self.options)
 
     def _open(self):
-        if self.video_capture is None:
+        if self.decoder is None:
             raise ValueError("unknown device")
-        if not self.video_capture.isOpened():
-            self.video_capture.open(self.device)
+        if not self.decoder.is_open:
+            self.decoder.open()
 
     def start(self):
         if self.running:
             return self
         self.running = True
-        self._open()
-        self.grabbed, self.frame = self.video_capture.read()
-        self.thread.start()
+        self.ring.closed = False
+        if self.writer is not None:
+            self.writer.start()
+        self.pipeline.start()
+        self.thread.start()  # opening blocks until the stream sends data, the thread does it
         return self
 
-    def get_frames(self):
+    def cursor(self, mode: str = LATEST, max_rate: Optional[float] = None,
+               stream: Optional[str] = None) -> FrameCursor:
+        """
+            A cursor on the decoded frames, or on the derived stream `stream` of the pipeline.
+        """
+        if stream is not None:
+            return self.pipeline.cursor(stream, mode, max_rate)
+        return self.ring.cursor(mode, max_rate)
+
+    def latest(self) -> Optional[Frame]:
+        return self.ring.latest()
+
+    def _request_frame(self, timeout: float):
+        """
+            Ask for a frame decoded from now on and wait for it: with the on_demand policy the latest one can be
+            seconds old. Otherwise only the first frame is waited for.
+        """
+        head = self.ring.head
+        self.ring.request()
+        if self.decode_policy == ON_DEMAND or head == 0:
+            self.ring.wait_for(head + 1, timeout)
+
+    def get_frames(self, timeout: float = 1.) -> Tuple[bool, Optional[np.ndarray]]:
+        self._request_frame(timeout)
         return self.grabbed, self.frame
 
+    def _read(self, decode: bool = True):
+        """
+            Grab the next frame and, if `decode`, retrieve it straight into the ring's free slot, falling back to a
+            copy if the decoder could not reuse it (e.g. the frame size changed).
+        """
+        start = time.perf_counter() if TRACER.enabled else 0
+        self.grabbed = self.decoder.grab()
+        if not self.grabbed:
+            return
+        self.grabs += 1
+        if TRACER.enabled:
+            start = TRACER.record('camera.grab', start)
+        if not decode:
+            return
+        slot = self.ring.writable_slot()
+        retrieved, frame = self.decoder.retrieve(slot)
+        if not retrieved:
+            return
+        self.decodes += 1
+        if TRACER.enabled:
+            TRACER.record('camera.retrieve', start)
+        wait_time, decode_time, queue_depth = self.decoder.wait_time, self.decoder.decode_time, self.decoder.queue_depth
+        if FLIGHT_LOG.enabled:
+            FLIGHT_LOG.record("frame", self.ring.head + 1, self.grabs, decode_time, queue_depth)
+        timestamp = time.time()
+        if frame is slot:
+            sequence = self.ring.publish(timestamp)
+        else:
+            sequence = self.ring.write(frame, timestamp)
+        self.decode_stats.append((timestamp, wait_time, decode_time, queue_depth))
+        if RECORDER.enabled:
+            RECORDER.record('frames', timestamp, sequence, self.grabs, decode_time, queue_depth)
+
     def update_frame(self):
         try:
-            with open(f"{self.capture_frame_dir}/frame_list_{RUN_ID}.txt", 'w') as frame_data_file:
-                previous_time = time.time()
-                need_capture = True
-                while self.running:
-                    current_time = time.time()
-                    if current_time > previous_time + self.capture_rate:
-                        previous_time = current_time
-                        need_capture = True
-                    if not self.grabbed or not self.video_capture.isOpened():
+            self._open()
+            self.grabbed, frame = self.decoder.read()
+            if self.grabbed:
+                self.ring.write(frame)
+            while self.running:
+                current_time = time.time()
+                if not self.grabbed or not self.decoder.is_open:
+                    self.stop()
+                    break
+                capture_due = self.writer is not None and self.capture_policy.due(current_time)
+                decode = self.decode_policy == ALWAYS or self.ring.requested or capture_due or self.show_cam
+                if decode:
+                    self.ring.requested = False
+                self._read(decode)
+                if capture_due and self.grabbed and decode:
+                    reason = self.capture_policy.consider(self.frame, current_time)
+                    if reason is not None:
+                        self.writer.submit(self.frame, current_time, reason if self.capture_policy.tags_index else None)
+                if self.show_cam:
+                    cv2.imshow('tello-cam', self.frame)
+                    if not self.running or cv2.waitKey(1) & 0xFF == ord('q'):
                         self.stop()
-                    else:
-                        self.grabbed, self.frame = self.video_capture.read()
-                    if self.capture_frames and need_capture:
-                        need_capture = False
-                        file_name = self.snapshot(f"{self.capture_frame_dir}/{int(current_time * 1000)}.jpeg")
-                        frame_data_file.write(f"{current_time} {os.path.abspath(file_name)}\n")
-                    if self.show_video:
-                        cv2.imshow('tello-cam', self.frame)
-                        if not self.running or cv2.waitKey(1) & 0xFF == ord('q'):
-                            self.stop()
-                            cv2.destroyAllWindows()
+                        cv2.destroyAllWindows()
         finally:
-            if self.show_video:
+            self.ring.close()
+            self.pipeline.stop()
+            if self.decoder is not None:
+                self.decoder.close()
+            if self.writer is not None:
+                self.writer.stop()
+                self.logger.info(f"capture policy stats: {self.capture_policy.stats}")
+            if self.show_cam:
                 cv2.destroyAllWindows()
 
+    def decoder_stats(self, seconds: Optional[float] = None) -> dict:
+        """
+            Wait and decode time (ms) and queue depth of the frames published in the last `seconds` (all kept ones if
+            None).
+        """
+        stats = self.decode_stats.history() if seconds is None else self.decode_stats.window(seconds)
+        if len(stats) == 0:
+            return {'frames': 0}
+        wait_ms, decode_ms = stats['wait_time'] * 1000., stats['decode_time'] * 1000.
+        return {'frames': len(stats), 'wait_ms_mean': float(wait_ms.mean()),
+                'wait_ms_p90': float(np.percentile(wait_ms, 90)), 'decode_ms_mean': float(decode_ms.mean()),
+                'decode_ms_p90': float(np.percentile(decode_ms, 90)), 'decode_ms_max': float(decode_ms.max()),
+                'queue_depth_mean': float(stats['queue_depth'].mean()),
+                'queue_depth_max': int(stats['queue_depth'].max()), 'dropped': self.decoder.dropped}
+
     def snapshot(self, path: Optional[str] = None) -> str:
         img_path = path or datetime.now().strftime('%Y%m%d-%H%M%S') + ".jpeg"
+        self._request_frame(10.)
+        start = time.perf_counter() if TRACER.enabled else 0
         cv2.imwrite(img_path, self.frame)
+        if TRACER.enabled:
+            TRACER.record('camera.snapshot', start)
         return img_path
 
     def stop(self):
         if self.running:
             self.running = False
-            self.thread.join()
+            if current_thread() is not self.thread:
+                if self.decoder is not None:
+                    self.decoder.interrupt()
+                self.thread.join()
@@ -0,0 +1,119 @@
+from typing import Optional
+import cv2
+import numpy as np
+
+"""
+    Which decoded frames CameraStream hands to its FrameWriterPool.
+    The fixed policy keeps one frame every `frame_capture_rate` seconds. The adaptive policy looks at a frame at most
+    every `capture_min_interval` seconds and keeps it when the view changed enough since the last kept frame (mean
+    absolute difference of small grayscale thumbnails), unless it is blurred (variance of the Laplacian); after
+    `capture_max_interval` seconds without a kept frame the next one is kept regardless.
+"""
+
+FIXED = 'fixed'
+ADAPTIVE = 'adaptive'
+
+# selection reasons written to the frame index
+INTERVAL = 'interval'
+FIRST = 'first'
+CHANGE = 'change'
+MAX_INTERVAL = 'max-interval'
+
+
+class FixedRatePolicy:
+    tags_index = False
+
+    def __init__(self, **kwargs):
+        self.interval = float(kwargs.get('frame_capture_rate', 0.1))
+        self.last_check = None
+        self.stats = {'checked': 0, 'kept': 0}
+
+    def due(self, now: float) -> bool:
+        """
+            Whether the next frame should be decoded and passed to `consider`.
+        """
+        return self.last_check is None or now > self.last_check + self.interval
+
+    def consider(self, frame: np.ndarray, now: float) -> Optional[str]:
+        """
+            The reason to keep `frame`, None to skip it.
+        """
+        self.last_check = now
+        self.stats['checked'] += 1
+        self.stats['kept'] += 1
+        return INTERVAL
+
+
+class AdaptiveCapturePolicy:
+    """
+        Options: capture_min_interval (0.2s), capture_max_interval (3s), capture_change_threshold (mean absolute
+        difference, 0-255, default 12), capture_blur_threshold (Laplacian variance below which a frame is too blurred,
+        default 60; 0 disables the check).
+    """
+    tags_index = True
+    THUMBNAIL = (80, 60)  # change metric
+    SHARPNESS = (320, 240)  # blur metric
+
+    def __init__(self, **kwargs):
+        self.min_interval = float(kwargs.get('capture_min_interval', 0.2))
+        self.max_interval = float(kwargs.get('capture_max_interval', 3.))
+        self.change_threshold = float(kwargs.get('capture_change_threshold', 12.))
+        self.blur_threshold = float(kwargs.get('capture_blur_threshold', 60.))
+        self.last_check = None
+        self.last_kept = None
+        self.reference = np.zeros(self.THUMBNAIL[::-1], dtype=np.uint8)  # thumbnail of the last kept frame
+        self.thumbnail = np.zeros_like(self.reference)
+        self.difference = np.zeros_like(self.reference)
+        self.small = np.zeros(self.SHARPNESS[::-1], dtype=np.uint8)
+        self.stats = {'checked': 0, 'kept': 0, 'unchanged': 0, 'blurred': 0}
+
+    def due(self, now: float) -> bool:
+        return self.last_check is None or now >= self.last_check + self.min_interval
+
+    def change(self, frame: np.ndarray) -> float:
+        if frame.ndim == 3:
+            cv2.cvtColor(cv2.resize(frame, self.THUMBNAIL, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY,
+                         dst=self.thumbnail)
+        else:
+            cv2.resize(frame, self.THUMBNAIL, dst=self.thumbnail, interpolation=cv2.INTER_AREA)
+        cv2.absdiff(self.thumbnail, self.reference, dst=self.difference)
+        return float(cv2.mean(self.difference)[0])
+
+    def sharpness(self, frame: np.ndarray) -> float:
+        small = cv2.resize(frame, self.SHARPNESS, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.small)
+        else:
+            np.copyto(self.small, small)
+        _, deviation = cv2.meanStdDev(cv2.Laplacian(self.small, cv2.CV_16S))
+        return float(deviation[0, 0]) ** 2
+
+    def consider(self, frame: np.ndarray, now: float) -> Optional[str]:
+        self.last_check = now
+        self.stats['checked'] += 1
+        change = self.change(frame)
+        if self.last_kept is None:
+            reason = FIRST
+        elif now - self.last_kept >= self.max_interval:
+            reason = MAX_INTERVAL
+        elif change < self.change_threshold:
+            self.stats['unchanged'] += 1
+            return None
+        elif self.blur_threshold and self.sharpness(frame) < self.blur_threshold:
+            self.stats['blurred'] += 1
+            return None
+        else:
+            reason = CHANGE
+        self.last_kept = now
+        self.reference, self.thumbnail = self.thumbnail, self.reference
+        self.stats['kept'] += 1
+        return reason
+
+
+def make_capture_policy(**kwargs):
+    policy = kwargs.get('capture_policy', FIXED)
+    if policy == FIXED:
+        return FixedRatePolicy(**kwargs)
+    if policy == ADAPTIVE:
+        return AdaptiveCapturePolicy(**kwargs)
+    raise ValueError(f"Unknown capture policy: {policy}")
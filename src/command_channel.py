@@ -0,0 +1,475 @@
+import asyncio
+import re
+import socket
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Lock
+from typing import Any, Coroutine, Deque, Dict, List, Optional, Tuple
+from utils import logger_mixin, FLIGHT_LOG
+from flight_recorder import RECORDER
+from instrumentation import TRACER
+
+"""
+    Asynchronous command transport for the Tello SDK.
+
+    The drone answers commands strictly in order and does not tag its responses, so a request is matched to the
+    response that arrives while it is the one in flight. Commands are queued and sent one after the other by a single
+    sender task; callers get a future right away and only block if they choose to wait on it.
+    Queued commands are picked by priority class (safety, then flight, then queries), see CommandScheduler.
+"""
+
+NO_RESPONSE_COMMANDS = ('rc',)  # commands the drone never acknowledges
+VALUE_PATTERN = re.compile(r"^-?\d")  # responses carrying a value rather than an ok/error status
+
+SAFETY = 0
+FLIGHT = 1
+QUERY = 2
+PRIORITY_NAMES = ('safety', 'flight', 'query')
+SAFETY_COMMANDS = ('emergency', 'land', 'stop')
+IMMEDIATE_COMMANDS = ('emergency',)  # sent right away, even with another command in flight
+COALESCED_COMMANDS = ('rc', 'speed')  # setters where only the latest queued value matters
+
+
+class EventLoopThread(logger_mixin()):
+    """
+        An asyncio event loop running on a daemon thread, so synchronous code can submit coroutines to it.
+    """
+
+    def __init__(self, name: str = "tello-event-loop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @property
+    def running(self) -> bool:
+        return self.thread.is_alive()
+
+    def start(self) -> "EventLoopThread":
+        if not self.running:
+            self.thread.start()
+        return self
+
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def stop(self):
+        if self.running:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+
+__default_loop__ = None
+__default_loop_lock__ = Lock()
+
+
+def get_default_loop() -> EventLoopThread:
+    global __default_loop__
+    with __default_loop_lock__:
+        if __default_loop__ is None:
+            __default_loop__ = EventLoopThread().start()
+        return __default_loop__
+
+
+def expects_response(cmd: str) -> bool:
+    return cmd.split(' ', 1)[0] not in NO_RESPONSE_COMMANDS
+
+
+def is_query(cmd: str) -> bool:
+    return cmd.endswith('?')
+
+
+def priority_of(cmd: str) -> int:
+    if cmd.split(' ', 1)[0] in SAFETY_COMMANDS:
+        return SAFETY
+    return QUERY if is_query(cmd) else FLIGHT
+
+
+def coalesce_key(cmd: str) -> Optional[str]:
+    """
+        Queued commands with the same key are merged: a newer setter replaces the older one, an identical query is
+        answered once for all callers.
+    """
+    name = cmd.split(' ', 1)[0]
+    if name in COALESCED_COMMANDS:
+        return name
+    return cmd if is_query(cmd) else None
+
+
+def command_values(cmd: str) -> List[float]:
+    """
+        The first numeric arguments of a command (up to four), as recorded in the flight log.
+    """
+    values = []
+    for arg in cmd.split()[1:5]:
+        try:
+            values.append(float(arg))
+        except ValueError:
+            pass
+    return values
+
+
+class CommandCancelled(Exception):
+    """
+        A queued command dropped before it was sent, see CommandScheduler.
+    """
+
+
+class PendingCommand:
+    __slots__ = ('command', 'timeout', 'retries', 'future', 'queued_at', 'priority', 'followers')
+
+    def __init__(self, command: str, timeout: float, retries: int, future: asyncio.Future):
+        self.command = command
+        self.timeout = timeout
+        self.retries = retries
+        self.future = future
+        self.queued_at = time.perf_counter()
+        self.priority = priority_of(command)
+        self.followers: List[asyncio.Future] = []  # callers of commands merged into this one
+
+    @property
+    def done(self) -> bool:
+        return self.future.done() and all(future.done() for future in self.followers)
+
+    def merge(self, newer: "PendingCommand"):
+        self.command = newer.command
+        self.timeout = max(self.timeout, newer.timeout)
+        self.retries = max(self.retries, newer.retries)
+        self.followers.append(newer.future)
+
+    def resolve(self, result: Any):
+        for future in (self.future, *self.followers):
+            if not future.done():
+                future.set_result(result)
+
+    def fail(self, exception: BaseException):
+        for future in (self.future, *self.followers):
+            if not future.done():
+                future.set_exception(exception)
+
+    def cancel(self):
+        for future in (self.future, *self.followers):
+            future.cancel()
+
+    def accepts(self, response: str) -> bool:
+        """
+            A query is answered by a value, anything else by a status. A response of the wrong kind is a late answer
+            to a command that already timed out.
+        """
+        if is_query(self.command):
+            return response != 'ok'
+        return not VALUE_PATTERN.match(response)
+
+
+class CommandScheduler(logger_mixin()):
+    """
+        The channel's send queue, used only from the event loop. One FIFO per priority class; the sender always takes
+        the oldest command of the most urgent class whose rate limit allows it, so a `land` queued behind a long
+        list of moves and queries goes out as soon as the command in flight is answered. Queuing a safety command
+        cancels the flight commands still queued (their callers get a CommandCancelled), a takeoff or move must not
+        go out after the land or emergency that overtook it.
+        Superseded setters and duplicate queries are merged (see coalesce_key), only into the newest queued command of
+        their class so nothing is reordered around the commands queued in between. Once `max_queued` commands wait,
+        new flight and query commands wait for room, safety commands are always accepted.
+    """
+
+    def __init__(self, max_queued: int = 32, rate_limits: Optional[Dict[str, float]] = None):
+        self.max_queued = max_queued
+        self.queues: List[Deque[PendingCommand]] = [deque() for _ in PRIORITY_NAMES]
+        self.intervals = [0.] * len(PRIORITY_NAMES)  # minimal time between two sends of a class
+        for name, rate in (rate_limits or {}).items():
+            self.intervals[PRIORITY_NAMES.index(name)] = 1. / rate if rate else 0.
+        self.next_allowed = [0.] * len(PRIORITY_NAMES)
+        self.merge_targets: Dict[str, PendingCommand] = {}
+        self.waiting: Deque[object] = deque()  # callers waiting for room, in order
+        self.size = 0
+        self.changed = asyncio.Event()
+        self.room = asyncio.Event()
+        self.stats = {'queued': 0, 'coalesced': 0, 'throttled': 0, 'waited_for_room': 0, 'preempted': 0}
+
+    def empty(self) -> bool:
+        return self.size == 0
+
+    def preempt(self, command: str) -> int:
+        """
+            Fail the queued flight commands, overtaken by the safety `command`. Returns how many there were.
+        """
+        queue = self.queues[FLIGHT]
+        cancelled = 0
+        while queue:
+            pending = self._pop(FLIGHT)
+            if not pending.done:
+                pending.fail(CommandCancelled(f"'{pending.command}' cancelled by '{command}'"))
+                cancelled += 1
+        self.stats['preempted'] += cancelled
+        return cancelled
+
+    async def put(self, pending: PendingCommand):
+        if pending.priority == SAFETY:
+            self.preempt(pending.command)
+        elif self.size >= self.max_queued or self.waiting:
+            # callers get room in the order they came, nobody overtakes the ones already waiting
+            self.stats['waited_for_room'] += 1
+            turn = object()
+            self.waiting.append(turn)
+            try:
+                while self.size >= self.max_queued or self.waiting[0] is not turn:
+                    self.room.clear()
+                    await self.room.wait()
+            finally:
+                self.waiting.remove(turn)
+                self.room.set()  # the next one in line checks again
+        key = coalesce_key(pending.command)
+        target = self.merge_targets.get(key) if key is not None else None
+        if target is not None and not target.done:
+            target.merge(pending)
+            self.stats['coalesced'] += 1
+            return
+        self.queues[pending.priority].append(pending)
+        # the older commands of this class are no longer the newest, merging into them would reorder the queue
+        for stale in [name for name, queued in self.merge_targets.items() if queued.priority == pending.priority]:
+            del self.merge_targets[stale]
+        if key is not None:
+            self.merge_targets[key] = pending
+        self.size += 1
+        self.stats['queued'] += 1
+        self.changed.set()
+
+    def _pop(self, priority: int) -> PendingCommand:
+        pending = self.queues[priority].popleft()
+        key = coalesce_key(pending.command)
+        if key is not None and self.merge_targets.get(key) is pending:
+            del self.merge_targets[key]
+        self.size -= 1
+        self.room.set()
+        return pending
+
+    async def get(self) -> PendingCommand:
+        while True:
+            now = time.perf_counter()
+            wait = None
+            for priority, queue in enumerate(self.queues):
+                while queue and queue[0].done:
+                    self._pop(priority)
+                if not queue:
+                    continue
+                if now >= self.next_allowed[priority]:
+                    self.next_allowed[priority] = now + self.intervals[priority]
+                    return self._pop(priority)
+                self.stats['throttled'] += 1
+                delay = self.next_allowed[priority] - now
+                wait = delay if wait is None else min(wait, delay)
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def drain(self) -> List[PendingCommand]:
+        pending = [command for queue in self.queues for command in queue]
+        for queue in self.queues:
+            queue.clear()
+        self.merge_targets.clear()
+        self.size = 0
+        self.room.set()
+        return pending
+
+
+class _CommandProtocol(asyncio.DatagramProtocol):
+    def __init__(self, channel: "CommandChannel"):
+        self.channel = channel
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.channel._on_response(data, addr)
+
+    def error_received(self, exc: Exception):
+        self.channel.logger.error(exc)
+
+
+class CommandChannel(logger_mixin()):
+    """
+        Pipelined command channel: `submit` queues a command and returns a future resolved with the drone's response.
+        Timeouts and retries are applied per command. Query commands are retried by default, flight commands are not
+        since repeating e.g. `forward 500` after a lost acknowledgement would move the drone twice.
+        Scheduling options: command_queue_size (default 32) and command_rate_limits, sends per second per priority
+        class, e.g. {'query': 10} (default: no limits).
+    """
+
+    def __init__(self, remote_address: Tuple[str, int], loop: Optional[EventLoopThread] = None, **kwargs):
+        self.remote_address = remote_address
+        self.loop_thread = loop or get_default_loop()
+        self.default_timeout = float(kwargs.get('command_timeout', 20))
+        self.query_retries = int(kwargs.get('query_retries', 2))
+        self.command_retries = int(kwargs.get('command_retries', 0))
+        self.queue_size = int(kwargs.get('command_queue_size', 32))
+        self.rate_limits = dict(kwargs.get('command_rate_limits', {}))
+        self.transport = None
+        self._queue = None
+        self._sender = None
+        self._in_flight = None
+        self._response = None
+        self.last_sent_at = 0.  # time.perf_counter() of the last datagram sent
+        self.sent = 0  # datagrams sent, numbers the recorded commands
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.loop_thread.loop
+
+    @property
+    def is_open(self) -> bool:
+        return self.transport is not None
+
+    @property
+    def idle(self) -> bool:
+        """
+            Nothing queued and nothing waiting for a response.
+        """
+        return self.is_open and self._queue.empty() and self._in_flight is None
+
+    def open(self, sock: socket.socket) -> "CommandChannel":
+        """
+            Attach the channel to an already bound UDP socket.
+        """
+        if self.is_open:
+            return self
+        self.loop_thread.start()
+        self.loop_thread.submit(self._open(sock)).result()
+        return self
+
+    async def _open(self, sock: socket.socket):
+        sock.setblocking(False)
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: _CommandProtocol(self), sock=sock)
+        self._queue = CommandScheduler(self.queue_size, self.rate_limits)
+        self._sender = self.loop.create_task(self._send_loop())
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.loop_thread.submit(self._close()).result()
+
+    async def _close(self):
+        self._sender.cancel()
+        for pending in self._queue.drain():
+            pending.cancel()
+        if self._in_flight is not None:
+            self._in_flight.cancel()
+        self.transport.close()
+        self.transport = None
+
+    def _retries_for(self, cmd: str, retries: Optional[int]) -> int:
+        if retries is not None:
+            return retries
+        return self.query_retries if is_query(cmd) or cmd == 'command' else self.command_retries
+
+    async def request(self, cmd: str, timeout: Optional[float] = None, retries: Optional[int] = None) -> str:
+        """
+            Queue a command and wait for its response. Must be awaited on the channel's event loop.
+            `emergency` skips the queue and is sent at once, its result is None.
+        """
+        if not self.is_open:
+            raise ConnectionError("command channel is not open")
+        if cmd in IMMEDIATE_COMMANDS:
+            # whatever is in flight gets the drone's answer, the motors are off either way
+            self._queue.preempt(cmd)
+            self._sendto(cmd)
+            return None
+        future = self.loop.create_future()
+        await self._queue.put(PendingCommand(cmd, timeout or self.default_timeout,
+                                             self._retries_for(cmd, retries), future))
+        return await future
+
+    def submit(self, cmd: str, timeout: Optional[float] = None, retries: Optional[int] = None) -> Future:
+        """
+            Thread-safe: queue a command from any thread, returns a concurrent future.
+        """
+        return self.loop_thread.submit(self.request(cmd, timeout, retries))
+
+    def send_nowait(self, cmd: str):
+        """
+            Send a command immediately, bypassing the queue and without waiting for a response.
+        """
+        if not self.is_open:
+            raise ConnectionError("command channel is not open")
+        self.loop_thread.call_soon(self._send_now, cmd)
+
+    def _send_now(self, cmd: str):
+        if priority_of(cmd) == SAFETY:
+            self._queue.preempt(cmd)
+        self._sendto(cmd)
+
+    def _sendto(self, cmd: str) -> int:
+        self.logger.debug("sending %s", cmd)
+        self.transport.sendto(cmd.encode(encoding="utf-8"), self.remote_address)
+        self.last_sent_at = time.perf_counter()
+        self.sent += 1
+        if FLIGHT_LOG.enabled:
+            FLIGHT_LOG.record(f"send {cmd.split(' ', 1)[0]}", *command_values(cmd))
+        if RECORDER.enabled:
+            name = cmd.split(' ', 1)[0]
+            RECORDER.record('commands', self.sent, RECORDER.string_id(name),
+                            RECORDER.string_id(None if name in NO_RESPONSE_COMMANDS else cmd),
+                            (command_values(cmd) + [0.] * 4)[:4])
+        return self.sent
+
+    async def _send_loop(self):
+        while True:
+            pending = await self._queue.get()
+            if pending.done:
+                continue
+            await self._execute(pending)
+
+    async def _execute(self, pending: PendingCommand):
+        if TRACER.enabled:
+            TRACER.record('command.queue', pending.queued_at)
+        if not expects_response(pending.command):
+            self._sendto(pending.command)
+            pending.resolve(None)
+            return
+        self._in_flight = pending
+        try:
+            for attempt in range(pending.retries + 1):
+                self._response = self.loop.create_future()
+                sent_at = time.perf_counter()
+                sequence = self._sendto(pending.command)
+                try:
+                    response = await asyncio.wait_for(self._response, pending.timeout)
+                except asyncio.TimeoutError:
+                    self.logger.warning(f"no response to '{pending.command}' "
+                                        f"(attempt {attempt + 1}/{pending.retries + 1})")
+                    continue
+                if TRACER.enabled:
+                    TRACER.record(f"command.ack.{pending.command.split(' ', 1)[0]}", sent_at)
+                if FLIGHT_LOG.enabled:
+                    FLIGHT_LOG.record(f"ack {pending.command.split(' ', 1)[0]}", time.perf_counter() - sent_at,
+                                      attempt, float(response == 'ok'))
+                if RECORDER.enabled:
+                    RECORDER.record('acks', sequence, RECORDER.string_id(response), time.perf_counter() - sent_at,
+                                    attempt, response == 'ok')
+                pending.resolve(response)
+                return
+            pending.fail(socket.timeout(f"no response to '{pending.command}'"))
+        finally:
+            self._in_flight = None
+            self._response = None
+
+    def _on_response(self, data: bytes, addr: Tuple[str, int]):
+        try:
+            response = data.decode(encoding="utf-8").strip()
+        except UnicodeDecodeError:
+            self.logger.debug("dropping undecodable response from %s", addr)
+            return
+        self.logger.debug("received %s", response)
+        pending = self._in_flight
+        if pending is None or self._response is None or self._response.done() or not pending.accepts(response):
+            self.logger.debug("dropping stale response: %s", response)
+            return
+        self._response.set_result(response)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: remote={self.remote_address} open={self.is_open}>"
@@ -0,0 +1,222 @@
+import asyncio
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Any, Dict, Optional
+from utils import logger_mixin, CommandLineParser, GLOBALS
+from command_channel import get_default_loop
+from tello import DroneController
+
+"""
+    Several drones from one ground station: the drones join a common WiFi network (station mode, see
+    DroneController.set_wifi_ssid), each gets its own command socket, video port and telemetry buffer, and all command
+    channels run on a single event loop.
+"""
+
+
+class FleetTelemetry(logger_mixin()):
+    """
+        Every drone broadcasts its state to the same port, packets are routed to the right drone by source address.
+    """
+
+    def __init__(self, drones: Dict[str, DroneController], address: tuple = ('', 8890)):
+        self.address = address
+        self.routes = {drone.TELLO_ADDRESS[0]: drone.telemetry for drone in drones.values()}
+        self.unknown = 0
+        self.socket = None
+        self.running = False
+        self.thread = Thread(target=self.update_state, args=(), daemon=True)
+
+    def start(self) -> "FleetTelemetry":
+        if self.running:
+            return self
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.settimeout(0.5)
+        self.running = True
+        self.thread.start()
+        return self
+
+    def update_state(self):
+        while self.running:
+            try:
+                data, (host, _) = self.socket.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self.running:
+                    self.logger.error(e)
+                break
+            receiver = self.routes.get(host)
+            if receiver is None:
+                self.unknown += 1
+                continue
+            receiver.ingest(data)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.socket.close()
+
+
+class FleetController(logger_mixin()):
+    """
+        Drives N drones concurrently. `broadcast` sends a command to every drone and collects each one's response
+        (or exception); `synchronized` first waits for every command channel to be idle so the command leaves for all
+        drones in the same event loop turn, and reports the send skew.
+        Drone i binds local port `fleet_local_port + i` and, with `fleet_set_ports` (SDK 3.0), is told to stream
+        video to `fleet_video_port + i`.
+    """
+
+    def __init__(self, drones: Dict[str, str], **kwargs):
+        self.loop = get_default_loop()
+        self.skew_warning = float(kwargs.get('fleet_skew_warning', 0.02))  # s, only logged
+        self.set_ports = kwargs.get('fleet_set_ports', False)
+        command_port = int(kwargs.get('fleet_command_port', DroneController.TELLO_ADDRESS[1]))
+        local_port = int(kwargs.get('fleet_local_port', 9000))
+        video_port = int(kwargs.get('fleet_video_port', DroneController.VS_UDP_PORT))
+        state_address = tuple(kwargs.get('state_address', DroneController.STATE_ADDRESS))
+        options = {key: val for key, val in kwargs.items()
+                   if key not in ('tello_address', 'local_address', 'vs_udp_port', 'state_address')}
+        self.drones: Dict[str, DroneController] = {}
+        for i, (name, host) in enumerate(drones.items()):
+            self.drones[name] = DroneController(None, tello_address=(host, command_port),
+                                                local_address=('', local_port + i), vs_udp_port=video_port + i,
+                                                state_address=None, event_loop=self.loop, **options)
+        self.telemetry = FleetTelemetry(self.drones, state_address)
+        self.state_port = state_address[1]
+
+    def __getitem__(self, name: str) -> DroneController:
+        return self.drones[name]
+
+    def __len__(self) -> int:
+        return len(self.drones)
+
+    async def _gather(self, cmd: str, timeout: Optional[float], retries: Optional[int]) -> Dict[str, Any]:
+        return await self._gather_each(lambda drone: cmd, timeout, retries)
+
+    def broadcast(self, cmd: str, timeout: Optional[float] = None, retries: Optional[int] = None) -> Dict[str, Any]:
+        """
+            Send `cmd` to every drone concurrently. Returns each drone's response, or the exception it raised.
+        """
+        return self.loop.submit(self._gather(cmd, timeout, retries)).result()
+
+    async def _synchronized(self, cmd: str, timeout: Optional[float], idle_timeout: float) -> Dict[str, Any]:
+        deadline = time.perf_counter() + idle_timeout
+        while not all(drone.channel.idle for drone in self.drones.values()):
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"command channels still busy, not sending '{cmd}'")
+            await asyncio.sleep(0.001)
+        results = await self._gather(cmd, timeout, 0)
+        sent = [drone.channel.last_sent_at for drone in self.drones.values()]
+        results['skew'] = max(sent) - min(sent)
+        return results
+
+    def synchronized(self, cmd: str, timeout: Optional[float] = None, idle_timeout: float = 30.) -> Dict[str, Any]:
+        """
+            Send `cmd` to all drones at once. The result has each drone's response plus the measured 'skew' between
+            the first and last send, in seconds. A skew above `fleet_skew_warning` only logs a warning, the command
+            has already been sent to every drone by then.
+        """
+        results = self.loop.submit(self._synchronized(cmd, timeout, idle_timeout)).result()
+        if results['skew'] > self.skew_warning:
+            self.logger.warning(f"'{cmd}' sent with a skew of {results['skew'] * 1000:.1f}ms")
+        return results
+
+    async def _gather_each(self, make_cmd, timeout: Optional[float] = None,
+                           retries: Optional[int] = None) -> Dict[str, Any]:
+        results = await asyncio.gather(*(drone.channel.request(make_cmd(drone), timeout, retries)
+                                         for drone in self.drones.values()), return_exceptions=True)
+        return dict(zip(self.drones, results))
+
+    def broadcast_each(self, make_cmd) -> Dict[str, Any]:
+        """
+            Like `broadcast`, with a per-drone command built by `make_cmd(drone)`.
+        """
+        return self.loop.submit(self._gather_each(make_cmd)).result()
+
+    def arm(self) -> "FleetController":
+        for drone in self.drones.values():
+            drone.command_socket.bind(drone.LOCAL_ADDRESS)
+            drone.channel.open(drone.command_socket)
+            drone.armed = True
+        self.telemetry.start()
+        for drone in self.drones.values():
+            drone.odometry.start()  # fed by the samples FleetTelemetry routes to the drone's receiver
+        failed = {name: result for name, result in self.broadcast("command").items() if result != 'ok'}
+        if failed:
+            raise ConnectionError(f"failed to arm: {failed}")
+        if self.set_ports:
+            for name, result in self.broadcast_each(
+                    lambda drone: f"port {self.state_port} {drone.VS_UDP_PORT}").items():
+                if result != 'ok':
+                    self.logger.error(f"{name} refused its stream ports: {result}")
+        return self
+
+    def takeoff(self) -> Dict[str, Any]:
+        for drone in self.drones.values():
+            if not drone.is_flying:
+                drone.odometry.reset()  # positions are relative to the takeoff spot
+        results = self.synchronized("takeoff")
+        for name, drone in self.drones.items():
+            drone.is_flying = drone.is_flying or results[name] == 'ok'
+        return results
+
+    def land(self) -> Dict[str, Any]:
+        results = self.synchronized("land")
+        for name, drone in self.drones.items():
+            drone.is_flying = drone.is_flying and results[name] != 'ok'
+        return results
+
+    def emergency(self):
+        """
+            Stop all motors right away, skipping every queue.
+        """
+        for drone in self.drones.values():
+            drone.channel.send_nowait("emergency")
+            drone.is_flying = False
+
+    def batteries(self) -> Dict[str, int]:
+        return {name: drone.get_battery() for name, drone in self.drones.items()}
+
+    def end(self):
+        with ThreadPoolExecutor(len(self.drones)) as pool:
+            list(pool.map(lambda drone: drone.end(), self.drones.values()))
+        self.telemetry.stop()
+        for drone in self.drones.values():
+            drone.shutdown()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {', '.join(f'{n}={d.TELLO_ADDRESS[0]}' for n, d in self.drones.items())}>"
+
+
+class Main(CommandLineParser):
+    """
+        python3 fleet.py --drone Frodo=192.168.1.11 --drone Sam=192.168.1.12 [--takeoff-test]
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello fleet")
+        self.add_argument('--drone', type=str, action='append', required=True, help="name=ip, once per drone")
+        self.add_argument('--takeoff-test', default=False, const=True, nargs='?',
+                          help="synchronized takeoff, hover for 5 seconds and land")
+        self.parse_args()
+        self.fleet = FleetController(dict(drone.split('=', 1) for drone in self.args.drone), **GLOBALS)
+
+    def main(self):
+        try:
+            self.fleet.arm()
+            self.logger.info(f"batteries: {self.fleet.batteries()}")
+            if self.args.takeoff_test:
+                self.logger.info(f"takeoff: {self.fleet.takeoff()}")
+                time.sleep(5)
+                self.logger.info(f"land: {self.fleet.land()}")
+        finally:
+            self.fleet.end()
+
+
+if __name__ == "__main__":
+    Main().main()
@@ -0,0 +1,420 @@
+import atexit
+import json
+import os
+import queue
+import time
+from threading import Lock, Thread
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from utils import logger_mixin, CommandLineParser, RUN_ID
+
+"""
+    One append-only, columnar recording per run (`flight_<RUN_ID>` in the `flight_recorder` directory), with every
+    row stamped by the same monotonic clock: its `clock` column, seconds since the recorder was opened (a
+    time.perf_counter difference; `started` in the meta is the wall-clock time of 0).
+        meta.json               run id, wall-clock start time, the streams and their column types
+        strings.txt             interned strings (command names, responses, frame paths), the line number is the id
+        <stream>.chunks         CHUNK_DTYPE index, one entry per written chunk: first row, rows, first and last time
+        <stream>.<column>       the column's values back to back
+    Rows are buffered per stream and written a chunk at a time by a background thread; a chunk's index entry is
+    appended after its columns, so readers only see complete chunks. Rows of a stream are in time order, a time
+    range is found by a binary search over the chunk index and then within the chunk.
+"""
+
+CHUNK_DTYPE = np.dtype([
+    ('first', '<u8'),  # first row of the chunk
+    ('rows', '<u4'),
+    ('reserved', '<u4'),
+    ('start', '<f8'),  # clock of the first and last row
+    ('end', '<f8'),
+])
+META_FILE = "meta.json"
+STRINGS_FILE = "strings.txt"
+NO_STRING = 0xffffffff
+
+STREAMS = {
+    'commands': np.dtype([
+        ('clock', '<f8'),
+        ('sequence', '<u4'),  # per channel, matches the ack
+        ('name', '<u4'),  # string id
+        ('text', '<u4'),  # string id of the whole command, NO_STRING for rc packets (see values)
+        ('values', '<f4', (4,)),  # numeric arguments
+    ]),
+    'acks': np.dtype([
+        ('clock', '<f8'),
+        ('sequence', '<u4'),
+        ('response', '<u4'),  # string id
+        ('rtt', '<f4'),  # seconds since the answered send
+        ('attempt', '<u1'),
+        ('ok', '?'),
+    ]),
+    'frames': np.dtype([
+        ('clock', '<f8'),
+        ('timestamp', '<f8'),  # capture time, seconds since the epoch
+        ('frame', '<u8'),  # sequence in the camera's frame ring
+        ('grabs', '<u8'),  # packets grabbed so far, frames skipped by on-demand decoding are the difference
+        ('decode_time', '<f4'),  # s, see video_decoder
+        ('queue_depth', '<i4'),  # input waiting behind the frame, -1 if the decoder can't tell
+    ]),
+    'captures': np.dtype([
+        ('clock', '<f8'),
+        ('timestamp', '<f8'),  # capture time of the saved frame, matches a `frames` row
+        ('path', '<u4'),  # string id of the image file or archive directory
+        ('index', '<i8'),  # frame number in the archive, -1 for image files
+        ('reason', '<u4'),  # string id, see capture_policy
+    ]),
+}
+
+
+def dtype_to_json(dtype: np.dtype) -> list:
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+
+def dtype_from_json(fields: list) -> np.dtype:
+    return np.dtype([(name, base, tuple(shape)) if shape else (name, base) for name, base, shape in fields])
+
+
+class FlightRecorder(logger_mixin()):
+    """
+        Writer side. Closed by default, hot paths guard with `if RECORDER.enabled:` like FLIGHT_LOG.
+        `record(stream, *values)` appends a row of one of the STREAMS (clock excluded, it is taken here),
+        `record_row(stream, row)` appends a structured row (e.g. a telemetry sample), declaring the stream on first use.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.chunk_records = 4096
+        self.flush_interval = 1.
+        self.origin = 0.
+        self.started = 0.
+        self.lock = Lock()
+        self.streams: Dict[str, np.dtype] = {}
+        self.buffers: Dict[str, np.ndarray] = {}
+        self.counts: Dict[str, int] = {}
+        self.strings: Dict[str, int] = {}
+        self.rows = 0
+        self.chunks = queue.SimpleQueue()
+        self.thread = None
+
+    def open(self, directory: str, chunk_records: int = 4096, flush_interval: float = 1.) -> "FlightRecorder":
+        if self.enabled:
+            return self
+        self.directory = directory
+        self.chunk_records = chunk_records
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        self.strings.clear()
+        open(os.path.join(directory, STRINGS_FILE), 'w').close()
+        for name, dtype in STREAMS.items():
+            self._declare(name, dtype)
+        self.thread = Thread(target=self._write, name="flight-recorder", daemon=True)
+        self.thread.start()
+        self.enabled = True
+        atexit.register(self.close)
+        self.logger.info(f"recording the flight to {directory}")
+        return self
+
+    def clock(self) -> float:
+        return time.perf_counter() - self.origin
+
+    def from_epoch(self, timestamp: float) -> float:
+        """
+            A time.time() timestamp on the recorder's clock.
+        """
+        return timestamp - self.started
+
+    def _declare(self, stream: str, dtype: np.dtype):
+        self.streams[stream] = dtype
+        self.buffers[stream] = np.zeros(self.chunk_records, dtype=dtype)
+        self.counts[stream] = 0
+        self.chunks.put(('declare', stream, dtype))
+
+    def intern(self, string: str) -> int:
+        """
+            Id of `string` in the strings table, call with the lock held or from a single thread.
+        """
+        string_id = self.strings.get(string)
+        if string_id is None:
+            string_id = self.strings[string] = len(self.strings)
+            self.chunks.put(('string', string, None))
+        return string_id
+
+    def string_id(self, string: Optional[str]) -> int:
+        if string is None:
+            return NO_STRING
+        with self.lock:
+            return self.intern(string)
+
+    def record(self, stream: str, *values):
+        if not self.enabled:
+            return
+        with self.lock:
+            now = time.perf_counter() - self.origin  # under the lock, rows stay in clock order
+            count = self.counts[stream]
+            self.buffers[stream][count] = (now,) + values
+            self._advance(stream, count + 1)
+
+    def record_row(self, stream: str, row: np.void):
+        if not self.enabled:
+            return
+        with self.lock:
+            now = time.perf_counter() - self.origin
+            if stream not in self.streams:
+                self._declare(stream, np.dtype([('clock', '<f8')] + [
+                    (name, row.dtype.fields[name][0]) for name in row.dtype.names]))
+            count = self.counts[stream]
+            self.buffers[stream][count] = (now,) + row.item()
+            self._advance(stream, count + 1)
+
+    def _advance(self, stream: str, count: int):
+        self.counts[stream] = count
+        self.rows += 1
+        if count == self.chunk_records:
+            self._flush(stream)
+
+    def _flush(self, stream: str):
+        count = self.counts[stream]
+        if count:
+            self.chunks.put(('chunk', stream, self.buffers[stream][:count]))
+            self.buffers[stream] = np.zeros(self.chunk_records, dtype=self.streams[stream])
+            self.counts[stream] = 0
+
+    def flush(self):
+        with self.lock:
+            for stream in self.streams:
+                self._flush(stream)
+
+    def _write_meta(self, streams: Dict[str, np.dtype]):
+        meta = {'run_id': str(RUN_ID), 'started': self.started, 'clock': 'perf_counter',
+                'streams': {name: dtype_to_json(dtype) for name, dtype in streams.items()}}
+        with open(os.path.join(self.directory, META_FILE + ".tmp"), 'w') as meta_file:
+            json.dump(meta, meta_file, indent=1)
+        os.replace(os.path.join(self.directory, META_FILE + ".tmp"), os.path.join(self.directory, META_FILE))
+
+    def _write(self):
+        streams: Dict[str, np.dtype] = {}
+        rows: Dict[str, int] = {}
+        last_flush = time.perf_counter()
+        with open(os.path.join(self.directory, STRINGS_FILE), 'a') as strings_file:
+            while True:
+                try:
+                    item = self.chunks.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = ('flush', None, None)
+                if item is None:
+                    break
+                kind, name, payload = item
+                if kind == 'string':
+                    strings_file.write(name.replace('\n', ' ') + '\n')
+                    strings_file.flush()
+                elif kind == 'declare':
+                    streams[name] = payload
+                    rows[name] = 0
+                    for column in payload.names:
+                        open(os.path.join(self.directory, f"{name}.{column}"), 'wb').close()
+                    open(os.path.join(self.directory, f"{name}.chunks"), 'wb').close()
+                    self._write_meta(streams)
+                elif kind == 'chunk':
+                    for column in payload.dtype.names:
+                        with open(os.path.join(self.directory, f"{name}.{column}"), 'ab') as column_file:
+                            np.ascontiguousarray(payload[column]).tofile(column_file)
+                    entry = np.array((rows[name], len(payload), 0, payload['clock'][0], payload['clock'][-1]),
+                                     dtype=CHUNK_DTYPE)
+                    with open(os.path.join(self.directory, f"{name}.chunks"), 'ab') as index_file:
+                        entry.tofile(index_file)
+                    rows[name] += len(payload)
+                if time.perf_counter() - last_flush >= self.flush_interval:
+                    # bound what a crash loses: partial chunks go out every flush_interval
+                    last_flush = time.perf_counter()
+                    self.flush()
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.flush()
+        self.chunks.put(None)
+        self.thread.join()
+        self.logger.info(f"recorded {self.rows} rows to {self.directory}")
+
+
+RECORDER = FlightRecorder()
+
+
+class FlightRecording:
+    """
+        Reader side, works on a recording that is still being written. Columns are memory mapped, so a time range
+        query only touches the pages of the rows it returns.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.started = self.meta['started']
+        self.streams = {name: dtype_from_json(fields) for name, fields in self.meta['streams'].items()}
+        self._strings = None
+
+    @property
+    def strings(self) -> List[str]:
+        if self._strings is None:
+            with open(os.path.join(self.directory, STRINGS_FILE)) as strings_file:
+                self._strings = [line.rstrip('\n') for line in strings_file]
+        return self._strings
+
+    def string(self, string_id: int) -> Optional[str]:
+        if string_id == NO_STRING:
+            return None
+        if string_id >= len(self.strings):
+            self._strings = None  # written since we read them
+        return self.strings[string_id]
+
+    def to_epoch(self, t: float) -> float:
+        return self.started + t
+
+    def chunks(self, stream: str) -> np.ndarray:
+        return np.fromfile(os.path.join(self.directory, f"{stream}.chunks"), dtype=CHUNK_DTYPE)
+
+    def __len__(self) -> int:
+        return sum(self.length(stream) for stream in self.streams)
+
+    def length(self, stream: str, chunks: Optional[np.ndarray] = None) -> int:
+        chunks = self.chunks(stream) if chunks is None else chunks
+        return int(chunks['first'][-1] + chunks['rows'][-1]) if len(chunks) else 0
+
+    def column(self, stream: str, column: str, length: Optional[int] = None) -> np.ndarray:
+        length = self.length(stream) if length is None else length
+        field = self.streams[stream].fields[column][0]
+        if length == 0:
+            return np.zeros((0,) + field.shape, dtype=field.base)
+        return np.memmap(os.path.join(self.directory, f"{stream}.{column}"), dtype=field.base, mode='r',
+                         shape=(length,) + field.shape)
+
+    def rows(self, stream: str, start: float = -np.inf, end: float = np.inf) -> range:
+        """
+            The rows of `stream` with start <= clock <= end.
+        """
+        chunks = self.chunks(stream)
+        if len(chunks) == 0:
+            return range(0)
+        times = self.column(stream, 'clock', self.length(stream, chunks))
+        first = int(np.searchsorted(chunks['end'], start, side='left'))
+        last = int(np.searchsorted(chunks['start'], end, side='right'))
+        if first >= last:
+            return range(0)
+        low, high = int(chunks['first'][first]), int(chunks['first'][last - 1] + chunks['rows'][last - 1])
+        return range(low + int(np.searchsorted(times[low:high], start, side='left')),
+                     low + int(np.searchsorted(times[low:high], end, side='right')))
+
+    def read(self, stream: str, rows: range, columns: Optional[Sequence[str]] = None) -> np.ndarray:
+        dtype = self.streams[stream]
+        columns = list(dtype.names if columns is None else dict.fromkeys(('clock',) + tuple(columns)))
+        records = np.empty(len(rows), dtype=[(column, dtype.fields[column][0]) for column in columns])
+        for column in columns:
+            records[column] = self.column(stream, column)[rows.start:rows.stop]
+        return records
+
+    def between(self, stream: str, start: float = -np.inf, end: float = np.inf,
+                columns: Optional[Sequence[str]] = None) -> np.ndarray:
+        """
+            The rows of `stream` recorded between `start` and `end` (recorder clock) as a structured array,
+            optionally only some of its columns.
+        """
+        return self.read(stream, self.rows(stream, start, end), columns)
+
+    def at(self, stream: str, t: float) -> Optional[np.void]:
+        """
+            The last row of `stream` recorded at or before `t`, e.g. the telemetry when a command was sent.
+        """
+        rows = self.rows(stream, end=t)
+        if len(rows) == 0:
+            return None
+        return self.read(stream, range(rows.stop - 1, rows.stop))[0]
+
+    def duration(self) -> float:
+        ends = [float(chunks['end'][-1]) for chunks in map(self.chunks, self.streams) if len(chunks)]
+        return max(ends) if ends else 0.
+
+    def summary(self) -> Dict[str, Tuple[int, float, float]]:
+        """
+            stream -> (rows, first time, last time)
+        """
+        summary = {}
+        for stream in self.streams:
+            chunks = self.chunks(stream)
+            summary[stream] = (self.length(stream, chunks), float(chunks['start'][0]) if len(chunks) else 0.,
+                               float(chunks['end'][-1]) if len(chunks) else 0.)
+        return summary
+
+    def replay(self, start: float = 0., end: Optional[float] = None, streams: Optional[Sequence[str]] = None,
+               speed: Optional[float] = None, step: float = 10.) -> Iterator[Tuple[float, str, np.void]]:
+        """
+            (time, stream, row) of the given streams merged in time order, read `step` seconds at a time. With a
+            `speed` rows are yielded at that multiple of the recorded pace, otherwise as fast as they are consumed.
+        """
+        streams = list(self.streams if streams is None else streams)
+        end = self.duration() if end is None else end
+        began = time.perf_counter()
+        window = start
+        while window <= end:
+            window_end = min(end, window + step)
+            batches = [self.between(stream, window, window_end) for stream in streams]
+            # rows at exactly window_end belong to the next window, except in the last one
+            if window_end < end:
+                batches = [batch[batch['clock'] < window_end] for batch in batches]
+            times = np.concatenate([batch['clock'] for batch in batches]) if batches else np.zeros(0)
+            sources = np.concatenate([np.full(len(batch), i) for i, batch in enumerate(batches)]) \
+                if batches else np.zeros(0, dtype=int)
+            offsets = np.concatenate([np.arange(len(batch)) for batch in batches]) \
+                if batches else np.zeros(0, dtype=int)
+            for i in np.argsort(times, kind='stable'):
+                t = float(times[i])
+                if speed:
+                    delay = (t - start) / speed - (time.perf_counter() - began)
+                    if delay > 0:
+                        time.sleep(delay)
+                yield t, streams[sources[i]], batches[sources[i]][offsets[i]]
+            if window_end >= end:
+                break
+            window = window_end
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.directory} run={self.meta['run_id']} " \
+               f"streams={list(self.streams)} duration={self.duration():.1f}s>"
+
+
+class Main(CommandLineParser):
+    """
+        Summarize a recording, or print its rows between --start and --end (recorder clock, seconds), e.g.
+        python3 flight_recorder.py recordings/flight_<run id> --streams commands acks --start 30 --end 45
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello flight recording")
+        self.add_argument('recording', type=str)
+        self.add_argument('--streams', nargs='*', default=None)
+        self.add_argument('--start', type=float, default=None)
+        self.add_argument('--end', type=float, default=None)
+        self.add_argument('--speed', type=float, default=None, help="replay at this multiple of the recorded pace")
+        self.parse_args()
+
+    def main(self):
+        recording = FlightRecording(self.args.recording)
+        print(recording)
+        for stream, (rows, first, last) in recording.summary().items():
+            print(f"{stream:>12}: {rows} rows, {first:.3f}s - {last:.3f}s")
+        if self.args.start is None and self.args.end is None and self.args.speed is None:
+            return
+        string_columns = ('name', 'text', 'response', 'path', 'reason')
+        for t, stream, row in recording.replay(self.args.start or 0., self.args.end, self.args.streams,
+                                               self.args.speed):
+            fields = ' '.join(f"{name}={recording.string(row[name]) if name in string_columns else row[name]}"
+                              for name in row.dtype.names[1:])
+            print(f"{t:10.3f} {stream} {fields}")
+
+
+if __name__ == "__main__":
+    Main().main()
@@ -0,0 +1,181 @@
+import json
+import os
+from typing import Dict, Optional, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin, CommandLineParser
+
+"""
+    On-disk layout of an archive directory:
+        meta.json           shape, dtype and frames per chunk
+        chunk_00000.raw     `chunk_frames` raw frames back to back, memory mapped
+        timestamps.f8       one float64 capture time per frame, appended after the frame data is in place
+    The frame count is derived from the timestamps file, so a reader never sees a half written frame.
+"""
+
+META_FILE = "meta.json"
+TIMESTAMPS_FILE = "timestamps.f8"
+
+
+class FrameArchive(logger_mixin()):
+    """
+        Fixed-shape frames in chunked memory-mapped files with a binary timestamp index: O(1) access by frame
+        number, binary search by time, and appending while capturing. Frames are returned as memmap views, nothing is
+        decoded or copied.
+    """
+
+    def __init__(self, directory: str, shape: Optional[Tuple[int, ...]] = None, dtype='u1',
+                 chunk_frames: int = 256, grayscale: bool = False):
+        self.directory = directory
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            self.shape = tuple(meta['shape'])
+            self.dtype = np.dtype(meta['dtype'])
+            self.chunk_frames = meta['chunk_frames']
+            self.grayscale = meta['grayscale']
+        else:
+            if shape is None:
+                raise ValueError(f"{directory} is not an archive and no frame shape was given to create one")
+            self.grayscale = grayscale
+            self.shape = tuple(shape[:2]) if grayscale else tuple(shape)
+            self.dtype = np.dtype(dtype)
+            self.chunk_frames = chunk_frames
+            os.makedirs(directory, exist_ok=True)
+            with open(meta_path, 'w') as meta_file:
+                json.dump({'shape': self.shape, 'dtype': self.dtype.str, 'chunk_frames': self.chunk_frames,
+                           'grayscale': self.grayscale}, meta_file)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.chunks: Dict[int, np.memmap] = {}
+        self.timestamps_path = os.path.join(directory, TIMESTAMPS_FILE)
+        self.timestamps_file = None
+        self._timestamps = None
+        self._length = None
+
+    @classmethod
+    def for_frame(cls, directory: str, frame: np.ndarray, **kwargs) -> "FrameArchive":
+        return cls(directory, frame.shape, frame.dtype, **kwargs)
+
+    def _chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.directory, f"chunk_{chunk:05d}.raw")
+
+    def _chunk(self, chunk: int, writable: bool = False) -> np.memmap:
+        mapped = self.chunks.get(chunk)
+        if mapped is not None and writable and mapped.mode == 'r':
+            mapped = None  # mapped read-only by a read before the first append to it, map it again for writing
+        if mapped is None:
+            path = self._chunk_path(chunk)
+            if writable and not os.path.exists(path):
+                mode = 'w+'
+            else:
+                mode = 'r+' if writable else 'r'
+            mapped = np.memmap(path, dtype=self.dtype, mode=mode, shape=(self.chunk_frames,) + self.shape)
+            self.chunks[chunk] = mapped
+        return mapped
+
+    def __len__(self) -> int:
+        if self._length is not None:
+            return self._length
+        return os.path.getsize(self.timestamps_path) // 8 if os.path.exists(self.timestamps_path) else 0
+
+    def append(self, frame: np.ndarray, timestamp: float) -> int:
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if frame.shape != self.shape:
+            raise ValueError(f"frame shape {frame.shape} doesn't match the archive's {self.shape}")
+        if self.timestamps_file is None:
+            self._length = len(self)
+            self.timestamps_file = open(self.timestamps_path, 'ab')
+        index = self._length
+        chunk, position = divmod(index, self.chunk_frames)
+        if position == 0 and chunk > 0:
+            # the previous chunk is complete, let the kernel write it back
+            self.chunks.pop(chunk - 1).flush()
+        self._chunk(chunk, writable=True)[position] = frame
+        self.timestamps_file.write(np.float64(timestamp).tobytes())
+        self._length += 1
+        self._timestamps = None
+        return index
+
+    def flush(self):
+        for mapped in self.chunks.values():
+            if mapped.mode != 'r':
+                mapped.flush()
+        if self.timestamps_file is not None:
+            self.timestamps_file.flush()
+
+    def close(self):
+        self.flush()
+        if self.timestamps_file is not None:
+            self.timestamps_file.close()
+            self.timestamps_file = None
+            self._length = None
+        self.chunks.clear()
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        if self._timestamps is None or len(self._timestamps) != len(self):
+            if self.timestamps_file is not None:
+                self.timestamps_file.flush()
+            self._timestamps = np.fromfile(self.timestamps_path, dtype='f8', count=len(self)) \
+                if len(self) else np.zeros(0, dtype='f8')
+        return self._timestamps
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f"frame {index} out of range ({length} frames)")
+        chunk, position = divmod(index, self.chunk_frames)
+        return self._chunk(chunk, writable=self.timestamps_file is not None)[position]
+
+    def timestamp(self, index: int) -> float:
+        return float(self.timestamps[index])
+
+    def find(self, timestamp: float) -> int:
+        """
+            The last frame captured at or before `timestamp`.
+        """
+        return max(0, int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1)
+
+    def between(self, start: float, end: float) -> range:
+        timestamps = self.timestamps
+        return range(int(np.searchsorted(timestamps, start, side='left')),
+                     int(np.searchsorted(timestamps, end, side='right')))
+
+    def export_image_list(self, output_dir: str, extension: str = ".png", step: int = 1) -> str:
+        """
+            Write the frames as numbered images plus an `images.txt` list, the layout the offline LSD-SLAM app
+            (main_on_images) reads. Returns the path of the list.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        list_path = os.path.join(output_dir, "images.txt")
+        with open(list_path, 'w') as list_file:
+            for index in range(0, len(self), step):
+                image_path = os.path.abspath(os.path.join(output_dir, f"{index:06d}{extension}"))
+                cv2.imwrite(image_path, self[index])
+                list_file.write(f"{image_path}\n")
+        self.logger.info(f"exported {len(range(0, len(self), step))} frames to {output_dir}")
+        return list_path
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.directory} frames={len(self)} shape={self.shape}>"
+
+
+class Main(CommandLineParser):
+    def __init__(self):
+        super().__init__(prog="Frame archive exporter")
+        self.add_argument('archive', type=str)
+        self.add_argument('output_dir', type=str)
+        self.add_argument('--extension', type=str, default=".png")
+        self.add_argument('--step', type=int, default=1, help="export every n-th frame")
+        self.parse_args()
+
+    def main(self):
+        FrameArchive(self.args.archive).export_image_list(self.args.output_dir, self.args.extension, self.args.step)
+
+
+if __name__ == "__main__":
+    Main().main()
@@ -0,0 +1,248 @@
+import os
+import errno
+import time
+from multiprocessing import shared_memory
+from threading import Thread
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin
+from frame_ring import FrameCursor, Frame
+
+"""
+    Channels handing decoded frames to another process (the LSD-SLAM app), so the stream is decoded once in
+    CameraStream and SLAM, display and recording all read the same frames. Frames are converted to 8 bit grayscale
+    of a fixed size (the Tello streams 960x720), which is what LSD-SLAM tracks on.
+
+    shm:  a POSIX shared-memory ring, readable as the file /dev/shm/<name>:
+          header  SHM_HEADER_DTYPE
+          slots   `slots` x SHM_SLOT_DTYPE
+          frames  `slots` x height x width bytes
+          A writer clears the slot's sequence, writes the frame and then sets the sequence and the header's head;
+          a reader copies frame head % slots and keeps it if the slot's sequence was head before and after the copy.
+    pipe: a named pipe carrying back to back raw height x width frames. The writer blocks while the pipe is full,
+          frames decoded meanwhile are skipped.
+"""
+
+SHM = 'shm'
+PIPE = 'pipe'
+SHM_MAGIC = 0x464c5354  # 'TSLF'
+SHM_HEADER_DTYPE = np.dtype([
+    ('magic', 'u4'),
+    ('version', 'u4'),
+    ('width', 'u4'),
+    ('height', 'u4'),
+    ('slots', 'u4'),
+    ('reserved', 'u4'),
+    ('head', 'u8'),  # sequence of the latest complete frame, 0 before the first one
+])
+SHM_SLOT_DTYPE = np.dtype([
+    ('sequence', 'u8'),  # 0 while being written
+    ('timestamp', 'f8'),  # capture time, seconds since the epoch
+])
+
+
+class FrameChannel(logger_mixin()):
+    """
+        Base channel: a thread following a FrameRing cursor and publishing every frame it gets.
+    """
+
+    def __init__(self, size: Tuple[int, int] = (960, 720)):
+        self.size = tuple(size)  # width, height
+        self.gray = np.zeros((self.size[1], self.size[0]), dtype=np.uint8)
+        self.frames_sent = 0
+        self.running = False
+        self.thread = None
+
+    @property
+    def source(self) -> str:
+        """
+            What the reading process opens.
+        """
+        raise NotImplementedError
+
+    def convert(self, image: np.ndarray, out: np.ndarray):
+        """
+            Grayscale `image` into `out`, converting in place when the size already matches.
+        """
+        if image.ndim == 3:
+            if image.shape[1::-1] == self.size:
+                cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=out)
+                return
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if image.shape[::-1] != self.size:
+            cv2.resize(image, self.size, dst=out, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(out, image)
+
+    def publish(self, frame: Frame):
+        raise NotImplementedError
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def start(self, cursor: FrameCursor) -> "FrameChannel":
+        if self.running:
+            return self
+        self.open()
+        self.running = True
+        self.thread = Thread(target=self.feed, args=(cursor,), name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def feed(self, cursor: FrameCursor):
+        try:
+            while self.running:
+                frame = cursor.wait(0.5)
+                if frame is None:
+                    if cursor.ring.closed:
+                        break
+                    continue
+                self.publish(frame)
+                self.frames_sent += 1
+        except BrokenPipeError:
+            self.logger.warning(f"reader of {self.source} went away")
+        finally:
+            self.running = False
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2.)
+            self.thread = None
+        self.close()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.source} size={self.size} sent={self.frames_sent}>"
+
+
+class SharedMemoryFrameRing(FrameChannel):
+    """
+        Writer side of the shm channel, `attach` opens an existing ring for reading (e.g. from another Python process).
+    """
+
+    def __init__(self, name: Optional[str] = None, size: Tuple[int, int] = (960, 720), slots: int = 4,
+                 create: bool = True):
+        super().__init__(size)
+        width, height = self.size
+        frames_offset = SHM_HEADER_DTYPE.itemsize + slots * SHM_SLOT_DTYPE.itemsize
+        if create:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=frames_offset + slots * width * height)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+        self.owner = create
+        self.header = np.ndarray((), SHM_HEADER_DTYPE, self.memory.buf, 0)
+        if create:
+            self.header[()] = (SHM_MAGIC, 1, width, height, slots, 0, 0)
+        elif self.header['magic'] != SHM_MAGIC:
+            raise ValueError(f"{name} is not a frame ring")
+        self.slots = int(self.header['slots'])
+        self.slot_headers = np.ndarray((self.slots,), SHM_SLOT_DTYPE, self.memory.buf, SHM_HEADER_DTYPE.itemsize)
+        self.frames = np.ndarray((self.slots, height, width), np.uint8, self.memory.buf, frames_offset)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedMemoryFrameRing":
+        memory = shared_memory.SharedMemory(name)
+        header = np.ndarray((), SHM_HEADER_DTYPE, memory.buf, 0).copy()
+        memory.close()
+        return cls(name, (int(header['width']), int(header['height'])), int(header['slots']), create=False)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @property
+    def source(self) -> str:
+        return os.path.join('/dev/shm', self.memory.name.lstrip('/'))
+
+    def publish(self, frame: Frame):
+        sequence = int(self.header['head']) + 1
+        index = sequence % self.slots
+        slot = self.slot_headers[index]
+        slot['sequence'] = 0
+        self.convert(frame.image, self.frames[index])
+        slot['timestamp'] = frame.timestamp
+        slot['sequence'] = sequence
+        self.header['head'] = sequence
+
+    def read(self, out: Optional[np.ndarray] = None) -> Tuple[int, float, Optional[np.ndarray]]:
+        """
+            Copy the latest complete frame, returns (sequence, timestamp, image); sequence is 0 if there is none yet.
+        """
+        out = np.empty(self.frames.shape[1:], np.uint8) if out is None else out
+        for _ in range(self.slots):
+            sequence = int(self.header['head'])
+            if sequence == 0:
+                return 0, 0., None
+            slot = self.slot_headers[sequence % self.slots]
+            if slot['sequence'] != sequence:
+                continue
+            timestamp = float(slot['timestamp'])
+            np.copyto(out, self.frames[sequence % self.slots])
+            if slot['sequence'] == sequence:
+                return sequence, timestamp, out
+        return 0, 0., None
+
+    def close(self):
+        # drop the numpy views before closing the mapping they point into
+        self.header = self.slot_headers = self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            self.owner = False
+
+
+class FramePipe(FrameChannel):
+    """
+        Writer side of the pipe channel. The fifo is created on start and removed on stop; frames are only written
+        once a reader opened it.
+    """
+
+    def __init__(self, path: str, size: Tuple[int, int] = (960, 720)):
+        super().__init__(size)
+        self.path = path
+        self.fd = None
+
+    @property
+    def source(self) -> str:
+        return self.path
+
+    def open(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path)
+
+    def _connect(self) -> bool:
+        """
+            Open the fifo without blocking on a missing reader, so stop() isn't stuck behind it.
+        """
+        try:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            return False
+        os.set_blocking(self.fd, True)
+        self.logger.debug(f"reader connected to {self.path}")
+        return True
+
+    def publish(self, frame: Frame):
+        while self.fd is None and self.running:
+            if not self._connect():
+                time.sleep(0.1)
+        if self.fd is None:
+            return
+        self.convert(frame.image, self.gray)
+        data = memoryview(self.gray).cast('B')
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,359 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Event, Thread
+from typing import Dict, List, Optional, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin
+from frame_ring import FrameRing, FrameCursor, LATEST
+from instrumentation import TRACER
+
+"""
+    Derived frame streams: named conversions of CameraStream's decoded frames, computed once per frame on a pool of
+    worker threads and published to their own FrameRing, so every consumer of a stream shares the same result and the
+    grab thread never converts anything. Streams are declared with `frame_streams`, a dict of name -> stages, whose
+    first item may name another stream to derive from instead of the decoded frames:
+        -D frame_streams="{'gray': ['grayscale'], 'slam': ['gray', 'undistort', ('resize', (640, 480))]}"
+    Stages: 'grayscale', ('resize', (width, height)), ('crop', (x, y, width, height)) and 'undistort' or
+    ('undistort', path) with the calibration (default lsd_slam/calibration.xml, or the .npz maps of calibration.py).
+    A stream is only computed while a consumer reads it (its cursors raise FrameRing.requested, as with the on_demand
+    decode policy) or one of the streams derived from it. A stream and everything derived from it run as one task,
+    so each ring keeps a single producer; independent streams run in parallel. A stream whose previous frame is still
+    being computed skips the new one, consumers always get the latest frame a stream could keep up with.
+"""
+
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lsd_slam',
+                                'calibration.xml')
+
+
+class Stage:
+    """
+        One conversion. `output` gives the (shape, dtype) it makes of an input, `__call__` writes into `out`.
+    """
+
+    def output(self, shape: Tuple[int, ...], dtype: np.dtype) -> Tuple[Tuple[int, ...], np.dtype]:
+        return shape, dtype
+
+    def __call__(self, image: np.ndarray, out: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return self.__class__.__name__.lower()
+
+
+class Grayscale(Stage):
+    def output(self, shape, dtype):
+        return shape[:2], dtype
+
+    def __call__(self, image, out):
+        if image.ndim == 2:
+            np.copyto(out, image)
+            return out
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=out)
+
+
+class Resize(Stage):
+    def __init__(self, size: Tuple[int, int]):
+        self.size = tuple(int(x) for x in size)  # width, height
+
+    def output(self, shape, dtype):
+        return (self.size[1], self.size[0]) + tuple(shape[2:]), dtype
+
+    def __call__(self, image, out):
+        shrinking = self.size[0] < image.shape[1]
+        return cv2.resize(image, self.size, dst=out, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+    def __repr__(self):
+        return f"resize{self.size}"
+
+
+class Crop(Stage):
+    def __init__(self, rect: Tuple[int, int, int, int]):
+        self.x, self.y, self.width, self.height = (int(v) for v in rect)
+
+    def output(self, shape, dtype):
+        if self.x < 0 or self.y < 0 or self.x + self.width > shape[1] or self.y + self.height > shape[0]:
+            raise ValueError(f"crop {(self.x, self.y, self.width, self.height)} is outside a "
+                             f"{shape[1]}x{shape[0]} frame")
+        return (self.height, self.width) + tuple(shape[2:]), dtype
+
+    def __call__(self, image, out):
+        np.copyto(out, image[self.y:self.y + self.height, self.x:self.x + self.width])
+        return out
+
+    def __repr__(self):
+        return f"crop{(self.x, self.y, self.width, self.height)}"
+
+
+class Undistort(Stage):
+    """
+        Rectifies with the camera calibration. The maps are made once per input size, scaling the camera matrix when
+        the frames are not at the calibration resolution; with no distortion at all the stage is a copy.
+    """
+
+    def __init__(self, path: str = CALIBRATION_FILE):
+        self.path = path
+        self.maps = None
+        self.maps_size = None
+        self.identity = False
+        if path.endswith('.npz'):
+            from calibration import Undistorter
+            undistorter = Undistorter(path)
+            self.maps, self.maps_size = (undistorter.map1, undistorter.map2), undistorter.image_size
+            self.camera_matrix, self.distortion, self.image_size = None, None, undistorter.image_size
+        else:
+            storage = cv2.FileStorage(path, cv2.FILE_STORAGE_READ)
+            if not storage.isOpened():
+                raise ValueError(f"can't read the calibration {path}")
+            self.camera_matrix = storage.getNode('Camera_Matrix').mat()
+            self.distortion = storage.getNode('Distortion_Coefficients').mat()
+            self.image_size = (int(storage.getNode('image_Width').real()), int(storage.getNode('image_Height').real()))
+            storage.release()
+            self.identity = not np.any(self.distortion)
+
+    def _prepare(self, size: Tuple[int, int]):
+        if self.camera_matrix is None:
+            raise ValueError(f"the maps in {self.path} are for {self.image_size[0]}x{self.image_size[1]} frames, "
+                             f"got {size[0]}x{size[1]}")
+        matrix = self.camera_matrix.copy()
+        matrix[0] *= size[0] / self.image_size[0]
+        matrix[1] *= size[1] / self.image_size[1]
+        self.maps = cv2.initUndistortRectifyMap(matrix, self.distortion, None, matrix, size, cv2.CV_16SC2)
+        self.maps_size = size
+
+    def __call__(self, image, out):
+        if self.identity:
+            np.copyto(out, image)
+            return out
+        size = (image.shape[1], image.shape[0])
+        if self.maps_size != size:
+            self._prepare(size)
+        return cv2.remap(image, self.maps[0], self.maps[1], cv2.INTER_LINEAR, dst=out)
+
+    def __repr__(self):
+        return f"undistort({os.path.basename(self.path)})"
+
+
+STAGES = {'grayscale': Grayscale, 'resize': Resize, 'crop': Crop, 'undistort': Undistort}
+
+
+def make_stage(spec) -> Stage:
+    """
+        'name' or (name, argument).
+    """
+    name, *args = (spec,) if isinstance(spec, str) else spec
+    if name not in STAGES:
+        raise ValueError(f"Unknown pipeline stage: {name}")
+    return STAGES[name](*args)
+
+
+class DerivedStream(logger_mixin()):
+    """
+        A named chain of stages and the ring its results are published to, with the source frame's timestamp.
+        Intermediate results go to buffers kept between frames and the last stage writes straight into the ring.
+    """
+
+    def __init__(self, name: str, source: Optional[str], stages: List[Stage], ring_size: int = 4):
+        if not stages:
+            raise ValueError(f"stream {name} has no stages")
+        self.name = name
+        self.source = source  # None for the decoded frames
+        self.stages = stages
+        self.ring = FrameRing(ring_size)
+        self.children: List["DerivedStream"] = []
+        self.buffers: List[np.ndarray] = []
+        self.input_layout = None
+        self.computed = 0
+        self.skipped = 0  # frames dropped while busy or lost to the source ring before they were done
+        self.compute_time = 0.
+
+    def collect_wanted(self, wanted: set) -> bool:
+        """
+            Add the names of this stream and those derived from it that a consumer asked a frame of (or that a wanted
+            stream derives from) to `wanted`, clearing the requests. Returns whether this one is wanted.
+        """
+        requested = self.ring.requested
+        self.ring.requested = False
+        for child in self.children:
+            requested = child.collect_wanted(wanted) or requested
+        if requested:
+            wanted.add(self.name)
+        return requested
+
+    def request(self, wanted: set):
+        """
+            Ask again for the wanted streams of this tree, e.g. when their frame was skipped.
+        """
+        if self.name in wanted:
+            self.ring.request()
+        for child in self.children:
+            child.request(wanted)
+
+    def _plan(self, image: np.ndarray):
+        shape, dtype = image.shape, image.dtype
+        self.buffers = []
+        for stage in self.stages[:-1]:
+            shape, dtype = stage.output(shape, dtype)
+            self.buffers.append(np.empty(shape, dtype))
+        self.ring.allocate(*self.stages[-1].output(shape, dtype))
+        self.input_layout = (image.shape, image.dtype)
+
+    def compute(self, image: np.ndarray, timestamp: float, wanted: set, valid=lambda: True) -> bool:
+        """
+            Run the stages on `image` and publish the result unless `valid()` says the source was overwritten
+            meanwhile, then do the same for the wanted derived streams.
+        """
+        start = time.perf_counter()
+        if self.input_layout != (image.shape, image.dtype):
+            self._plan(image)
+        slot = self.ring.writable_slot()
+        result = image
+        for stage, buffer in zip(self.stages, self.buffers + [slot]):
+            result = stage(result, buffer)
+        if result is not slot:
+            np.copyto(slot, result)  # OpenCV allocated a new output instead of using the slot
+        if not valid():
+            self.skipped += 1
+            self.request(wanted)
+            return False
+        self.ring.publish(timestamp)
+        self.computed += 1
+        self.compute_time += time.perf_counter() - start
+        if TRACER.enabled:
+            TRACER.record(f'pipeline.{self.name}', start)
+        for child in self.children:
+            if child.name in wanted:
+                child.compute(slot, timestamp, wanted)
+        return True
+
+    def stats(self) -> dict:
+        return {'computed': self.computed, 'skipped': self.skipped,
+                'compute_ms_mean': self.compute_time / self.computed * 1000. if self.computed else 0.}
+
+    def __repr__(self):
+        source = f"{self.source} -> " if self.source else ""
+        return f"<{self.__class__.__name__}: {self.name} = {source}{' -> '.join(map(repr, self.stages))}>"
+
+
+class FramePipeline(logger_mixin()):
+    """
+        Follows a FrameRing and hands every new frame to the streams that are wanted, one task per independent
+        stream on a thread pool (OpenCV releases the GIL, so the workers run in parallel).
+        Options: frame_streams (see above), pipeline_workers (default: one per independent stream, at most 4),
+        pipeline_ring_size (slots per derived ring, default 4).
+    """
+
+    def __init__(self, source: FrameRing, **kwargs):
+        self.source = source
+        self.streams: Dict[str, DerivedStream] = {}
+        ring_size = int(kwargs.get('pipeline_ring_size', 4))
+        for name, spec in dict(kwargs.get('frame_streams', {})).items():
+            if name in STAGES:
+                raise ValueError(f"stream {name} is named like a stage")
+            spec = list(spec)
+            parent = spec.pop(0) if spec and isinstance(spec[0], str) and spec[0] not in STAGES else None
+            self.streams[name] = DerivedStream(name, parent, [make_stage(stage) for stage in spec], ring_size)
+        for stream in self.streams.values():
+            if stream.source is not None:
+                if stream.source not in self.streams:
+                    raise ValueError(f"stream {stream.name} derives from unknown stream {stream.source}")
+                self.streams[stream.source].children.append(stream)
+        self.roots = [stream for stream in self.streams.values() if stream.source is None]
+        self._check_cycles()
+        self.workers = int(kwargs.get('pipeline_workers', min(4, max(1, len(self.roots)))))
+        self.pending: Dict[str, Future] = {}  # the task of each independent stream
+        self.dispatched: Dict[str, int] = {}  # the source sequence each independent stream was last given
+        self.behind = set()  # streams that were busy when a frame came, see DerivedStream.skipped
+        self.executor = None
+        self.stopped = Event()
+        self.thread = None
+        self.running = False
+
+    def _check_cycles(self):
+        reachable = set()
+        pending = list(self.roots)
+        while pending:
+            stream = pending.pop()
+            reachable.add(stream.name)
+            pending.extend(stream.children)
+        unreachable = set(self.streams) - reachable
+        if unreachable:
+            raise ValueError(f"streams derived from each other in a cycle: {sorted(unreachable)}")
+
+    def __bool__(self) -> bool:
+        return bool(self.streams)
+
+    def cursor(self, name: str, mode: str = LATEST, max_rate: Optional[float] = None) -> FrameCursor:
+        if name not in self.streams:
+            raise ValueError(f"Unknown frame stream: {name}")
+        return self.streams[name].ring.cursor(mode, max_rate)
+
+    def start(self) -> "FramePipeline":
+        if self.running or not self.streams:
+            return self
+        self.running = True
+        self.stopped.clear()
+        for stream in self.streams.values():
+            stream.ring.closed = False
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="frame-pipeline")
+        self.thread = Thread(target=self.run, name="frame-pipeline-dispatch", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while self.running:
+            frame = self.source.latest()
+            wanted = set()
+            roots = [stream for stream in self.roots if stream.collect_wanted(wanted)]
+            if not roots:
+                self.stopped.wait(0.005)
+                continue
+            waiting = False
+            for stream in roots:
+                dispatched = self.dispatched.get(stream.name, 0)
+                future = self.pending.get(stream.name)
+                if frame is None or frame.sequence <= dispatched or (future is not None and not future.done()):
+                    # nothing new for it yet, or still busy with the previous frame: keep the request for later
+                    if future is not None and not future.done():
+                        self.behind.add(stream.name)
+                    stream.request(wanted)
+                    waiting = True
+                    continue
+                if stream.name in self.behind:
+                    stream.skipped += frame.sequence - dispatched - 1
+                    self.behind.discard(stream.name)
+                self.dispatched[stream.name] = frame.sequence
+                self.pending[stream.name] = self.executor.submit(self._compute, stream, frame, wanted)
+            if waiting:
+                # ask the decoder for a frame and wake up as soon as one is published
+                self.source.request()
+                self.source.wait_for(self.source.head + 1, 0.005)
+                if self.source.closed:
+                    break
+
+    def _compute(self, stream: DerivedStream, frame, wanted: set):
+        try:
+            stream.compute(frame.image, frame.timestamp, wanted, lambda: self.source.is_valid(frame.sequence))
+        except Exception as e:
+            self.logger.error(f"{stream.name}: {e}")
+
+    def stop(self):
+        """
+            Finish the frames being computed and wake every consumer of the derived streams.
+        """
+        if self.running:
+            self.running = False
+            self.stopped.set()
+            self.thread.join()
+            self.executor.shutdown(wait=True)
+        for stream in self.streams.values():
+            stream.ring.close()
+        if self.streams:
+            self.logger.info(f"frame pipeline stats: {self.stats()}")
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: stream.stats() for name, stream in self.streams.items()}
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {list(self.streams.values())} workers={self.workers}>"
@@ -0,0 +1,196 @@
+import time
+from threading import Condition
+from typing import NamedTuple, Optional, Tuple
+import numpy as np
+
+LATEST = 'latest'
+NEXT = 'next'
+
+
+class Frame(NamedTuple):
+    sequence: int  # monotonically increasing, starts at 1
+    timestamp: float  # capture time, seconds since the epoch
+    image: np.ndarray  # read-only view into the ring slot
+
+
+class FrameRing:
+    """
+        Fixed-size ring of preallocated frame slots. A single producer decodes into `writable_slot()` and then
+        `publish()`es it; any number of consumers read read-only views of the published slots.
+        The slot being written is never handed out, so `size - 1` frames are readable at any time. A view stays valid
+        until the producer wraps around to its slot, which `is_valid(sequence)` reports.
+        Consumers that find nothing new raise `requested`, which a producer decoding on demand uses to decide
+        whether the next frame is worth decoding.
+    """
+
+    def __init__(self, size: int = 8):
+        if size < 2:
+            raise ValueError(f"frame ring needs at least 2 slots, got {size}")
+        self.size = size
+        self.slots = None
+        self.views = None
+        self.sequences = [0] * size
+        self.timestamps = [0.0] * size
+        self.head = 0  # sequence number of the latest published frame, 0 before the first one
+        self.closed = False
+        self.requested = False
+        self.condition = Condition()
+
+    @property
+    def shape(self) -> Optional[Tuple[int, ...]]:
+        return None if self.slots is None else self.slots.shape[1:]
+
+    def allocate(self, shape: Tuple[int, ...], dtype=np.uint8):
+        with self.condition:
+            self.slots = np.zeros((self.size,) + tuple(shape), dtype=dtype)
+            self.views = []
+            for slot in self.slots:
+                view = slot.view()
+                view.flags.writeable = False
+                self.views.append(view)
+            # frames published before a reallocation are gone
+            self.sequences = [0] * self.size
+
+    def writable_slot(self) -> Optional[np.ndarray]:
+        """
+            The slot the next published frame will occupy, None until the ring is allocated.
+        """
+        if self.slots is None:
+            return None
+        return self.slots[(self.head + 1) % self.size]
+
+    def publish(self, timestamp: Optional[float] = None) -> int:
+        with self.condition:
+            sequence = self.head + 1
+            index = sequence % self.size
+            self.sequences[index] = sequence
+            self.timestamps[index] = time.time() if timestamp is None else timestamp
+            self.head = sequence
+            self.condition.notify_all()
+            return sequence
+
+    def write(self, image: np.ndarray, timestamp: Optional[float] = None) -> int:
+        """
+            Copy a frame that was not decoded in place into the next slot, (re)allocating on a shape change.
+        """
+        if self.slots is None or self.slots.shape[1:] != image.shape or self.slots.dtype != image.dtype:
+            self.allocate(image.shape, image.dtype)
+        np.copyto(self.writable_slot(), image)
+        return self.publish(timestamp)
+
+    def oldest(self) -> int:
+        return max(1, self.head - self.size + 2)
+
+    def is_valid(self, sequence: int) -> bool:
+        index = sequence % self.size
+        return self.oldest() <= sequence <= self.head and self.sequences[index] == sequence
+
+    def get(self, sequence: int) -> Optional[Frame]:
+        with self.condition:
+            if not self.is_valid(sequence):
+                return None
+            index = sequence % self.size
+            return Frame(sequence, self.timestamps[index], self.views[index])
+
+    def latest(self) -> Optional[Frame]:
+        return self.get(self.head)
+
+    def wait_for(self, sequence: int, timeout: Optional[float] = None) -> bool:
+        """
+            Block until frame `sequence` has been published.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.head >= sequence or self.closed, timeout) and not self.closed
+
+    def request(self):
+        self.requested = True
+
+    def close(self):
+        """
+            Wake every waiting consumer, used when the producer stops.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def cursor(self, mode: str = LATEST, max_rate: Optional[float] = None) -> "FrameCursor":
+        return FrameCursor(self, mode, max_rate)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: size={self.size} shape={self.shape} head={self.head}>"
+
+
+class FrameCursor:
+    """
+        A consumer's independent position in a FrameRing.
+        LATEST: every read returns the newest frame not seen yet, skipping anything in between.
+        NEXT: reads return frames in order, skipping only those already overwritten (counted in `dropped`).
+        With `max_rate` the cursor hands out at most that many frames per second and doesn't ask for frames in between.
+    """
+
+    def __init__(self, ring: FrameRing, mode: str = LATEST, max_rate: Optional[float] = None):
+        if mode not in (LATEST, NEXT):
+            raise ValueError(f"Unknown cursor mode: {mode}")
+        self.ring = ring
+        self.mode = mode
+        self.last_sequence = ring.head if mode == NEXT else 0
+        self.dropped = 0
+        self.min_interval = 1. / max_rate if max_rate else 0.
+        self.last_delivery = 0.
+
+    def throttled(self) -> float:
+        """
+            Seconds until `max_rate` allows the next frame, 0 if it does now.
+        """
+        if not self.min_interval:
+            return 0.
+        return max(0., self.last_delivery + self.min_interval - time.time())
+
+    def _next_sequence(self) -> int:
+        if self.mode == LATEST:
+            return self.ring.head
+        sequence = self.last_sequence + 1
+        oldest = self.ring.oldest()
+        if sequence < oldest:
+            self.dropped += oldest - sequence
+            sequence = oldest
+        return sequence
+
+    def has_new(self) -> bool:
+        return self.ring.head > self.last_sequence
+
+    def poll(self) -> Optional[Frame]:
+        """
+            The next frame for this cursor, or None if there is no new one (or `max_rate` doesn't allow one yet).
+        """
+        if self.throttled():
+            return None
+        while self.has_new():
+            sequence = self._next_sequence()
+            frame = self.ring.get(sequence)
+            if frame is not None:
+                self.last_sequence = frame.sequence
+                if self.min_interval:
+                    self.last_delivery = time.time()
+                return frame
+            self.last_sequence = sequence  # lost to a reallocation of the ring
+        self.ring.request()
+        return None
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """
+            Block until a new frame is published (or `timeout` passes) and return it.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            frame = self.poll()
+            if frame is not None:
+                return frame
+            remaining = None if deadline is None else deadline - time.time()
+            if self.ring.closed or (remaining is not None and remaining <= 0):
+                return None
+            throttled = self.throttled()
+            if throttled:
+                time.sleep(throttled if remaining is None else min(throttled, remaining))
+                continue
+            self.ring.wait_for(self.last_sequence + 1, remaining)
@@ -0,0 +1,222 @@
+import os
+import queue
+import time
+from threading import Thread, Lock
+from typing import Dict, List, Optional, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin, RUN_ID
+from frame_archive import FrameArchive
+from instrumentation import TRACER
+from flight_recorder import RECORDER
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+CODECS = {
+    'jpeg': ('.jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+RAW = 'raw'  # append unencoded frames to a FrameArchive in `{directory}/archive_{RUN_ID}`
+
+
+class FrameWriterPool(logger_mixin()):
+    """
+        Encodes and writes captured frames on a pool of worker threads fed by a bounded queue, so the grab loop only
+        pays for one copy into a pooled buffer. OpenCV releases the GIL while encoding, so threads scale here.
+        When the queue is full the drop policy decides: drop the oldest queued frame, drop the new one, or block.
+        Written frames are listed in `frame_list_{RUN_ID}.txt` ("timestamp path [reason]"), flushed in batches.
+        The `raw` codec skips encoding and appends to a FrameArchive instead, from a single worker to keep order.
+    """
+
+    def __init__(self, directory: str, **kwargs):
+        self.directory = directory
+        self.workers = int(kwargs.get('writer_workers', 2))
+        self.queue_size = int(kwargs.get('writer_queue_size', 16))
+        self.drop_policy = kwargs.get('writer_drop_policy', DROP_OLDEST)
+        if self.drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {self.drop_policy}")
+        self.codec = kwargs.get('frame_codec', 'jpeg')
+        if self.codec != RAW and self.codec not in CODECS:
+            raise ValueError(f"Unknown codec: {self.codec}")
+        if self.codec == RAW:
+            self.workers = 1
+            self.archive_dir = os.path.join(directory, f"archive_{RUN_ID}")
+            self.archive_options = {'chunk_frames': int(kwargs.get('archive_chunk_frames', 256)),
+                                    'grayscale': kwargs.get('archive_grayscale', False)}
+            self.archive = None
+        else:
+            extension, quality_flag = CODECS[self.codec]
+            self.extension = extension
+            self.encode_params = [quality_flag, int(kwargs.get('frame_quality', 3 if self.codec == 'png' else 90))]
+        self.index_batch = int(kwargs.get('index_batch', 32))  # flush the index every `index_batch` frames...
+        self.index_flush_interval = float(kwargs.get('index_flush_interval', 1.0))  # ...or every that many seconds
+        self.index_path = os.path.join(directory, f"frame_list_{RUN_ID}.txt")
+        self.queue = queue.Queue(self.queue_size)
+        self.free_buffers: List[np.ndarray] = []
+        self.buffer_lock = Lock()
+        self.index_lock = Lock()
+        self.index_entries: List[Tuple[float, str, Optional[str]]] = []
+        self.last_index_flush = time.time()
+        self.index_file = None
+        self.counters = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+        self.counter_lock = Lock()
+        self.threads = []
+        self.running = False
+
+    def start(self) -> "FrameWriterPool":
+        if self.running:
+            return self
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_file = open(self.index_path, 'a')
+        self.running = True
+        self.threads = [Thread(target=self._work, name=f"frame-writer-{i}", daemon=True) for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _acquire_buffer(self, frame: np.ndarray) -> np.ndarray:
+        with self.buffer_lock:
+            while self.free_buffers:
+                buffer = self.free_buffers.pop()
+                if buffer.shape == frame.shape and buffer.dtype == frame.dtype:
+                    return buffer
+        return np.empty_like(frame)
+
+    def _release_buffer(self, buffer: np.ndarray):
+        with self.buffer_lock:
+            if len(self.free_buffers) < self.queue_size + self.workers:
+                self.free_buffers.append(buffer)
+
+    def submit(self, frame: np.ndarray, timestamp: Optional[float] = None, reason: Optional[str] = None) -> bool:
+        """
+            Queue a frame for writing. Returns False if it was dropped. Only the `block` policy can block the caller.
+            `reason` (why the frame was selected) is added to its index line.
+        """
+        if not self.running:
+            raise RuntimeError("frame writer pool is not running")
+        timestamp = time.time() if timestamp is None else timestamp
+        buffer = self._acquire_buffer(frame)
+        np.copyto(buffer, frame)
+        item = (timestamp, buffer, reason, time.perf_counter() if TRACER.enabled else 0)
+        if self.drop_policy == BLOCK:
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._count('dropped')
+                if self.drop_policy == DROP_NEWEST:
+                    self._release_buffer(buffer)
+                    return False
+                try:
+                    _, dropped, _, _ = self.queue.get_nowait()
+                    self._release_buffer(dropped)
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    self._release_buffer(buffer)
+                    return False
+        self._count('queued')
+        return True
+
+    def _count(self, counter: str):
+        with self.counter_lock:
+            self.counters[counter] += 1
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, buffer, reason, queued_at = item
+            if TRACER.enabled:
+                TRACER.record('writer.queue', queued_at)
+            if self.codec == RAW:
+                self._archive(timestamp, buffer, reason)
+                continue
+            path = os.path.abspath(os.path.join(self.directory, f"{int(timestamp * 1000)}{self.extension}"))
+            try:
+                start = time.perf_counter() if TRACER.enabled else 0
+                ok, encoded = cv2.imencode(self.extension, buffer, self.encode_params)
+                if not ok:
+                    raise ValueError(f"failed to encode {path}")
+                if TRACER.enabled:
+                    start = TRACER.record('writer.encode', start)
+                with open(path, 'wb') as image_file:
+                    image_file.write(encoded.tobytes())
+                if TRACER.enabled:
+                    TRACER.record('writer.write', start)
+            except Exception as e:
+                self._count('failed')
+                self.logger.error(e)
+                continue
+            finally:
+                self._release_buffer(buffer)
+            self._count('written')
+            self._add_index_entry(timestamp, path, reason)
+            if RECORDER.enabled:
+                RECORDER.record('captures', timestamp, RECORDER.string_id(path), -1, RECORDER.string_id(reason))
+
+    def _archive(self, timestamp: float, buffer: np.ndarray, reason: Optional[str] = None):
+        try:
+            if self.archive is None:
+                self.archive = FrameArchive.for_frame(self.archive_dir, buffer, **self.archive_options)
+            index = self.archive.append(buffer, timestamp)
+        except Exception as e:
+            self._count('failed')
+            self.logger.error(e)
+            return
+        finally:
+            self._release_buffer(buffer)
+        self._count('written')
+        if RECORDER.enabled:
+            RECORDER.record('captures', timestamp, RECORDER.string_id(self.archive_dir), index,
+                            RECORDER.string_id(reason))
+
+    def _add_index_entry(self, timestamp: float, entry: str, reason: Optional[str] = None):
+        with self.index_lock:
+            self.index_entries.append((timestamp, entry, reason))
+            if len(self.index_entries) >= self.index_batch or \
+                    time.time() - self.last_index_flush > self.index_flush_interval:
+                self._flush_index()
+
+    def _flush_index(self):
+        if not self.index_entries or self.index_file is None:
+            return
+        self.index_entries.sort(key=lambda index_entry: index_entry[0])
+        self.index_file.writelines(f"{timestamp} {entry}{'' if reason is None else ' ' + reason}\n"
+                                   for timestamp, entry, reason in self.index_entries)
+        self.index_file.flush()
+        self.index_entries.clear()
+        self.last_index_flush = time.time()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters, pending=self.queue.qsize())
+
+    def stop(self):
+        """
+            Write whatever is still queued, then stop the workers and flush the index.
+        """
+        if not self.running:
+            return
+        self.running = False
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        with self.index_lock:
+            self._flush_index()
+            self.index_file.close()
+            self.index_file = None
+        if self.codec == RAW and self.archive is not None:
+            self.archive.close()
+        self.logger.info(f"frame writer stats: {self.stats()}")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: dir={self.directory} codec={self.codec} {self.stats()}>"
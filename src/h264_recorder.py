@@ -0,0 +1,181 @@
+import os
+import socket
+import time
+from threading import Thread
+from typing import Iterator, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin, RUN_ID
+
+"""
+    The drone sends its video as an H.264 elementary stream split over UDP datagrams. Every I-frame is preceded by
+    an SPS NAL unit (type 7), so a decoder can start cleanly at any SPS - those are the keyframe offsets indexed here.
+"""
+
+START_CODE = b'\x00\x00\x00\x01'
+NAL_SPS = 7
+
+PACKET_INDEX_DTYPE = np.dtype([
+    ('timestamp', 'f8'),  # arrival time, seconds since the epoch
+    ('offset', 'u8'),  # position of the packet in the .h264 file
+    ('size', 'u4'),
+    ('keyframe', 'i4'),  # position of an SPS inside the packet, -1 if there is none
+])
+
+
+def find_keyframe(payload: bytes) -> int:
+    position = payload.find(START_CODE)
+    while position != -1:
+        if position + 4 < len(payload) and payload[position + 4] & 0x1f == NAL_SPS:
+            return position
+        position = payload.find(START_CODE, position + 4)
+    return -1
+
+
+class H264Recorder(logger_mixin()):
+    """
+        Writes the raw video payload to `{record_dir}/stream_{RUN_ID}.h264` without decoding it, plus a sidecar
+        `.idx` of packet arrival times and keyframe offsets (PACKET_INDEX_DTYPE records).
+        The recorder owns the video port; if live decoding is wanted it forwards every packet to `forward_address`,
+        where a CameraStream can read it from `forward_url`.
+    """
+
+    def __init__(self, address: Tuple[str, int] = ('', 11111), **kwargs):
+        self.address = address
+        self.directory = kwargs.get('record_dir', 'recordings')
+        self.path = os.path.join(self.directory, f"stream_{RUN_ID}.h264")
+        self.index_path = self.path + ".idx"
+        self.decode = kwargs.get('record_decode', True)  # forward packets for live decoding
+        self.forward_address = ('127.0.0.1', int(kwargs.get('record_forward_port', address[1] + 1)))
+        self.index_batch = int(kwargs.get('index_batch', 256))
+        self.socket = None
+        self.forward_socket = None
+        self.packets = 0
+        self.bytes = 0
+        self.keyframes = 0
+        self.running = False
+        self.thread = Thread(target=self.record, args=(), daemon=True)
+
+    @property
+    def forward_url(self) -> str:
+        return f"udp://@{self.forward_address[0]}:{self.forward_address[1]}"
+
+    def start(self) -> "H264Recorder":
+        if self.running:
+            return self
+        os.makedirs(self.directory, exist_ok=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.socket.bind(self.address)
+        self.socket.settimeout(0.5)
+        if self.decode:
+            self.forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = True
+        self.thread.start()
+        return self
+
+    def record(self):
+        index = np.zeros(self.index_batch, dtype=PACKET_INDEX_DTYPE)
+        pending = 0
+        with open(self.path, 'wb') as stream_file, open(self.index_path, 'wb') as index_file:
+            while self.running:
+                try:
+                    payload = self.socket.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    if self.running:
+                        self.logger.error(e)
+                    break
+                if self.forward_socket is not None:
+                    self.forward_socket.sendto(payload, self.forward_address)
+                keyframe = find_keyframe(payload)
+                index[pending] = (time.time(), self.bytes, len(payload), keyframe)
+                pending += 1
+                stream_file.write(payload)
+                self.packets += 1
+                self.bytes += len(payload)
+                self.keyframes += keyframe != -1
+                if pending == self.index_batch:
+                    index.tofile(index_file)
+                    pending = 0
+            index[:pending].tofile(index_file)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.socket.close()
+            if self.forward_socket is not None:
+                self.forward_socket.close()
+            self.logger.info(f"recorded {self.packets} packets ({self.bytes} bytes, {self.keyframes} keyframes) "
+                             f"to {self.path}")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.path} packets={self.packets} keyframes={self.keyframes}>"
+
+
+class H264Reader(logger_mixin()):
+    """
+        Reads a recording made by H264Recorder: packet timing, keyframe lookup and decoding from any keyframe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = np.fromfile(path + ".idx", dtype=PACKET_INDEX_DTYPE)
+        keyframe_packets = self.index[self.index['keyframe'] >= 0]
+        self.keyframe_times = keyframe_packets['timestamp']
+        self.keyframe_offsets = keyframe_packets['offset'] + keyframe_packets['keyframe'].astype('u8')
+
+    def __len__(self) -> int:
+        return len(self.keyframe_offsets)
+
+    @property
+    def duration(self) -> float:
+        return float(self.index['timestamp'][-1] - self.index['timestamp'][0]) if len(self.index) else 0.
+
+    def keyframe_at(self, timestamp: float) -> int:
+        """
+            The last keyframe at or before `timestamp`.
+        """
+        return max(0, int(np.searchsorted(self.keyframe_times, timestamp, side='right')) - 1)
+
+    def packets(self, keyframe: int = 0) -> Iterator[Tuple[float, bytes]]:
+        """
+            Yield (arrival time, payload) for every packet, starting with the packet holding `keyframe`.
+        """
+        start = 0
+        if len(self) and keyframe:
+            start = int(np.searchsorted(self.index['offset'], self.keyframe_offsets[keyframe], side='right')) - 1
+        with open(self.path, 'rb') as stream_file:
+            stream_file.seek(int(self.index['offset'][start]) if len(self.index) else 0)
+            skip = int(self.keyframe_offsets[keyframe] - self.index['offset'][start]) if keyframe else 0
+            for timestamp, _, size, _ in self.index[start:]:
+                payload = stream_file.read(int(size))
+                yield float(timestamp), payload[skip:]
+                skip = 0
+
+    def source(self, keyframe: int = 0) -> str:
+        """
+            What a decoder can open to start at `keyframe`. Raw H.264 has no container to seek in, so for any keyframe
+            but the first this is an FFmpeg subfile URL, which reads the recording from the keyframe's offset on.
+        """
+        if keyframe == 0:
+            return self.path
+        return f"subfile,,start,{int(self.keyframe_offsets[keyframe])},end,0,,:{self.path}"
+
+    def open_capture(self, keyframe: int = 0) -> cv2.VideoCapture:
+        return cv2.VideoCapture(self.source(keyframe))
+
+    def frames(self, keyframe: int = 0) -> Iterator[np.ndarray]:
+        capture = self.open_capture(keyframe)
+        try:
+            grabbed, frame = capture.read()
+            while grabbed:
+                yield frame
+                grabbed, frame = capture.read()
+        finally:
+            capture.release()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.path} packets={len(self.index)} keyframes={len(self)}>"
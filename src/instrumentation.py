@@ -0,0 +1,152 @@
+import json
+import math
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+from utils import logger_mixin
+
+"""
+    Opt-in per-stage latency tracing. Hot paths guard every measurement with `if TRACER.enabled:`, so with tracing
+    off the cost is one attribute lookup.
+    Turn it on with the `trace` define (and `trace_file=<path>` to export the histograms at shutdown).
+"""
+
+BUCKETS_PER_OCTAVE = 4  # histogram resolution: 4 buckets per doubling, ~19% relative error
+MIN_DURATION = 1e-6  # everything at or under 1us shares the first bucket
+NUM_BUCKETS = 120  # 1us * 2 ** (120 / 4) ~ 18 minutes
+
+
+class Histogram:
+    """
+        Log-bucketed histogram of durations in seconds: fixed memory and an O(1) insert.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = 0.
+
+    def add(self, duration: float):
+        if duration <= MIN_DURATION:
+            bucket = 0
+        else:
+            bucket = min(NUM_BUCKETS - 1, int(math.log2(duration / MIN_DURATION) * BUCKETS_PER_OCTAVE))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+
+    def percentile(self, p: float) -> float:
+        if self.count == 0:
+            return 0.
+        rank = p / 100. * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                # upper edge of the bucket, clamped to what was actually seen
+                return min(self.max, max(self.min, MIN_DURATION * 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE)))
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean_ms': self.total / self.count * 1000, 'min_ms': self.min * 1000,
+                'p50_ms': self.percentile(50) * 1000, 'p90_ms': self.percentile(90) * 1000,
+                'p99_ms': self.percentile(99) * 1000, 'max_ms': self.max * 1000}
+
+
+class Tracer(logger_mixin()):
+    """
+        Named stage histograms. `record(stage, start)` adds the time since `start` (a time.perf_counter() value).
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms: Dict[str, Histogram] = {}
+        self.lock = Lock()
+        self.started = time.time()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def record(self, stage: str, start: float, end: Optional[float] = None) -> float:
+        """
+            Returns the end time, to be used as the start of the next stage.
+        """
+        end = time.perf_counter() if end is None else end
+        self.add(stage, end - start)
+        return end
+
+    def add(self, stage: str, duration: float):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(duration)
+
+    def stages(self) -> List[str]:
+        return sorted(self.histograms)
+
+    def summary(self, stage: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            if stage is not None:
+                return {stage: self.histograms[stage].summary()} if stage in self.histograms else {}
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.started = time.time()
+
+    def export(self, path: str):
+        with open(path, 'w') as export_file:
+            json.dump({'started': self.started, 'exported': time.time(), 'stages': self.summary()}, export_file,
+                      indent=2)
+        self.logger.info(f"trace exported to {path}")
+
+    def format_lines(self) -> List[str]:
+        return [f"{name}: p50 {s['p50_ms']:.1f}ms p99 {s['p99_ms']:.1f}ms n={s['count']}"
+                for name, s in self.summary().items() if s['count']]
+
+
+class PhaseTimer(logger_mixin()):
+    """
+        Wall-clock phases of a one-off sequence such as startup, relative to the timer's creation. Phases can run on
+        different threads and overlap.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.phases: List[Tuple[str, float, float]] = []
+        self.lock = Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter() - self.origin
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, start, time.perf_counter() - self.origin))
+
+    def mark(self, name: str):
+        now = time.perf_counter() - self.origin
+        with self.lock:
+            self.phases.append((name, now, now))
+
+    def format_lines(self) -> List[str]:
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        return [f"{name:<16} {start:6.2f}s - {end:6.2f}s ({end - start:.2f}s)" for name, start, end in phases]
+
+    def log(self, title: str = "startup"):
+        self.logger.info('\n'.join([f"{title}:"] + self.format_lines()))
+
+
+TRACER = Tracer()
+STARTUP = PhaseTimer()
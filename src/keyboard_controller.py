@@ -3,89 +3,192 @@ import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 import pygame
 from tello import DroneController
-from typing import Tuple, Callable
-import cv2
+from typing import Tuple, Callable, Optional, TYPE_CHECKING
+import time
 from utils import logger_mixin
-from camera_stream import CameraStream
+from frame_ring import Frame
+from instrumentation import TRACER
+
+if TYPE_CHECKING:
+    from camera_stream import CameraStream
+
+
+RC_KEYS = {  # key: (axis, direction) in rc mode
+    pygame.K_RIGHT: (0, 1),
+    pygame.K_LEFT: (0, -1),
+    pygame.K_UP: (1, 1),
+    pygame.K_DOWN: (1, -1),
+    pygame.K_w: (2, 1),
+    pygame.K_s: (2, -1),
+    pygame.K_e: (3, 1),
+    pygame.K_q: (3, -1),
+}
 
 
 class KeyboardControl(logger_mixin()):
     """
     controlling the drone via keyboard, will display the camera information if set to work.
+    In rc mode the keys act as sticks: pressing one sets its axis on the drone's RCScheduler, releasing it centers
+    the axis again, and the scheduler streams the stick state to the drone at a fixed rate.
+    With `display_stream` the window shows that derived stream of the camera (see frame_pipeline.py, e.g. frames
+    resized to the window) instead of the decoded frames; it has to stay BGR.
     """
 
     def __init__(self, drone: DroneController, control_window_size: Tuple[int, int] = (1280, 720),
-                 camera: CameraStream = None):
+                 camera: "CameraStream" = None, show_stats: bool = False, display_fps: float = 30,
+                 event_rate: float = 120, rc_mode: bool = False, rc_speed: int = 50,
+                 display_stream: Optional[str] = None):
         self.drone = drone
         self.move_amount = 50
         self.rotate_amount = 45
         self.camera = camera
+        self.display_stream = display_stream
+        self.display_ring = None
         self.control_window_size = control_window_size
         self.screen = None
+        self.show_stats = show_stats  # draw the tracing histograms over the video, toggled with 'i'
+        self.font = None
+        self.display_fps = display_fps  # cap on video redraws
+        self.event_rate = event_rate  # keyboard polling rate, independent of the video
+        self._surfaces = {}
+        self._surface_slots = None
+        self.rc_mode = rc_mode
+        self.rc_speed = rc_speed  # stick deflection for a pressed key, 0-100
+        self.pressed = set()
 
     def __repr__(self):
         return f"<{self.__class__.__name__} for {self.drone}>"
 
-    def pass_control(self, exit_check: Callable[[], bool] = lambda: False):
+    def draw_stats(self):
+        if self.font is None:
+            pygame.font.init()
+            self.font = pygame.font.SysFont('monospace', 14)
+        for i, line in enumerate(TRACER.format_lines()):
+            self.screen.blit(self.font.render(line, True, (255, 255, 0), (0, 0, 0)), (5, 5 + 16 * i))
+
+    def _slot_surface(self, frame: Frame) -> pygame.Surface:
+        """
+            Surfaces wrap the ring slots' memory directly (as BGR), so they are made once per slot and show whatever
+            frame the slot currently holds.
+        """
+        ring = self.display_ring
+        if self._surface_slots is not ring.slots:
+            self._surface_slots = ring.slots
+            self._surfaces = {}
+            self.screen.fill([0, 0, 0])
+        index = frame.sequence % ring.size
+        surface = self._surfaces.get(index)
+        if surface is None:
+            height, width = frame.image.shape[:2]
+            surface = self._surfaces[index] = pygame.image.frombuffer(frame.image, (width, height), 'BGR')
+        return surface
+
+    def render(self, frame: Frame):
+        if TRACER.enabled:
+            TRACER.add('display.handoff', time.time() - frame.timestamp)
+        start = time.perf_counter() if TRACER.enabled else 0
+        self.screen.blit(self._slot_surface(frame), (0, 0))
+        if TRACER.enabled:
+            start = TRACER.record('display.blit', start)
+        if self.show_stats and TRACER.enabled:
+            self.draw_stats()
+        pygame.display.update()
+        if TRACER.enabled:
+            TRACER.record('display.update', start)
+
+    def update_sticks(self):
+        sticks = [0, 0, 0, 0]
+        for key in self.pressed:
+            axis, direction = RC_KEYS[key]
+            sticks[axis] += direction * self.rc_speed
+        self.drone.rc.set(*sticks)
+
+    def handle_rc_event(self, event) -> bool:
+        """
+            Returns True if the event was a stick key.
+        """
+        if event.type not in (pygame.KEYDOWN, pygame.KEYUP) or event.key not in RC_KEYS:
+            return False
+        if event.type == pygame.KEYDOWN:
+            self.pressed.add(event.key)
+        else:
+            self.pressed.discard(event.key)
+        self.update_sticks()
+        return True
+
+    def pass_control(self, exit_check: Callable[[], bool] = lambda: False,
+                     on_ready: Optional[Callable[[], None]] = None):
         self.logger.debug("Passing control to keyboard, press 'h' for help")
-        pygame.init()
+        pygame.display.init()  # only what is used, pygame.init() would also bring up audio and joysticks
         self.screen = pygame.display.set_mode(self.control_window_size)
         pygame.display.set_caption("DJI Tello Control Window")
+        if on_ready is not None:
+            on_ready()
+        clock = pygame.time.Clock()
+        cursor = self.camera.cursor(stream=self.display_stream) if self.camera is not None else None
+        self.display_ring = cursor.ring if cursor is not None else None
+        frame_interval = 1. / self.display_fps
+        last_render = 0.
+        if self.rc_mode:
+            self.drone.rc.start()
         running = True
         while running:
+            clock.tick(self.event_rate)
 
             if exit_check():
                 self.logger.debug("lsd-slam process died, exiting...")
                 running = False
 
-            if self.camera is not None:
-                ret, frame = self.camera.get_frames()
+            # redraw only when a new frame arrived, and no more than display_fps times a second
+            if cursor is not None and time.time() - last_render >= frame_interval:
+                frame = cursor.poll()
                 if frame is not None:
-                    self.screen.fill([0, 0, 0])
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    frame = frame.swapaxes(0, 1)
-                    frame = pygame.surfarray.make_surface(frame)
-                    self.screen.blit(frame, (0, 0))
-                    pygame.display.update()
-                else:
-                    self.logger.error("Couldn't get frame to display")
+                    last_render = time.time()
+                    self.render(frame)
 
             for event in pygame.event.get():
+                if self.rc_mode and self.handle_rc_event(event):
+                    continue
                 if event.type == pygame.KEYDOWN:
-                    if event.type == pygame.K_t:
-                        self.drone.takeoff()
+                    if event.key == pygame.K_t:
+                        self.drone.takeoff(wait=not self.rc_mode)
                         self.logger.debug("taking off")
-                    if event.key == pygame.K_RIGHT:
+                    elif event.key == pygame.K_l:
+                        self.drone.land(wait=not self.rc_mode)
+                        self.logger.debug("landing")
+                    elif event.key == pygame.K_RIGHT:
                         self.drone.move.right(self.move_amount)
-                        self.logger.debug(f"moving {self.move_amount} to the right")
+                        self.logger.debug("moving %d to the right", self.move_amount)
                     elif event.key == pygame.K_LEFT:
                         self.drone.move.left(self.move_amount)
-                        self.logger.debug(f"moving {self.move_amount} to the left")
+                        self.logger.debug("moving %d to the left", self.move_amount)
                     elif event.key == pygame.K_UP:
                         self.drone.move.forward(self.move_amount)
-                        self.logger.debug(f"moving {self.move_amount} forwards")
+                        self.logger.debug("moving %d forwards", self.move_amount)
                     elif event.key == pygame.K_DOWN:
                         self.drone.move.back(self.move_amount)
-                        self.logger.debug(f"moving {self.move_amount} backwards")
+                        self.logger.debug("moving %d backwards", self.move_amount)
                     elif event.key == pygame.K_q:
                         self.drone.rotate.ccw(self.rotate_amount)
-                        self.logger.debug(f"rotating {self.rotate_amount} counter-clockwise")
+                        self.logger.debug("rotating %d counter-clockwise", self.rotate_amount)
                     elif event.key == pygame.K_e:
                         self.drone.rotate.cw(self.rotate_amount)
-                        self.logger.debug(f"rotating {self.rotate_amount} clockwise")
+                        self.logger.debug("rotating %d clockwise", self.rotate_amount)
                     elif event.key == pygame.K_s:
                         self.drone.move.down(self.move_amount)
-                        self.logger.debug(f"moving {self.move_amount} down")
+                        self.logger.debug("moving %d down", self.move_amount)
                     elif event.key == pygame.K_w:
                         self.drone.move.up(self.move_amount)
-                        self.logger.debug(f"moving {self.move_amount} up")
+                        self.logger.debug("moving %d up", self.move_amount)
                     elif event.key == pygame.K_ESCAPE:
                         self.logger.debug("Returning control")
                         self.drone.end()
                         running = False
+                    elif event.key == pygame.K_i:
+                        self.show_stats = not self.show_stats
                     elif event.key == pygame.K_p:
                         img_path = self.camera.snapshot()
-                        self.logger.debug(f"printscreen: {img_path}")
+                        self.logger.debug("printscreen: %s", img_path)
                     elif event.key == pygame.K_h:
                         print(
                             "Drone is being controlled by keyboard;\n"
@@ -97,8 +200,14 @@ class KeyboardControl(logger_mixin()):
                             "\t- w:             move up\n"
                             "\t- q:             rotate counter clockwise\n"
                             "\t- e:             rotate clockwise\n"
-                            "\t- t:             take off"
+                            "\t- t:             take off\n"
+                            "\t- l:             land\n"
+                            "\t- i:             toggle latency stats (with the trace define)"
                         )
 
+        if self.rc_mode:
+            self.drone.rc.stop()
         pygame.quit()
-        cv2.destroyAllWindows()
\ No newline at end of file
+        if self.camera is not None:
+            import cv2
+            cv2.destroyAllWindows()
\ No newline at end of file
@@ -1,10 +1,18 @@
 from utils import logger_mixin, CommandLineParser, GLOBALS, update_global
+import os
+import sys
 import subprocess
 import signal
-from typing import Union
+from threading import Thread
+from typing import Optional, Union
+from frame_ring import FrameCursor
+from frame_channel import FrameChannel, SharedMemoryFrameRing, FramePipe, SHM, PIPE
+from pose_stream import PoseStream
+from point_cloud import VoxelPointCloud
 
 LIVE = 0
 OFFLINE = 1
+UDP = 'udp'  # the app decodes the drone's stream itself
 
 """
 The files are hardcoded and should be replaced here:
@@ -25,14 +33,51 @@ def get_lsd_slam_app(app_type: Union[str, int]) -> str:
 
 
 class LSDSlamSystem(logger_mixin()):
+    """
+        Runs the LSD-SLAM app on `input_source`. With slam_input=shm or slam_input=pipe the app instead reads the
+        frames CameraStream already decoded, through a frame channel (see frame_channel.py) that this system
+        creates on `attach` and removes on `terminate`; slam_frame_size is the (width, height) it is fed.
+        The app's output is read by a background thread: pose lines go to `poses` (see pose_stream.py), keyframe
+        points to `point_cloud` (see point_cloud.py), everything else is echoed to stdout as before (slam_echo=False
+        silences it).
+    """
     update_global('lsd_slam_live_app', "/home/nimrodd/code/lsd_slam_noros/bin/live_main", False)
     update_global('lsd_slam_offline_app', "/home/nimrodd/code/lsd_slam_noros/bin/main_on_images", False)
 
-    def __init__(self, input_source, app_type: Union[str, int] = LIVE, calibration_file: str = CALIBRATION_FILE):
+    def __init__(self, input_source, app_type: Union[str, int] = LIVE, calibration_file: str = CALIBRATION_FILE,
+                 poses: Optional[PoseStream] = None, **kwargs):
         self.slam_process = None
+        self.frame_channel: Optional[FrameChannel] = None
+        self.output_thread = None
+        self.poses = poses if poses is not None else PoseStream(**kwargs)
+        self.point_cloud = VoxelPointCloud(**kwargs)
+        self.echo = kwargs.get('slam_echo', True)
         self.input_source = input_source
         self.application = get_lsd_slam_app(app_type)
         self.calibration_file = calibration_file
+        self.input_mode = kwargs.get('slam_input', UDP)
+        if self.input_mode not in (UDP, SHM, PIPE):
+            raise ValueError(f"Unknown slam input: {self.input_mode}")
+        self.frame_size = tuple(kwargs.get('slam_frame_size', (960, 720)))
+        self.pipe_path = kwargs.get('slam_pipe', f"/tmp/tello_slam_{os.getpid()}.fifo")
+
+    @property
+    def shares_frames(self) -> bool:
+        return self.input_mode != UDP
+
+    def attach(self, cursor: FrameCursor) -> "LSDSlamSystem":
+        """
+            Feed the app from `cursor` (usually CameraStream.cursor()) instead of `input_source`.
+        """
+        if self.input_mode == SHM:
+            self.frame_channel = SharedMemoryFrameRing(f"tello_slam_{os.getpid()}", self.frame_size)
+        elif self.input_mode == PIPE:
+            self.frame_channel = FramePipe(self.pipe_path, self.frame_size)
+        else:
+            raise ValueError("slam input is the udp stream, nothing to attach")
+        self.frame_channel.start(cursor)
+        self.input_source = self.frame_channel.source
+        return self
 
     @property
     def is_initialized(self):
@@ -40,12 +85,27 @@ class LSDSlamSystem(logger_mixin()):
 
     def start(self) -> "LSDSlamSystem":
         signal.signal(signal.SIGINT, self.__on_sigint)
-        process_args = [self.app, self.input_source, self.calibration_file]
-        self.LOGGER.debug(f"starting slam process: {' '.join(process_args)}")
-        self.slam_process = subprocess.Popen(process_args, shell=False)
-        self.LOGGER.debug(f"slam process pid: {self.slam_process.pid}")
+        process_args = [self.application, self.input_source, self.calibration_file]
+        self.logger.debug(f"starting slam process: {' '.join(process_args)}")
+        self.slam_process = subprocess.Popen(process_args, shell=False, stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.logger.debug(f"slam process pid: {self.slam_process.pid}")
+        self.output_thread = Thread(target=self.poses.follow, name="slam-output", daemon=True,
+                                    args=(self.slam_process.stdout, self._other_output))
+        self.output_thread.start()
         return self
 
+    def _other_output(self, line: str):
+        if not self.point_cloud.ingest(line) and self.echo:
+            sys.stdout.write(line)
+
+    def latest_pose(self):
+        return self.poses.fresh()
+
+    def stats(self) -> dict:
+        return {'fps': self.poses.fps(), 'lag': self.poses.lag(), 'keyframes': self.poses.keyframes,
+                'voxels': len(self.point_cloud)}
+
     def is_alive(self):
         if self.slam_process is not None:
             return self.slam_process.poll() is None
@@ -53,6 +113,9 @@ class LSDSlamSystem(logger_mixin()):
     def terminate(self):
         if self.slam_process is not None:
             self.slam_process.terminate()
+        if self.frame_channel is not None:
+            self.frame_channel.stop()
+            self.frame_channel = None
 
     def wait_on_slam(self):
         if self.slam_process:
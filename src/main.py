@@ -1,8 +1,10 @@
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import TRACER, STARTUP
 from tello import DroneController
-from keyboard_controller import KeyboardControl
-from utils import CommandLineParser, GLOBALS
-from lsd_slam import LSDSlamSystem
+from utils import CommandLineParser, GLOBALS, FLIGHT_LOG, RUN_ID
+from flight_recorder import RECORDER
 import time
 
 
@@ -22,10 +24,47 @@ class Main(CommandLineParser):
         --doa-check :   Quick check for connectivity and battery.
         --with-camera   :   Set True to recieve video stream from drone.
         --keyboard  :   Use the keyboard to control the drone. Press 'H' afterwards to receive instructions
-        --lsd-slam  :   Activate LSD-SLAM for the drone, overrides camera.
+        --lsd-slam  :   Activate LSD-SLAM for the drone, overrides camera unless slam_input is shared.
         capture_frames  :   save the captured frames from the camera
         frame_dir   :   The dir where the frames are saved
         frame_capture_rate  : rate of capture, default is 0.1
+        capture_policy  :   fixed (default, every frame_capture_rate seconds) or adaptive, keeping frames when the view
+                            changed and they are sharp: capture_min_interval, capture_max_interval,
+                            capture_change_threshold, capture_blur_threshold
+        frame_codec :   jpeg/png/webp, frame_quality sets its quality (png: compression level), or raw to append
+                        unencoded frames to a memory-mapped archive (archive_grayscale, archive_chunk_frames)
+        record_stream   :   write the raw H.264 stream to record_dir (default recordings), record_decode=False to skip
+                            live decoding altogether
+        writer_workers, writer_queue_size, writer_drop_policy (drop-oldest/drop-newest/block)   :   frame writer pool
+        blocking_commands   :   set False to return from flight commands without waiting for the drone's response
+        command_timeout :   seconds to wait for a command response, default is 20
+        command_queue_size: commands queued before callers wait for room (safety commands never wait), default is 32
+        command_rate_limits: max sends per second per command class (safety/flight/query), e.g. {'query': 10}, none by
+                            default
+        rc_control  :   fly with continuous rc sticks instead of discrete moves, rc_rate sets the packets per second
+                        (default 20, max 50) and rc_speed the stick deflection (default 50)
+        decode_policy   :   always (default) or on_demand, to only decode the frames a consumer or a capture asks for
+        video_decoder   :   opencv (default) or pyav, decoding the UDP stream itself with low-delay settings (needs PyAV;
+                            decoder_threads, decoder_thread_type slice/frame), see video_decoder.py
+        frame_streams   :   derived streams computed once per frame on a worker pool (pipeline_workers) from the decoded
+                            ones, e.g. {'slam': ['grayscale', 'undistort', ('resize', (640, 480))]}, see
+                            frame_pipeline.py; slam_stream and display_stream pick the ones SLAM and the control window
+                            read
+        slam_input  :   udp (default, LSD-SLAM decodes the stream itself), shm or pipe to feed it the frames decoded
+                        here as grayscale, through shared memory or a named pipe (slam_pipe=<path>)
+        slam_echo   :   set False to hide the SLAM app's output (its poses are parsed either way)
+        point_cloud_file    :   export the SLAM point cloud (.ply or .npy) at shutdown, point_cloud_resolution and
+                                point_cloud_max_voxels bound it
+        odometry_velocity_gain, odometry_height_gain, odometry_tof_weight  :   dead reckoning from the telemetry (see
+                            odometry.DeadReckoning), DroneController.current_position()
+        mission_speed, mission_settle, mission_reorder, mission_return, mission_curves  :   waypoint missions planned
+                            and flown by DroneController.fly_mission, see mission.py
+        flight_log  :   <path>, binary log of every command, ack, rc packet and decoded frame (see utils.FlightLog)
+        flight_recorder :   <dir>, record commands, acks, telemetry, poses and frame references of the run into
+                            <dir>/flight_<run id>, read it back with flight_recorder.py (recorder_chunk_records,
+                            recorder_flush_interval)
+        trace   :   record per-stage latency histograms, trace_file=<path> exports them at shutdown, trace_overlay
+                    draws them in the control window
 
         Example:
         python3 main.py --ssid Frodo --keyboard --with-camera --verbose -d capture_frame frame_dir=frames frame_capture_rate=0.2
@@ -43,21 +82,61 @@ class Main(CommandLineParser):
         self.parse_args()
        
         self.args.ssid = DRONES.get(self.args.ssid, self.args.ssid)
-        if self.args.run_doa:
+        if self.args.doa_check:
             self.set_debug()
+        TRACER.enable(GLOBALS.get('trace', False))
+        if GLOBALS.get('flight_log'):
+            FLIGHT_LOG.open(GLOBALS['flight_log'])
+        if GLOBALS.get('flight_recorder'):
+            RECORDER.open(os.path.join(GLOBALS['flight_recorder'], f"flight_{RUN_ID}"),
+                          int(GLOBALS.get('recorder_chunk_records', 4096)),
+                          float(GLOBALS.get('recorder_flush_interval', 1.)))
 
         self.drone = None
         self.slam_system = None
 
     def _post_init(self):
-        self.drone = DroneController(ssid=self.args.ssid, **GLOBALS)
-        self.drone.arm()
-        self.slam_system = LSDSlamSystem(self.drone.udp_address, **GLOBALS)
+        """
+            The wifi association and the command handshake run while the modules this run needs are loaded.
+        """
+        with STARTUP.phase('drone'):
+            self.drone = DroneController(None, **GLOBALS)
+        with ThreadPoolExecutor(2) as pool:
+            link = pool.submit(self._bring_up_link)
+            modules = pool.submit(self._import_modules)
+            modules.result()
+            link.result()
+        if self.args.lsd_slam:
+            with STARTUP.phase('slam'):
+                from lsd_slam import LSDSlamSystem
+                self.slam_system = LSDSlamSystem(self.drone.udp_address, poses=self.drone.poses, **GLOBALS)
+
+    def _bring_up_link(self):
+        if self.args.ssid:
+            with STARTUP.phase('wifi'):
+                self.drone.connect(self.args.ssid)
+        with STARTUP.phase('handshake'):
+            self.drone.arm()
+
+    def _import_modules(self):
+        if not self.args.doa_check:
+            with STARTUP.phase('import control'):
+                import keyboard_controller  # noqa: F401 (pygame)
+        if self.args.with_camera or self.args.lsd_slam or self.args.doa_check or GLOBALS.get('record_stream'):
+            with STARTUP.phase('import video'):
+                import camera_stream  # noqa: F401 (OpenCV)
+        if self.args.lsd_slam:
+            with STARTUP.phase('import slam'):
+                import lsd_slam  # noqa: F401
+
+    def _first_control(self):
+        STARTUP.mark('first control')
+        STARTUP.log()
 
     def run_doa(self):
         try:
             self.logger.info(f"running dead-or-alive checks for {self.args.ssid}")
-            self.drone.arm()
+            STARTUP.log()
             self.logger.info(self.drone.get_battery())
             if self.args.lsd_slam:
                 self.logger.info("testing slam system")
@@ -79,20 +158,39 @@ class Main(CommandLineParser):
     def main(self):
         self._post_init()
         try:
-            self.run_doa() if self.args.run_doa else self.run()
+            self.run_doa() if self.args.doa_check else self.run()
         finally:
-            self.slam_system.terminate()
+            if self.slam_system is not None:
+                if self.slam_system.is_initialized:
+                    self.logger.info(f"slam: {self.slam_system.stats()}")
+                    if GLOBALS.get('point_cloud_file'):
+                        self.slam_system.point_cloud.export(GLOBALS['point_cloud_file'])
+                self.slam_system.terminate()
             self.drone.end()
+            if TRACER.enabled and GLOBALS.get('trace_file'):
+                TRACER.export(GLOBALS['trace_file'])
+            FLIGHT_LOG.close()
+            RECORDER.close()
 
     def run(self):
-        show_video = self.args.with_camera and not self.args.lsd_slam
-        if show_video:
+        from keyboard_controller import KeyboardControl
+        if self.drone.recorder is not None:
+            self.drone.record_stream()
+        shared_slam = self.args.lsd_slam and self.slam_system.shares_frames
+        show_video = self.args.with_camera and (not self.args.lsd_slam or shared_slam)
+        if show_video or shared_slam:
             self.drone.capture_stream(show_cam=False)
+        if shared_slam:
+            self.slam_system.attach(self.drone.stream.cursor(stream=GLOBALS.get('slam_stream')))
         if self.args.lsd_slam:
             self.drone.streamon()
             self.slam_system.start()
-        KeyboardControl(self.drone, camera=self.drone.stream if show_video else None).pass_control(
-            (lambda: not self.slam_system.is_alive()) if self.slam_system.is_initialized else (lambda: False))
+        KeyboardControl(self.drone, camera=self.drone.stream if show_video else None,
+                        show_stats=GLOBALS.get('trace_overlay', False), rc_mode=GLOBALS.get('rc_control', False),
+                        rc_speed=int(GLOBALS.get('rc_speed', 50)),
+                        display_stream=GLOBALS.get('display_stream')).pass_control(
+            (lambda: not self.slam_system.is_alive()) if self.args.lsd_slam else (lambda: False),
+            on_ready=self._first_control)
 
 
 if __name__ == "__main__":
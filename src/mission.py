@@ -0,0 +1,348 @@
+import math
+import time
+from collections import deque
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+from utils import logger_mixin, CommandLineParser, GLOBALS
+
+"""
+    Waypoint missions flown with as few `go`/`curve` commands as the SDK allows. Waypoints are in cm relative to the
+    takeoff spot, in the frame of the SDK's go command (x forward, y left, z up, heading kept).
+    Planning:
+        order       nearest neighbour tour from the start, improved with 2-opt (open path, or closed with
+                    mission_return), unless mission_reorder is off
+        merge       drop waypoints in the middle of a straight line, they are flown through anyway
+        split       legs longer than GO_LIMIT on some axis become equal pieces, waypoints within MIN_MOVE (on every
+                    axis) of the previous one are skipped
+        curves      dynamic programming over the legs: every two consecutive legs that form a legal curve (both
+                    points within GO_LIMIT and not within MIN_MOVE, radius within CURVE_RADIUS) are flown as one
+                    curve when its estimated time beats the two go commands, settle time included; legs that
+                    pass through merged waypoints are always flown straight
+    Every step carries an estimated duration, length / speed + mission_settle.
+"""
+
+GO_LIMIT = 500  # cm, per axis
+MIN_MOVE = 20  # cm, a move must exceed this on at least one axis
+GO_SPEED = (10, 100)  # cm/s
+CURVE_SPEED = (10, 60)
+CURVE_RADIUS = (50, 1000)  # cm
+COLLINEAR_TOLERANCE = 0.01  # sine of the angle between legs under which they are merged
+
+
+class MissionStep(NamedTuple):
+    command: str
+    target: Tuple[int, int, int]  # position after the step, cm from the takeoff spot
+    length: float  # flown distance, cm
+    duration: float  # estimate, s
+
+
+class MissionPlan:
+    def __init__(self, steps: List[MissionStep], waypoints: np.ndarray, order: np.ndarray):
+        self.steps = steps
+        self.waypoints = waypoints  # in flight order
+        self.order = order  # flight order -> index in the given waypoints
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    @property
+    def commands(self) -> List[str]:
+        return [step.command for step in self.steps]
+
+    @property
+    def length(self) -> float:
+        return sum(step.length for step in self.steps)
+
+    @property
+    def duration(self) -> float:
+        return sum(step.duration for step in self.steps)
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {len(self.waypoints)} waypoints, {len(self.steps)} commands, "
+                f"{self.length / 100:.1f}m in ~{self.duration:.0f}s>")
+
+
+def from_odometry(position: Sequence[float]) -> Tuple[float, float, float]:
+    """
+        A position of odometry.DeadReckoning (y right) in the go command's frame (y left).
+    """
+    x, y, z = position
+    return x, -y, z
+
+
+def path_length(points: np.ndarray) -> float:
+    return float(np.linalg.norm(np.diff(points, axis=0), axis=1).sum())
+
+
+def order_waypoints(start: np.ndarray, waypoints: np.ndarray, closed: bool = False) -> np.ndarray:
+    """
+        Visiting order of `waypoints` from `start` with a short total path: nearest neighbour, then 2-opt moves
+        evaluated for all segment pairs at once until none shortens the path.
+    """
+    count = len(waypoints)
+    if count < 2:
+        return np.arange(count)
+    points = np.vstack((start, waypoints))
+    distances = np.linalg.norm(points[:, None, :] - points[None, :, :], axis=2)
+    tour = [0]
+    unvisited = np.ones(count + 1, dtype=bool)
+    unvisited[0] = False
+    for _ in range(count):
+        nearest = int(np.argmin(np.where(unvisited, distances[tour[-1]], np.inf)))
+        tour.append(nearest)
+        unvisited[nearest] = False
+    tour = np.array(tour + ([0] if closed else []))
+    # 2-opt: reversing tour[i + 1:j + 1] replaces edges (i, i+1), (j, j+1) by (i, j), (i+1, j+1); an open path may
+    # also reverse its tail, which replaces edge (i, i+1) by nothing
+    for _ in range(100 * count):
+        a, b = tour[:-1], tour[1:]
+        edges = distances[a, b]
+        gain = edges[:, None] + edges[None, :] - distances[a[:, None], a[None, :]] - distances[b[:, None], b[None, :]]
+        gain = np.triu(gain, 2)
+        tail = edges - distances[a, tour[-1]] if not closed else np.zeros(len(edges))
+        i, j = np.unravel_index(int(np.argmax(gain)), gain.shape)
+        best_tail = int(np.argmax(tail))
+        if gain[i, j] > 1e-6 and gain[i, j] >= tail[best_tail]:
+            tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+        elif tail[best_tail] > 1e-6:
+            tour[best_tail + 1:] = tour[best_tail + 1:][::-1]
+        else:
+            break
+    tour = tour[1:-1] if closed else tour[1:]
+    return tour - 1
+
+
+def merge_collinear(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Drop the points where the path goes straight on. Also returns, for every point kept, whether the leg ending
+        there passes through dropped points.
+    """
+    if len(points) < 3:
+        return points, np.zeros(len(points), dtype=bool)
+    legs = np.diff(points, axis=0)
+    norms = np.linalg.norm(legs, axis=1)
+    keep = np.ones(len(points), dtype=bool)
+    directions = legs / np.maximum(norms, 1e-9)[:, None]
+    sines = np.linalg.norm(np.cross(directions[:-1], directions[1:]), axis=1)
+    straight = (sines < COLLINEAR_TOLERANCE) & (np.einsum('ij,ij->i', directions[:-1], directions[1:]) > 0)
+    keep[1:-1] = ~straight & (norms[:-1] > 0)
+    dropped = np.cumsum(~keep)[keep]
+    through = np.concatenate(([False], np.diff(dropped) > 0))
+    return points[keep], through
+
+
+def split_legs(points: np.ndarray, through: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Integer positions whose consecutive differences are all legal go moves, and for each of these legs whether
+        it covers a leg marked in `through` (one flag per point, for the leg ending there).
+    """
+    points = np.rint(points).astype(np.int64)
+    through = np.zeros(len(points), dtype=bool) if through is None else through
+    keep = [0]
+    for index in range(1, len(points)):
+        if np.abs(points[index] - points[keep[-1]]).max() > MIN_MOVE:
+            keep.append(index)
+        elif index == len(points) - 1 and len(keep) > 1 and \
+                np.abs(points[index] - points[keep[-2]]).max() > MIN_MOVE:
+            # end on the last waypoint, its short leg is folded into the previous one unless that makes it too short
+            # as well, then the mission ends on the previous point
+            keep[-1] = index
+    result = [points[0]]
+    straight = []
+    for begin, end in zip(keep[:-1], keep[1:]):
+        previous = result[-1]
+        leg = points[end] - previous
+        pieces = max(1, math.ceil(np.abs(leg).max() / GO_LIMIT))
+        result.extend(previous + np.rint(leg * piece / pieces).astype(np.int64) for piece in range(1, pieces + 1))
+        straight.extend([bool(through[begin + 1:end + 1].any())] * pieces)
+    return np.array(result), np.array(straight, dtype=bool)
+
+
+def curve_geometry(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        (radius, arc length) of the circle arcs from a through b to c, for arrays of points, inf for straight lines.
+    """
+    ab, bc, ac = b - a, c - b, c - a
+    la, lb, lc = (np.linalg.norm(v, axis=-1) for v in (ab, bc, ac))
+    twice_area = np.linalg.norm(np.cross(ab, ac), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radius = np.where(twice_area > 1e-9, la * lb * lc / (2 * twice_area), np.inf)
+        cos_b = np.clip(np.einsum('...i,...i->...', -ab, bc) / np.maximum(la * lb, 1e-9), -1., 1.)
+        # the inscribed angle at b spans the arc a-c without b, the flown arc is the rest of the circle
+        arc = np.where(np.isfinite(radius), radius * (2 * np.pi - 2 * np.arccos(cos_b)), la + lb)
+    return radius, arc
+
+
+class MissionPlanner(logger_mixin()):
+    """
+        Options: mission_speed (go speed, default 60 cm/s), mission_curve_speed (default and at most 60),
+        mission_settle (time to stop and settle after each command, default 1s), mission_reorder (default True),
+        mission_return (plan a closed tour back to the start, default False), mission_curves (default True).
+    """
+
+    def __init__(self, **kwargs):
+        self.speed = int(np.clip(kwargs.get('mission_speed', 60), *GO_SPEED))
+        self.curve_speed = int(np.clip(kwargs.get('mission_curve_speed', 60), *CURVE_SPEED))
+        self.settle = float(kwargs.get('mission_settle', 1.))
+        self.reorder = kwargs.get('mission_reorder', True)
+        self.closed = kwargs.get('mission_return', False)
+        self.curves = kwargs.get('mission_curves', True)
+
+    def go_time(self, length: float) -> float:
+        return float(length) / self.speed + self.settle
+
+    def curve_time(self, arc: float) -> float:
+        return float(arc) / self.curve_speed + self.settle
+
+    def plan(self, waypoints: Sequence[Sequence[float]], start: Sequence[float] = (0, 0, 0)) -> MissionPlan:
+        waypoints = np.asarray(waypoints, dtype=np.float64).reshape(-1, 3)
+        start = np.asarray(start, dtype=np.float64)
+        order = order_waypoints(start, waypoints, self.closed) if self.reorder else np.arange(len(waypoints))
+        ordered = waypoints[order]
+        points = np.vstack((start, ordered) + ((start,) if self.closed else ()))
+        points, straight = split_legs(*merge_collinear(points))
+        steps = self._steps(points, straight)
+        plan = MissionPlan(steps, ordered, order)
+        self.logger.debug("%s: %s", plan, ' | '.join(plan.commands))
+        return plan
+
+    def _steps(self, points: np.ndarray, straight: Optional[np.ndarray] = None) -> List[MissionStep]:
+        """
+            Cheapest go/curve cover of the legs: best[i] is the time to reach point i. Legs marked in `straight` are
+            never part of a curve.
+        """
+        count = len(points)
+        if count < 2:
+            return []
+        lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+        legal = np.zeros(count, dtype=bool)  # legal[i]: curve from points[i - 2] through points[i - 1] to points[i]
+        arcs = np.full(count, np.inf)
+        if self.curves and count >= 3:
+            a, b, c = points[:-2].astype(np.float64), points[1:-1].astype(np.float64), points[2:].astype(np.float64)
+            radius, arc = curve_geometry(a, b, c)
+            first, second = b - a, c - a
+            legal[2:] = ((np.abs(first).max(axis=1) <= GO_LIMIT) & (np.abs(second).max(axis=1) <= GO_LIMIT) &
+                         (np.abs(first).max(axis=1) > MIN_MOVE) & (np.abs(second).max(axis=1) > MIN_MOVE) &
+                         (radius >= CURVE_RADIUS[0]) & (radius <= CURVE_RADIUS[1]))
+            if straight is not None:
+                legal[2:] &= ~straight[:-1] & ~straight[1:]
+            arcs[2:] = arc
+        best = np.zeros(count)
+        via_curve = np.zeros(count, dtype=bool)
+        for i in range(1, count):
+            best[i] = best[i - 1] + self.go_time(lengths[i - 1])
+            if legal[i] and best[i - 2] + self.curve_time(arcs[i]) < best[i]:
+                best[i] = best[i - 2] + self.curve_time(arcs[i])
+                via_curve[i] = True
+        steps = []
+        i = count - 1
+        while i > 0:
+            if via_curve[i]:
+                first, second = points[i - 1] - points[i - 2], points[i] - points[i - 2]
+                steps.append(MissionStep(f"curve {' '.join(map(str, first))} {' '.join(map(str, second))} "
+                                         f"{self.curve_speed}", tuple(int(v) for v in points[i]), float(arcs[i]),
+                                         self.curve_time(arcs[i])))
+                i -= 2
+            else:
+                leg = points[i] - points[i - 1]
+                steps.append(MissionStep(f"go {' '.join(map(str, leg))} {self.speed}", tuple(int(v) for v in points[i]),
+                                         float(lengths[i - 1]), self.go_time(lengths[i - 1])))
+                i -= 1
+        return steps[::-1]
+
+    def naive(self, waypoints: Sequence[Sequence[float]], start: Sequence[float] = (0, 0, 0)) -> MissionPlan:
+        """
+            The waypoints as given, one go per leg (split where needed), for comparison.
+        """
+        curves, reorder = self.curves, self.reorder
+        self.curves = self.reorder = False
+        try:
+            waypoints = np.asarray(waypoints, dtype=np.float64).reshape(-1, 3)
+            points, _ = split_legs(np.vstack((np.asarray(start, dtype=np.float64), waypoints)))
+            return MissionPlan(self._steps(points), waypoints, np.arange(len(waypoints)))
+        finally:
+            self.curves, self.reorder = curves, reorder
+
+
+class MissionRunner(logger_mixin()):
+    """
+        Flies a plan through a CommandChannel. Up to `mission_window` commands are queued ahead, so the next one goes
+        out as soon as the drone acknowledges the previous one; each is given its estimated duration times
+        `mission_timeout_factor` (plus mission_timeout_margin seconds) to complete.
+    """
+
+    def __init__(self, channel, **kwargs):
+        self.channel = channel
+        self.window = int(kwargs.get('mission_window', 4))
+        self.timeout_factor = float(kwargs.get('mission_timeout_factor', 3.))
+        self.timeout_margin = float(kwargs.get('mission_timeout_margin', 5.))
+        self.durations: List[float] = []
+
+    def run(self, plan: MissionPlan) -> List[float]:
+        """
+            Fly the plan, returns the time each step took. Raises if the drone rejects or doesn't answer a step, the
+            steps queued behind it are cancelled.
+        """
+        pending = deque()
+        upcoming = iter(plan.steps)
+        self.durations = []
+        started = last_done = time.perf_counter()
+        try:
+            for index in range(len(plan.steps)):
+                while len(pending) < self.window:
+                    step = next(upcoming, None)
+                    if step is None:
+                        break
+                    timeout = step.duration * self.timeout_factor + self.timeout_margin
+                    pending.append((step, self.channel.submit(step.command, timeout, 0)))
+                step, future = pending.popleft()
+                response = future.result()
+                now = time.perf_counter()
+                self.durations.append(now - last_done)
+                last_done = now
+                if response != 'ok':
+                    raise RuntimeError(f"'{step.command}' failed: {response}")
+                self.logger.info(f"step {index + 1}/{len(plan)} {step.command}: {self.durations[-1]:.1f}s "
+                                 f"(estimated {step.duration:.1f}s)")
+        finally:
+            for _, future in pending:
+                future.cancel()
+        self.logger.info(f"mission done in {time.perf_counter() - started:.1f}s (estimated {plan.duration:.1f}s)")
+        return self.durations
+
+
+def read_waypoints(path: str) -> np.ndarray:
+    """
+        One "x y z" waypoint (cm) per line, `#` comments.
+    """
+    with open(path) as waypoints_file:
+        rows = [line.split('#', 1)[0].replace(',', ' ').split() for line in waypoints_file]
+    return np.array([[float(v) for v in row] for row in rows if row], dtype=np.float64).reshape(-1, 3)
+
+
+class Main(CommandLineParser):
+    """
+        Plan a mission from a waypoint file and print it next to the waypoints flown as given, e.g.
+        python3 mission.py survey.txt -D mission_speed=80 mission_return=True
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello mission planner")
+        self.add_argument('waypoints', type=str)
+        self.parse_args()
+
+    def main(self):
+        waypoints = read_waypoints(self.args.waypoints)
+        planner = MissionPlanner(**GLOBALS)
+        start = time.perf_counter()
+        plan = planner.plan(waypoints)
+        elapsed = time.perf_counter() - start
+        naive = planner.naive(waypoints)
+        for step in plan.steps:
+            print(f"{step.command:<40} -> {step.target} {step.duration:5.1f}s")
+        print(f"planned in {elapsed * 1000:.1f}ms: {plan}")
+        print(f"as given: {naive}")
+
+
+if __name__ == "__main__":
+    Main().main()
@@ -0,0 +1,251 @@
+import math
+import time
+from threading import Thread, Event
+from typing import Tuple
+import numpy as np
+from utils import logger_mixin, CommandLineParser, GLOBALS
+from ring_buffer import TimeSeriesRing
+
+"""
+    Dead reckoning from the state broadcast, to know where the drone is between (or without) SLAM poses.
+    Frames: the Tello reports attitude in degrees and acceleration in 0.001g in its body frame (x forward, y right,
+    z down, so about agz=-1000 at rest), and its vision-positioning speeds vgx/vgy/vgz in dm/s. The estimate is in
+    the takeoff frame: x forward and y right of the heading at `reset`, z up, in cm and cm/s.
+    Per batch of samples, all vectorized:
+        acceleration    body -> world rotation from pitch/roll/yaw, minus gravity and the estimated bias
+        velocity        complementary filter of the reported speeds and the integrated acceleration
+        height          `h` blended with the tof distance when it is in range, complementary filter with the
+                        integrated vertical velocity
+        position        trapezoidal integration of the velocity
+    While the drone sits on the ground (no speed, no height) the velocity is held at zero and the residual
+    acceleration updates the bias.
+"""
+
+ODOMETRY_DTYPE = np.dtype([
+    ('timestamp', 'f8'),  # of the telemetry sample, seconds since the epoch
+    ('x', 'f4'),  # cm
+    ('y', 'f4'),
+    ('z', 'f4'),
+    ('vx', 'f4'),  # cm/s
+    ('vy', 'f4'),
+    ('vz', 'f4'),
+])
+
+MG_TO_CMS2 = 0.980665  # 0.001g in cm/s^2
+GRAVITY_MG = np.array([0., 0., -1000.])  # what the accelerometer reads at rest, in the world frame
+TOF_RANGE = (10, 800)  # cm, 10 is what the sensor reports when it sees nothing
+
+
+def complementary(previous: np.ndarray, measured: np.ndarray, increments: np.ndarray, gain: float) -> np.ndarray:
+    """
+        x[k] = gain * measured[k] + (1 - gain) * (x[k-1] + increments[k]) over a whole batch, with x[-1] = previous.
+        Unrolled into x[k] = keep^k * (keep * previous + cumsum(w / keep^j)), with w = gain * measured +
+        keep * increments, in blocks short enough for keep^-j to stay well within float64 precision.
+    """
+    keep = 1. - gain
+    if keep <= 0.:
+        return measured.astype(np.float64)
+    weighted = gain * measured + keep * increments
+    result = np.empty_like(weighted, dtype=np.float64)
+    block = max(1, int(30 / max(1e-9, -math.log2(keep)))) if keep < 1. else len(weighted)
+    for start in range(0, len(weighted), block):
+        powers = keep ** np.arange(min(block, len(weighted) - start), dtype=np.float64)
+        if weighted.ndim > 1:
+            powers = powers[:, None]
+        chunk = powers * (keep * previous + np.cumsum(weighted[start:start + block] / powers, axis=0))
+        result[start:start + block] = chunk
+        previous = chunk[-1]
+    return result
+
+
+def rotation_matrices(pitch: np.ndarray, roll: np.ndarray, yaw: np.ndarray) -> np.ndarray:
+    """
+        (N, 3, 3) body -> world rotations, yaw-pitch-roll (Z-Y-X) convention, angles in radians.
+    """
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cr, sr = np.cos(roll), np.sin(roll)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    rotations = np.empty((len(pitch), 3, 3))
+    rotations[:, 0, 0] = cy * cp
+    rotations[:, 0, 1] = cy * sp * sr - sy * cr
+    rotations[:, 0, 2] = cy * sp * cr + sy * sr
+    rotations[:, 1, 0] = sy * cp
+    rotations[:, 1, 1] = sy * sp * sr + cy * cr
+    rotations[:, 1, 2] = sy * sp * cr - cy * sr
+    rotations[:, 2, 0] = -sp
+    rotations[:, 2, 1] = cp * sr
+    rotations[:, 2, 2] = cp * cr
+    return rotations
+
+
+class DeadReckoning(logger_mixin()):
+    """
+        Integrates the telemetry into a position and velocity estimate. Started with a TelemetryReceiver it consumes
+        the new samples every `odometry_interval` seconds (default 0.1, about the broadcast period); without one,
+        feed it batches with `update` (e.g. a recorded telemetry stream).
+        Options: odometry_velocity_gain (weight of the reported speed against the integrated acceleration, default
+        0.3), odometry_height_gain (0.5), odometry_tof_weight (weight of an in-range tof reading in the height,
+        0.5), odometry_bias_rate (0.05), odometry_max_gap (longest integrated step, 0.5s), odometry_max_extrapolation
+        (how far current_position projects the last estimate, 0.2s), odometry_history (6000 estimates).
+    """
+
+    def __init__(self, telemetry=None, **kwargs):
+        self.telemetry = telemetry
+        self.interval = float(kwargs.get('odometry_interval', 0.1))
+        self.velocity_gain = float(kwargs.get('odometry_velocity_gain', 0.3))
+        self.height_gain = float(kwargs.get('odometry_height_gain', 0.5))
+        self.tof_weight = float(kwargs.get('odometry_tof_weight', 0.5))
+        self.bias_rate = float(kwargs.get('odometry_bias_rate', 0.05))
+        self.max_gap = float(kwargs.get('odometry_max_gap', 0.5))
+        self.max_extrapolation = float(kwargs.get('odometry_max_extrapolation', 0.2))
+        self.buffer = TimeSeriesRing(ODOMETRY_DTYPE, int(kwargs.get('odometry_history', 6000)))
+        self.bias = np.zeros(3)  # world frame, 0.001g
+        self.consumed = 0  # telemetry samples processed
+        self.running = False
+        self.stopped = Event()
+        self.thread = None
+        self.pending_reset = None
+        self._reset((0., 0., 0.))
+
+    def reset(self, position: Tuple[float, float, float] = (0., 0., 0.)):
+        """
+            Restart the estimate at `position` with the next batch, whose first heading becomes the x axis.
+        """
+        self.pending_reset = position
+        if not self.running:
+            self._reset(position)
+
+    def _reset(self, position: Tuple[float, float, float]):
+        self.pending_reset = None
+        self.position = np.array(position, dtype=np.float64)
+        self.velocity = np.zeros(3)
+        self.last_timestamp = None
+        self.heading = None  # yaw of the takeoff frame, degrees
+        # (timestamp, x, y, z, vx, vy, vz) of the latest estimate, replaced as a whole so readers need no lock
+        self.estimate = (time.time(), *self.position.tolist(), *self.velocity.tolist())
+
+    def update(self, samples: np.ndarray) -> np.ndarray:
+        """
+            Integrate a batch of telemetry.TELEMETRY_DTYPE samples in time order, returns their ODOMETRY_DTYPE
+            estimates. Only called from a single thread.
+        """
+        if self.pending_reset is not None:
+            self._reset(self.pending_reset)
+        if len(samples) == 0:
+            return np.zeros(0, dtype=ODOMETRY_DTYPE)
+        timestamps = samples['timestamp'].astype(np.float64)
+        previous = timestamps[0] if self.last_timestamp is None else self.last_timestamp
+        steps = np.clip(np.diff(timestamps, prepend=previous), 0., self.max_gap)
+        yaw = samples['yaw'].astype(np.float64)
+        if self.heading is None:
+            self.heading = yaw[0]
+        rotations = rotation_matrices(np.radians(samples['pitch'].astype(np.float64)),
+                                      np.radians(samples['roll'].astype(np.float64)), np.radians(yaw - self.heading))
+        body = np.stack((samples['agx'], samples['agy'], samples['agz']), axis=1).astype(np.float64)
+        residual = np.einsum('nij,nj->ni', rotations, body) - GRAVITY_MG
+        # reported speeds, takeoff frame, down -> up
+        speeds = np.stack((samples['vgx'], samples['vgy'], -samples['vgz']), axis=1).astype(np.float64) * 10.
+        grounded = (samples['h'] <= 0) & ~speeds.any(axis=1)
+        if grounded.any():
+            self.bias += self.bias_rate * (residual[grounded].mean(axis=0) - self.bias)
+        acceleration = (residual - self.bias) * MG_TO_CMS2
+        acceleration[:, 2] = -acceleration[:, 2]  # z up
+        velocity = complementary(self.velocity, speeds, acceleration * steps[:, None], self.velocity_gain)
+        velocity[grounded] = 0.
+        # height: `h` is relative to the takeoff spot, the tof distance is sharper close to the ground
+        heights = samples['h'].astype(np.float64)
+        tof = samples['tof'].astype(np.float64)
+        in_range = (tof > TOF_RANGE[0]) & (tof < TOF_RANGE[1])
+        heights[in_range] = (1. - self.tof_weight) * heights[in_range] + self.tof_weight * tof[in_range]
+        previous_velocity = np.vstack((self.velocity, velocity[:-1]))
+        displacement = 0.5 * (previous_velocity + velocity) * steps[:, None]
+        position = self.position + np.cumsum(displacement, axis=0)
+        position[:, 2] = complementary(self.position[2], heights, displacement[:, 2], self.height_gain)
+        estimates = np.empty(len(samples), dtype=ODOMETRY_DTYPE)
+        estimates['timestamp'] = timestamps
+        estimates['x'], estimates['y'], estimates['z'] = position.T
+        estimates['vx'], estimates['vy'], estimates['vz'] = velocity.T
+        self.position, self.velocity, self.last_timestamp = position[-1], velocity[-1], timestamps[-1]
+        self.estimate = (float(self.last_timestamp), *self.position.tolist(), *self.velocity.tolist())
+        self.buffer.extend(estimates)
+        return estimates
+
+    def poll(self) -> int:
+        """
+            Integrate the telemetry received since the last call, returns the number of samples.
+        """
+        samples, self.consumed = self.telemetry.buffer.since(self.consumed)
+        if len(samples) == 0:
+            return 0
+        self.update(samples)
+        return len(samples)
+
+    def current_position(self, extrapolate: bool = True) -> Tuple[float, float, float]:
+        """
+            (x, y, z) in cm, projected from the latest estimate by its velocity (for at most
+            `odometry_max_extrapolation` seconds). Cheap enough to call from control loops.
+        """
+        timestamp, x, y, z, vx, vy, vz = self.estimate
+        if not extrapolate:
+            return x, y, z
+        elapsed = min(max(0., time.time() - timestamp), self.max_extrapolation)
+        return x + vx * elapsed, y + vy * elapsed, z + vz * elapsed
+
+    def current_velocity(self) -> Tuple[float, float, float]:
+        return self.estimate[4:]
+
+    def window(self, seconds: float) -> np.ndarray:
+        return self.buffer.window(seconds)
+
+    def start(self) -> "DeadReckoning":
+        if self.running or self.telemetry is None:
+            return self
+        self.running = True
+        self.stopped.clear()
+        self.consumed = self.telemetry.buffer.count
+        self.thread = Thread(target=self.run, name="odometry", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error(e)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.stopped.set()
+            self.thread.join()
+
+    def __repr__(self):
+        x, y, z = self.current_position(False)
+        return f"<{self.__class__.__name__}: position=({x:.0f}, {y:.0f}, {z:.0f})cm bias={self.bias.round(1)}mg>"
+
+
+class Main(CommandLineParser):
+    """
+        Dead-reckon the telemetry of a flight recording (see flight_recorder.py) into an .npy of ODOMETRY_DTYPE, e.g.
+        python3 odometry.py recordings/flight_<run id> track.npy -D odometry_velocity_gain=0.5
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello odometry")
+        self.add_argument('recording', type=str)
+        self.add_argument('output', type=str)
+        self.parse_args()
+
+    def main(self):
+        from flight_recorder import FlightRecording
+        samples = FlightRecording(self.args.recording).between('telemetry')
+        odometry = DeadReckoning(**GLOBALS)
+        start = time.perf_counter()
+        estimates = odometry.update(samples)
+        np.save(self.args.output, estimates)
+        self.logger.info(f"{len(samples)} samples in {time.perf_counter() - start:.3f}s, {odometry}")
+
+
+if __name__ == "__main__":
+    Main().main()
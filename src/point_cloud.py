@@ -0,0 +1,261 @@
+import time
+from threading import Lock
+from typing import Optional, Tuple
+import numpy as np
+from utils import logger_mixin, CommandLineParser, GLOBALS
+
+"""
+    The map LSD-SLAM builds, kept bounded: points are merged into a voxel grid where every occupied voxel holds the
+    running centroid (and mean intensity) of the points that fell in it. The app prints each keyframe's points as
+        points <keyframe_id> x y z [x y z ...]
+    (or x y z i per point with the `intensity` flag of `ingest`).
+    Voxel coordinates are packed into a single int64 key; a sorted copy of the keys indexes the voxel arrays, so a
+    whole keyframe is looked up and merged with a handful of vectorized NumPy calls.
+"""
+
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)  # voxel coordinates in [-2^20, 2^20) per axis
+KEY_MASK = (1 << KEY_BITS) - 1
+BYTES_PER_VOXEL = 8 + 24 + 4 + 4 + 8 + 8 + 8  # key, sums, count, intensity, generation, sorted index
+PLY_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('intensity', '<f4'), ('count', '<u4')])
+
+
+def pack_keys(voxels: np.ndarray) -> np.ndarray:
+    shifted = (voxels + KEY_OFFSET).astype(np.int64) & KEY_MASK
+    return (shifted[:, 0] << (2 * KEY_BITS)) | (shifted[:, 1] << KEY_BITS) | shifted[:, 2]
+
+
+def unpack_keys(keys: np.ndarray) -> np.ndarray:
+    voxels = np.empty((len(keys), 3), dtype=np.int64)
+    voxels[:, 0] = (keys >> (2 * KEY_BITS)) & KEY_MASK
+    voxels[:, 1] = (keys >> KEY_BITS) & KEY_MASK
+    voxels[:, 2] = keys & KEY_MASK
+    return voxels - KEY_OFFSET
+
+
+class VoxelPointCloud(logger_mixin()):
+    """
+        Voxel-downsampled point cloud with a hard cap on the number of voxels.
+        Options: point_cloud_resolution (voxel edge, in SLAM units, default 0.05), point_cloud_max_voxels (default
+        1M, about BYTES_PER_VOXEL bytes each). Storage grows by doubling up to the cap and then stays put; when full,
+        the voxels that were updated longest ago are evicted (point_cloud_evict, fraction evicted at once).
+        Every insertion bumps a generation counter, `snapshot(since)` returns only the voxels changed after it.
+    """
+
+    def __init__(self, **kwargs):
+        self.resolution = float(kwargs.get('point_cloud_resolution', 0.05))
+        self.max_voxels = int(kwargs.get('point_cloud_max_voxels', 1 << 20))
+        self.evict_fraction = float(kwargs.get('point_cloud_evict', 0.1))
+        self.lock = Lock()
+        self.size = 0
+        self.generation = 0
+        self.points_added = 0
+        self.evicted = 0
+        self.capacity = 0
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros((0, 3), dtype=np.float64)  # the centroid is sums / counts
+        self.counts = np.zeros(0, dtype=np.uint32)
+        self.intensity = np.zeros(0, dtype=np.float32)  # mean
+        self.generations = np.zeros(0, dtype=np.int64)  # last update
+        self.sorted_keys = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)  # sorted position -> voxel slot
+        self._allocate(min(self.max_voxels, 1 << 16))
+
+    def _allocate(self, capacity: int):
+        def grow(array: np.ndarray) -> np.ndarray:
+            new = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            new[:self.size] = array[:self.size]
+            return new
+
+        self.capacity = capacity
+        self.keys = grow(self.keys)
+        self.sums = grow(self.sums)
+        self.counts = grow(self.counts)
+        self.intensity = grow(self.intensity)
+        self.generations = grow(self.generations)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.keys, self.sums, self.counts, self.intensity, self.generations,
+                                              self.sorted_keys, self.order))
+
+    def add_points(self, points: np.ndarray, intensity: Optional[np.ndarray] = None) -> int:
+        """
+            Merge an (N, 3) array of points, returns the number of new voxels.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        points = points[np.isfinite(points).all(axis=1)]
+        if len(points) == 0:
+            return 0
+        intensity = np.zeros(len(points), np.float32) if intensity is None else np.asarray(intensity, np.float32)
+        keys = pack_keys(np.floor(points / self.resolution))
+        unique, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        sums = np.zeros((len(unique), 3))
+        for axis in range(3):
+            sums[:, axis] = np.bincount(inverse, points[:, axis], len(unique))
+        intensity_sums = np.bincount(inverse, intensity, len(unique))
+        with self.lock:
+            self.generation += 1
+            self.points_added += len(points)
+            positions = np.searchsorted(self.sorted_keys, unique)
+            found = positions < len(self.sorted_keys)
+            found[found] = self.sorted_keys[positions[found]] == unique[found]
+            # existing voxels: running centroid and mean intensity
+            slots = self.order[positions[found]]
+            old_counts = self.counts[slots].astype(np.float64)
+            self.sums[slots] += sums[found]
+            self.intensity[slots] = ((self.intensity[slots] * old_counts + intensity_sums[found]) /
+                                     (old_counts + counts[found]))
+            self.counts[slots] += counts[found].astype(np.uint32)
+            self.generations[slots] = self.generation
+            new = np.flatnonzero(~found)
+            if len(new) > self.max_voxels:
+                # a single batch larger than the whole grid, keep its densest voxels
+                new = np.sort(new[np.argsort(counts[new])[-self.max_voxels:]])
+            added = len(new)
+            if added:
+                self._reserve(added)
+                # eviction may have rebuilt the index, look the new keys up again
+                positions = np.searchsorted(self.sorted_keys, unique[new])
+                slots = np.arange(self.size, self.size + added)
+                self.keys[slots] = unique[new]
+                self.sums[slots] = sums[new]
+                self.counts[slots] = counts[new]
+                self.intensity[slots] = intensity_sums[new] / counts[new]
+                self.generations[slots] = self.generation
+                self.sorted_keys = np.insert(self.sorted_keys, positions, unique[new])
+                self.order = np.insert(self.order, positions, slots)
+                self.size += added
+            return added
+
+    def _reserve(self, count: int):
+        if self.size + count <= self.capacity:
+            return
+        if self.capacity < self.max_voxels:
+            capacity = self.capacity
+            while capacity < self.size + count and capacity < self.max_voxels:
+                capacity *= 2
+            self._allocate(min(capacity, self.max_voxels))
+            if self.size + count <= self.capacity:
+                return
+        count = min(count, self.capacity)
+        self._evict(max(self.size + count - self.capacity, int(self.capacity * self.evict_fraction)))
+
+    def _evict(self, count: int):
+        """
+            Drop the `count` least recently updated voxels and compact the arrays.
+        """
+        count = min(count, self.size)
+        stale = np.argpartition(self.generations[:self.size], count - 1)[:count]
+        keep = np.ones(self.size, dtype=bool)
+        keep[stale] = False
+        kept = int(keep.sum())
+        for array in (self.keys, self.sums, self.counts, self.intensity, self.generations):
+            array[:kept] = array[:self.size][keep]
+        self.size = kept
+        self.order = np.argsort(self.keys[:kept], kind='stable')
+        self.sorted_keys = self.keys[self.order]
+        self.evicted += count
+
+    def ingest(self, line: str, intensity: bool = False) -> bool:
+        """
+            Parse a `points` line of the SLAM app's output, returns whether it was one.
+        """
+        if not line.startswith('points '):
+            return False
+        try:
+            values = np.array(line.split()[2:], dtype=np.float64)
+        except ValueError:  # the app's own log lines may start with 'points ' too
+            self.logger.debug(f"not a points line: {line.rstrip()}")
+            return False
+        width = 4 if intensity else 3
+        if len(values) % width:
+            self.logger.warning(f"malformed points line ({len(values)} values)")
+            return True
+        values = values.reshape(-1, width)
+        self.add_points(values[:, :3], values[:, 3] if intensity else None)
+        return True
+
+    def _select(self, mask_fn=None, since: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with self.lock:
+            selected = self.generations[:self.size] > since
+            counts = self.counts[:self.size][selected]
+            centroids = self.sums[:self.size][selected] / counts[:, None]
+            intensity = self.intensity[:self.size][selected]
+        if mask_fn is not None:
+            mask = mask_fn(centroids)
+            return centroids[mask], intensity[mask], counts[mask]
+        return centroids, intensity, counts
+
+    def points(self) -> np.ndarray:
+        return self._select()[0]
+
+    def snapshot(self, since: int = 0) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+        """
+            (generation, centroids, intensity, counts) of the voxels updated after generation `since`; pass the
+            returned generation next time to only get what changed.
+        """
+        generation = self.generation
+        return (generation,) + self._select(since=since)
+
+    def query_box(self, low, high) -> np.ndarray:
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+        return self._select(lambda c: np.all((c >= low) & (c <= high), axis=1))[0]
+
+    def query_radius(self, center, radius: float) -> np.ndarray:
+        center = np.asarray(center, dtype=np.float64)
+        return self._select(lambda c: np.einsum('ij,ij->i', c - center, c - center) <= radius * radius)[0]
+
+    def export(self, path: str, since: int = 0) -> int:
+        """
+            Write the voxel centroids to a binary PLY, or to an .npy of PLY_DTYPE records, returns the generation
+            exported (see snapshot).
+        """
+        generation, centroids, intensity, counts = self.snapshot(since)
+        records = np.empty(len(centroids), dtype=PLY_DTYPE)
+        records['x'], records['y'], records['z'] = centroids.T
+        records['intensity'] = intensity
+        records['count'] = counts
+        if path.endswith('.npy'):
+            np.save(path, records)
+            return generation
+        with open(path, 'wb') as ply:
+            ply.write((f"ply\nformat binary_little_endian 1.0\nelement vertex {len(records)}\n"
+                       "property float x\nproperty float y\nproperty float z\nproperty float intensity\n"
+                       "property uint count\nend_header\n").encode('ascii'))
+            records.tofile(ply)
+        return generation
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.size}/{self.max_voxels} voxels of {self.resolution} "
+                f"({self.nbytes / 2 ** 20:.1f}MB), {self.points_added} points, {self.evicted} evicted>")
+
+
+class Main(CommandLineParser):
+    """
+        Downsample a recorded SLAM output (text, one `points` line per keyframe) into a PLY/NPY file, e.g.
+        python3 point_cloud.py slam_output.txt cloud.ply -D point_cloud_resolution=0.02
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello point cloud")
+        self.add_argument('input', type=str)
+        self.add_argument('output', type=str)
+        self.add_flag('--intensity')
+        self.parse_args()
+
+    def main(self):
+        cloud = VoxelPointCloud(**GLOBALS)
+        start = time.time()
+        with open(self.args.input) as slam_output:
+            for line in slam_output:
+                cloud.ingest(line, self.args.intensity)
+        cloud.export(self.args.output)
+        self.logger.info(f"{cloud} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    Main().main()
@@ -0,0 +1,139 @@
+import time
+from typing import IO, Callable, Optional
+import numpy as np
+from utils import logger_mixin
+from ring_buffer import TimeSeriesRing
+from flight_recorder import RECORDER
+
+"""
+    Camera poses printed by the SLAM app, one per line, in TUM trajectory order optionally prefixed by a label and a
+    frame id:
+        [pose|keyframe] [frame_id] time tx ty tz qx qy qz qw
+    `time` is the timestamp of the frame the pose belongs to. When the app was fed through a frame channel that is the
+    capture time in seconds since the epoch, and the difference to the arrival time is the tracking lag.
+"""
+
+POSE_DTYPE = np.dtype([
+    ('timestamp', 'f8'),  # arrival time, seconds since the epoch
+    ('frame_time', 'f8'),  # timestamp of the tracked frame as reported by the app
+    ('frame', 'i8'),  # frame id, -1 if not reported
+    ('keyframe', '?'),
+    ('x', 'f4'),
+    ('y', 'f4'),
+    ('z', 'f4'),
+    ('qx', 'f4'),
+    ('qy', 'f4'),
+    ('qz', 'f4'),
+    ('qw', 'f4'),
+])
+
+POSE_LABELS = ('', 'pose', 'keyframe')
+EPOCH_THRESHOLD = 1e9  # frame times above this are wall-clock times, lag can be computed
+
+
+def is_number(token: str) -> bool:
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_pose(line: str) -> Optional[tuple]:
+    """
+        (keyframe, frame, frame_time, x, y, z, qx, qy, qz, qw), or None for a line that isn't a pose.
+    """
+    tokens = line.replace(',', ' ').replace(':', ' ').split()
+    label = []
+    while tokens and not is_number(tokens[0]):
+        label.append(tokens.pop(0).lower())
+    label = ' '.join(label)
+    if label not in POSE_LABELS or len(tokens) not in (8, 9) or not all(is_number(token) for token in tokens):
+        return None
+    numbers = [float(token) for token in tokens]
+    frame = int(numbers.pop(0)) if len(numbers) == 9 else -1
+    return (label == 'keyframe', frame, *numbers)
+
+
+class PoseStream(logger_mixin()):
+    """
+        Poses parsed from the SLAM app's output into a preallocated ring buffer (`pose_history` records), fed line by
+        line from a reader thread, so the latest pose and the recent trajectory are available without touching files.
+    """
+
+    def __init__(self, **kwargs):
+        self.buffer = TimeSeriesRing(POSE_DTYPE, int(kwargs.get('pose_history', 6000)))
+        self.max_age = float(kwargs.get('pose_max_age', 0.5))  # older poses are considered stale
+        self.keyframes = 0
+        self.lines = 0
+        self.row = np.zeros(1, dtype=POSE_DTYPE)[0]
+
+    def ingest(self, line: str, timestamp: Optional[float] = None) -> bool:
+        """
+            Parse one output line, returns whether it was a pose. Only called from a single thread.
+        """
+        self.lines += 1
+        pose = parse_pose(line)
+        if pose is None:
+            return False
+        row = self.row
+        row['timestamp'] = time.time() if timestamp is None else timestamp
+        (row['keyframe'], row['frame'], row['frame_time'], row['x'], row['y'], row['z'],
+         row['qx'], row['qy'], row['qz'], row['qw']) = pose
+        self.keyframes += int(pose[0])
+        self.buffer.append(row)
+        if RECORDER.enabled:
+            RECORDER.record_row('poses', row)
+        return True
+
+    def follow(self, output: IO[str], passthrough: Optional[Callable[[str], None]] = None):
+        """
+            Ingest `output` until it closes; lines that aren't poses go to `passthrough`.
+        """
+        for line in output:
+            if not self.ingest(line) and passthrough is not None:
+                passthrough(line)
+
+    def latest(self) -> Optional[np.void]:
+        return self.buffer.latest()
+
+    def fresh(self) -> Optional[np.void]:
+        """
+            The latest pose, or None if it is older than `pose_max_age` (e.g. tracking was lost).
+        """
+        latest = self.buffer.latest()
+        if latest is None or time.time() - latest['timestamp'] > self.max_age:
+            return None
+        return latest
+
+    def window(self, seconds: float) -> np.ndarray:
+        return self.buffer.window(seconds)
+
+    def between(self, start: float, end: float) -> np.ndarray:
+        return self.buffer.between(start, end)
+
+    def last(self, n: int) -> np.ndarray:
+        return self.buffer.last(n)
+
+    def fps(self, seconds: float = 2.) -> float:
+        """
+            Tracking rate over the last `seconds`.
+        """
+        poses = self.buffer.window(seconds)
+        if len(poses) < 2:
+            return 0.
+        return (len(poses) - 1) / max(1e-6, float(poses['timestamp'][-1] - poses['timestamp'][0]))
+
+    def lag(self, seconds: float = 2.) -> float:
+        """
+            Mean delay between capturing a frame and its pose arriving over the last `seconds`, NaN when the app
+            doesn't report capture times.
+        """
+        poses = self.buffer.window(seconds)
+        poses = poses[poses['frame_time'] > EPOCH_THRESHOLD]
+        if len(poses) == 0:
+            return float('nan')
+        return float(np.mean(poses['timestamp'] - poses['frame_time']))
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.buffer} keyframes={self.keyframes} fps={self.fps():.1f}>"
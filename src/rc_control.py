@@ -0,0 +1,105 @@
+import time
+from threading import Thread, Lock, Event
+from typing import Optional, Tuple
+from utils import logger_mixin, FLIGHT_LOG
+
+AXES = ('left_right', 'forward_backward', 'up_down', 'yaw')
+
+
+def clamp(value: int) -> int:
+    return max(-100, min(100, int(value)))
+
+
+class RCScheduler(logger_mixin()):
+    """
+        Streams `rc` packets at a fixed rate from the current stick state. Callers only update the state, the
+        scheduler thread sends it fire-and-forget every 1/`rc_rate` seconds, which also keeps the link alive so the
+        drone doesn't auto-land after 15 seconds without commands.
+        DroneController pauses it from land until the next takeoff is answered; while paused the sticks are neutral
+        and a neutral packet is still sent every `rc_keepalive` seconds.
+    """
+
+    def __init__(self, channel, **kwargs):
+        self.channel = channel
+        self.rate = min(50., max(1., float(kwargs.get('rc_rate', 20))))
+        self.keepalive = float(kwargs.get('rc_keepalive', 5.))
+        self.sticks = [0, 0, 0, 0]
+        self.lock = Lock()
+        self.paused = Event()
+        self.packets_sent = 0
+        self.late = 0  # ticks that missed their deadline
+        self.running = False
+        self.thread = None
+
+    def set(self, left_right: Optional[int] = None, forward_backward: Optional[int] = None,
+            up_down: Optional[int] = None, yaw: Optional[int] = None):
+        with self.lock:
+            for axis, value in enumerate((left_right, forward_backward, up_down, yaw)):
+                if value is not None:
+                    self.sticks[axis] = clamp(value)
+
+    def set_axis(self, axis: str, value: int):
+        with self.lock:
+            self.sticks[AXES.index(axis)] = clamp(value)
+
+    def neutral(self):
+        with self.lock:
+            self.sticks = [0, 0, 0, 0]
+
+    @property
+    def state(self) -> Tuple[int, int, int, int]:
+        with self.lock:
+            return tuple(self.sticks)
+
+    def start(self) -> "RCScheduler":
+        if self.running:
+            return self
+        self.running = True
+        self.thread = Thread(target=self.run, name="rc-scheduler", daemon=True)
+        self.thread.start()
+        return self
+
+    def pause(self):
+        self.neutral()
+        self.paused.set()
+
+    def resume(self):
+        self.paused.clear()
+
+    def run(self):
+        period = 1. / self.rate
+        deadline = time.perf_counter()
+        last_sent = 0.
+        while self.running:
+            now = time.perf_counter()
+            if not self.paused.is_set() or now - last_sent >= self.keepalive:
+                left_right, forward_backward, up_down, yaw = self.state
+                try:
+                    self.channel.send_nowait(f"rc {left_right} {forward_backward} {up_down} {yaw}")
+                    self.packets_sent += 1
+                    if FLIGHT_LOG.enabled:
+                        FLIGHT_LOG.record("rc tick", now - deadline, self.late)
+                except ConnectionError as e:
+                    self.logger.error(e)
+                last_sent = now
+            deadline += period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, don't burst to catch up
+                self.late += 1
+                deadline = time.perf_counter()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.neutral()
+            try:
+                self.channel.send_nowait("rc 0 0 0 0")
+            except ConnectionError:
+                pass
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: rate={self.rate}Hz sticks={self.state} sent={self.packets_sent}>"
@@ -0,0 +1,108 @@
+import time
+from threading import Lock
+from typing import Optional, Sequence, Tuple, Union
+import numpy as np
+
+
+class TimeSeriesRing:
+    """
+        Fixed-capacity ring of records in a preallocated NumPy structured array. The dtype must contain a float
+        `timestamp` field and records must be appended in non-decreasing timestamp order.
+        Queries return copies in chronological order, so callers never see a record being overwritten.
+    """
+
+    def __init__(self, dtype: Union[np.dtype, Sequence], capacity: int):
+        self.dtype = np.dtype(dtype)
+        if 'timestamp' not in self.dtype.names:
+            raise ValueError("time series dtype must have a 'timestamp' field")
+        self.capacity = int(capacity)
+        self.data = np.zeros(self.capacity, dtype=self.dtype)
+        self.count = 0  # total records ever appended
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def append(self, record: tuple):
+        """
+            Append a record given as a tuple in dtype field order.
+        """
+        with self.lock:
+            self.data[self.count % self.capacity] = record
+            self.count += 1
+
+    def extend(self, records: np.ndarray):
+        """
+            Append a batch of records of the ring's dtype.
+        """
+        records = records[-self.capacity:]
+        with self.lock:
+            indices = np.arange(self.count, self.count + len(records)) % self.capacity
+            self.data[indices] = records
+            self.count += len(records)
+
+    def append_fields(self, timestamp: float, **fields):
+        with self.lock:
+            index = self.count % self.capacity
+            self.data[index] = 0
+            self.data[index]['timestamp'] = timestamp
+            for key, val in fields.items():
+                self.data[index][key] = val
+            self.count += 1
+
+    def latest(self) -> Optional[np.void]:
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.data[(self.count - 1) % self.capacity].copy()
+
+    def _ordered(self) -> np.ndarray:
+        if self.count <= self.capacity:
+            return self.data[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+    def last(self, n: int) -> np.ndarray:
+        with self.lock:
+            n = min(n, len(self))
+            if n <= 0:
+                return self.data[:0].copy()
+            indices = np.arange(self.count - n, self.count) % self.capacity
+            return self.data[indices]
+
+    def since(self, count: int) -> Tuple[np.ndarray, int]:
+        """
+            The records appended after the first `count` (as many as are still kept) and the new total count, read
+            together so a consumer can follow the ring without skipping or repeating records.
+        """
+        with self.lock:
+            n = min(self.count - count, len(self))
+            if n <= 0:
+                return self.data[:0].copy(), self.count
+            indices = np.arange(self.count - n, self.count) % self.capacity
+            return self.data[indices], self.count
+
+    def history(self) -> np.ndarray:
+        with self.lock:
+            return self._ordered()
+
+    def between(self, start: float, end: float) -> np.ndarray:
+        with self.lock:
+            ordered = self._ordered()
+        timestamps = ordered['timestamp']
+        lo = np.searchsorted(timestamps, start, side='left')
+        hi = np.searchsorted(timestamps, end, side='right')
+        return ordered[lo:hi]
+
+    def window(self, seconds: float, now: Optional[float] = None) -> np.ndarray:
+        now = time.time() if now is None else now
+        return self.between(now - seconds, now)
+
+    def age(self, now: Optional[float] = None) -> float:
+        latest = self.latest()
+        if latest is None:
+            return float('inf')
+        return (time.time() if now is None else now) - float(latest['timestamp'])
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {len(self)}/{self.capacity} records, {self.count} total>"
@@ -0,0 +1,272 @@
+import os
+import random
+import socket
+import time
+from threading import Thread
+from typing import Iterator, Optional, Tuple
+from utils import logger_mixin, CommandLineParser, GLOBALS
+from h264_recorder import H264Reader, START_CODE
+
+"""
+    A local stand-in for the drone, for measuring the project without one. Point a DroneController at it with
+    e.g. DroneController(None, tello_address=('127.0.0.1', 8889), local_address=('127.0.0.1', 9000)).
+"""
+
+MAX_PAYLOAD = 1460  # the drone splits its video into datagrams of this size
+MOVE_COMMANDS = ('up', 'down', 'left', 'right', 'forward', 'back')
+ROTATE_COMMANDS = ('cw', 'ccw')
+
+
+class VideoSource(logger_mixin()):
+    """
+        Streams a recorded H.264 file to a UDP address. Recordings made by H264Recorder are replayed with their
+        original packet timing; a bare elementary stream is split into datagrams and paced at `fps`.
+    """
+
+    def __init__(self, path: str, address: Tuple[str, int], fps: float = 30, loop: bool = True):
+        self.path = path
+        self.address = address
+        self.fps = fps
+        self.loop = loop
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.packets_sent = 0
+        self.running = False
+        self.thread = None
+
+    def start(self) -> "VideoSource":
+        if self.running:
+            return self
+        self.running = True
+        self.thread = Thread(target=self.stream, args=(), daemon=True)
+        self.thread.start()
+        return self
+
+    def _recorded_packets(self) -> Iterator[Tuple[float, bytes]]:
+        return H264Reader(self.path).packets()
+
+    def _paced_packets(self) -> Iterator[Tuple[float, bytes]]:
+        with open(self.path, 'rb') as stream_file:
+            data = stream_file.read()
+        timestamp = 0.
+        start = data.find(START_CODE)
+        while start != -1:
+            end = data.find(START_CODE, start + 4)
+            nal = data[start:end if end != -1 else len(data)]
+            for position in range(0, len(nal), MAX_PAYLOAD):
+                yield timestamp, nal[position:position + MAX_PAYLOAD]
+            if nal[4] & 0x1f in (1, 5):  # a coded slice ends a frame on the drone's single slice stream
+                timestamp += 1. / self.fps
+            start = end
+
+    def stream(self):
+        recorded = os.path.exists(self.path + ".idx")
+        while self.running:
+            packets = self._recorded_packets() if recorded else self._paced_packets()
+            start_time = time.time()
+            first_timestamp = None
+            for timestamp, payload in packets:
+                if not self.running:
+                    return
+                first_timestamp = timestamp if first_timestamp is None else first_timestamp
+                delay = start_time + timestamp - first_timestamp - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.socket.sendto(payload, self.address)
+                self.packets_sent += 1
+            if not self.loop:
+                break
+        self.running = False
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+
+
+class TelloSimulator(logger_mixin()):
+    """
+        UDP command server answering like a drone in SDK mode, with configurable latency and packet loss.
+        Commands are handled in order, each one taking `sim_latency` (+- `sim_jitter`) plus, for moves and
+        rotations, the time the maneuver would take at `sim_speed` cm/s / `sim_yaw_rate` degrees/s.
+        Once a client sent `command` the state is broadcast to its `state_port`; `streamon` starts streaming
+        `sim_video` to its `video_port`.
+    """
+
+    def __init__(self, address: Tuple[str, int] = ('127.0.0.1', 8889), **kwargs):
+        self.address = address
+        self.latency = float(kwargs.get('sim_latency', 0.005))
+        self.jitter = float(kwargs.get('sim_jitter', 0.))
+        self.loss = float(kwargs.get('sim_loss', 0.))  # probability of dropping a command or its response
+        self.speed = float(kwargs.get('sim_speed', 100))
+        self.yaw_rate = float(kwargs.get('sim_yaw_rate', 90))
+        self.realtime_moves = kwargs.get('sim_realtime_moves', True)  # take as long as a real maneuver
+        self.video_path = kwargs.get('sim_video', None)
+        self.video_fps = float(kwargs.get('sim_video_fps', 30))
+        self.state_port = int(kwargs.get('state_port', 8890))
+        self.video_port = int(kwargs.get('video_port', 11111))
+        self.state_rate = float(kwargs.get('sim_state_rate', 10))
+        self.state = {'pitch': 0, 'roll': 0, 'yaw': 0, 'vgx': 0, 'vgy': 0, 'vgz': 0, 'templ': 60, 'temph': 62,
+                      'tof': 10, 'h': 0, 'bat': 100, 'baro': 0., 'time': 0, 'agx': 0., 'agy': 0., 'agz': -1000.}
+        self.speed_setting = 100
+        self.flying = False
+        self.client = None
+        self.video = None
+        self.commands_received = 0
+        self.commands_dropped = 0
+        self.socket = None
+        self.running = False
+        self.thread = Thread(target=self.serve, args=(), daemon=True)
+        self.state_thread = Thread(target=self.broadcast_state, args=(), daemon=True)
+
+    def start(self) -> "TelloSimulator":
+        if self.running:
+            return self
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(self.address)
+        self.address = self.socket.getsockname()
+        self.socket.settimeout(0.5)
+        self.running = True
+        self.thread.start()
+        self.state_thread.start()
+        return self
+
+    def serve(self):
+        while self.running:
+            try:
+                data, client = self.socket.recvfrom(1518)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.commands_received += 1
+            if random.random() < self.loss:
+                self.commands_dropped += 1
+                continue
+            cmd = data.decode(encoding="utf-8").strip()
+            response, duration = self.execute(cmd, client)
+            time.sleep(max(0., self.latency + random.uniform(-self.jitter, self.jitter) + duration))
+            if response is None:
+                continue
+            if random.random() < self.loss:
+                self.commands_dropped += 1
+                continue
+            self.socket.sendto(response.encode(encoding="utf-8"), client)
+
+    def execute(self, cmd: str, client: Tuple[str, int]) -> Tuple[Optional[str], float]:
+        """
+            Apply a command to the simulated drone, returns the response (None for none) and how long it takes.
+        """
+        name, *args = cmd.split()
+        if name == 'command':
+            self.client = client
+            return 'ok', 0.
+        if name == 'rc':
+            self.state['vgx'], self.state['vgy'], self.state['vgz'], _ = (int(x) // 10 for x in args)
+            return None, 0.
+        if name == 'takeoff':
+            self.flying = True
+            self.state['h'] = 80
+            return 'ok', 3. if self.realtime_moves else 0.
+        if name in ('land', 'emergency'):
+            self.flying = False
+            self.state['h'] = 0
+            return 'ok', (2. if self.realtime_moves and name == 'land' else 0.)
+        if name == 'streamon':
+            self._start_video(client)
+            return 'ok', 0.
+        if name == 'streamoff':
+            if self.video is not None:
+                self.video.stop()
+            return 'ok', 0.
+        if name in MOVE_COMMANDS or name in ROTATE_COMMANDS:
+            if not self.flying:
+                return 'error Not joystick', 0.
+            amount = int(args[0])
+            if name == 'up':
+                self.state['h'] += amount
+            elif name == 'down':
+                self.state['h'] = max(0, self.state['h'] - amount)
+            elif name in ROTATE_COMMANDS:
+                self.state['yaw'] = (self.state['yaw'] + (amount if name == 'cw' else -amount) + 180) % 360 - 180
+            rate = self.yaw_rate if name in ROTATE_COMMANDS else self.speed
+            return 'ok', amount / rate if self.realtime_moves else 0.
+        if name in ('go', 'curve', 'flip', 'wifi'):
+            return 'ok', 1. if self.realtime_moves else 0.
+        if name == 'speed':
+            self.speed_setting = int(args[0])
+            return 'ok', 0.
+        return self.query(name), 0.
+
+    def query(self, name: str) -> str:
+        state = self.state
+        responses = {
+            'speed?': f"{self.speed_setting}",
+            'battery?': f"{state['bat']}",
+            'time?': f"{state['time']}s",
+            'height?': f"{state['h'] // 10}dm",
+            'temp?': f"{state['templ']}~{state['temph']}C",
+            'attitude?': f"pitch:{state['pitch']};roll:{state['roll']};yaw:{state['yaw']};",
+            'baro?': f"{state['baro']}",
+            'acceleration?': f"agx:{state['agx']:.2f};agy:{state['agy']:.2f};agz:{state['agz']:.2f};",
+            'tof?': f"{state['tof'] * 10}mm",
+            'wifi?': "90",
+        }
+        return responses.get(name, "error")
+
+    def _start_video(self, client: Tuple[str, int]):
+        if self.video_path is None or (self.video is not None and self.video.running):
+            return
+        self.video = VideoSource(self.video_path, (client[0], self.video_port), self.video_fps).start()
+
+    def broadcast_state(self):
+        state_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        state_socket.bind((self.address[0], 0))  # broadcast from the drone's own address
+        started = time.time()
+        while self.running:
+            time.sleep(1. / self.state_rate)
+            if self.client is None:
+                continue
+            if self.flying:
+                self.state['time'] = int(time.time() - started)
+            packet = ''.join(f"{key}:{val};" for key, val in self.state.items()) + "\r\n"
+            state_socket.sendto(packet.encode(encoding="utf-8"), (self.client[0], self.state_port))
+        state_socket.close()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.state_thread.join()
+            self.socket.close()
+            if self.video is not None:
+                self.video.stop()
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: address={self.address} received={self.commands_received} "
+                f"dropped={self.commands_dropped}>")
+
+
+class Main(CommandLineParser):
+    """
+        Run a simulated drone until interrupted, e.g.
+        python3 simulator.py --port 8889 -D sim_video=recordings/stream_xxx.h264 sim_latency=0.02 sim_loss=0.01
+    """
+
+    def __init__(self):
+        super().__init__(prog="Tello simulator")
+        self.add_argument('--host', type=str, default='127.0.0.1')
+        self.add_argument('--port', type=int, default=8889)
+        self.parse_args()
+
+    def main(self):
+        simulator = TelloSimulator((self.args.host, self.args.port), **GLOBALS).start()
+        self.logger.info(f"simulating a drone on {simulator.address}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            simulator.stop()
+
+
+if __name__ == "__main__":
+    Main().main()
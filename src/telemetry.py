@@ -0,0 +1,138 @@
+import socket
+import time
+from threading import Thread
+from typing import Optional
+import numpy as np
+from utils import logger_mixin
+from ring_buffer import TimeSeriesRing
+from flight_recorder import RECORDER
+
+"""
+    Once in SDK mode the drone broadcasts its state to port 8890 about 10 times a second, e.g.:
+    mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:0;roll:0;yaw:0;vgx:0;vgy:0;vgz:0;templ:83;temph:85;tof:10;h:0;bat:80;
+    baro:-71.81;time:0;agx:-4.00;agy:1.00;agz:-999.00;
+    The mission pad fields (mid, x, y, z, mpry) only exist on SDK 2.0 firmware and are ignored.
+"""
+
+TELEMETRY_DTYPE = np.dtype([
+    ('timestamp', 'f8'),  # arrival time, seconds since the epoch
+    ('pitch', 'i2'),  # degrees
+    ('roll', 'i2'),
+    ('yaw', 'i2'),
+    ('vgx', 'i2'),  # speed, dm/s
+    ('vgy', 'i2'),
+    ('vgz', 'i2'),
+    ('templ', 'i2'),  # lowest/highest temperature, celsius
+    ('temph', 'i2'),
+    ('tof', 'i2'),  # time-of-flight distance, cm
+    ('h', 'i2'),  # height, cm
+    ('bat', 'i2'),  # battery, percent
+    ('baro', 'f4'),  # barometer, m
+    ('time', 'i4'),  # motors on time, s
+    ('agx', 'f4'),  # acceleration, 0.001g
+    ('agy', 'f4'),
+    ('agz', 'f4'),
+])
+
+TELEMETRY_FIELDS = TELEMETRY_DTYPE.names[1:]
+
+
+def parse_state(packet: str) -> dict:
+    state = {}
+    for item in packet.strip().split(';'):
+        key, sep, val = item.partition(':')
+        if sep and key in TELEMETRY_FIELDS:
+            state[key] = float(val)
+    return state
+
+
+class TelemetryReceiver(logger_mixin()):
+    """
+        Background listener for the drone's state broadcast. Every packet is parsed into a preallocated ring buffer,
+        so the latest state and recent history are available without any round trip on the command channel.
+        With no address the receiver has no socket of its own and is fed through `ingest` (see fleet.py, where
+        several drones broadcast to the same port).
+    """
+
+    def __init__(self, address: Optional[tuple] = ('', 8890), **kwargs):
+        self.address = address
+        self.buffer = TimeSeriesRing(TELEMETRY_DTYPE, int(kwargs.get('telemetry_history', 6000)))
+        self.max_age = float(kwargs.get('telemetry_max_age', 1.0))  # older samples are considered stale
+        self.socket = None
+        self.running = False
+        self.malformed = 0
+        self.row = np.zeros(1, dtype=TELEMETRY_DTYPE)[0]
+        self.thread = Thread(target=self.update_state, args=(), daemon=True)
+
+    def start(self) -> "TelemetryReceiver":
+        if self.running or self.address is None:
+            return self
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.settimeout(0.5)
+        self.running = True
+        self.thread.start()
+        return self
+
+    def update_state(self):
+        while self.running:
+            try:
+                data = self.socket.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self.running:
+                    self.logger.error(e)
+                break
+            self.ingest(data)
+
+    def ingest(self, data: bytes, timestamp: Optional[float] = None):
+        """
+            Parse one state packet into the buffer. Only called from a single thread.
+        """
+        try:
+            state = parse_state(data.decode(encoding="utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            self.malformed += 1
+            return
+        if not state:  # no known field, a zero row would read as a landed, empty drone
+            self.malformed += 1
+            return
+        row = self.row
+        row['timestamp'] = time.time() if timestamp is None else timestamp
+        for key in TELEMETRY_FIELDS:
+            row[key] = state.get(key, 0)
+        self.buffer.append(row)
+        if RECORDER.enabled:
+            RECORDER.record_row('telemetry', row)
+
+    def latest(self) -> Optional[np.void]:
+        return self.buffer.latest()
+
+    def fresh(self) -> Optional[np.void]:
+        """
+            The latest sample, or None if it is older than `telemetry_max_age`.
+        """
+        latest = self.buffer.latest()
+        if latest is None or time.time() - latest['timestamp'] > self.max_age:
+            return None
+        return latest
+
+    def window(self, seconds: float) -> np.ndarray:
+        return self.buffer.window(seconds)
+
+    def between(self, start: float, end: float) -> np.ndarray:
+        return self.buffer.between(start, end)
+
+    def last(self, n: int) -> np.ndarray:
+        return self.buffer.last(n)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.socket.close()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: address={self.address} {self.buffer}>"
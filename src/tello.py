@@ -1,8 +1,17 @@
 from enum import Enum
-from typing import NamedTuple, Any
+from concurrent.futures import Future
+from typing import NamedTuple, Any, List, Optional, Union
 from utils import logger_mixin, connect_wifi
+import re
 import socket
-from camera_stream import CameraStream
+import time
+from command_channel import CommandChannel
+from telemetry import TelemetryReceiver
+from pose_stream import PoseStream
+from odometry import DeadReckoning
+from mission import MissionPlanner, MissionRunner, MissionPlan, from_odometry
+from instrumentation import TRACER
+from rc_control import RCScheduler
 
 
 class Vec3D:
@@ -18,6 +27,16 @@ class IMU(NamedTuple):
     yaw: int
 
 
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+def parse_numbers(response: str) -> List[int]:
+    """
+        Extract the numbers from a query response, e.g. "pitch:0;roll:-2;yaw:45;" or "-4.00 1.00 -999.00".
+    """
+    return [int(float(x)) for x in NUMBER_PATTERN.findall(response)]
+
+
 class TelloResponse(Enum):
     OK = 0
     ERROR = 1
@@ -33,17 +52,56 @@ class DroneController(logger_mixin()):
     LOCAL_ADDRESS = ('', 9000)
     VS_UDP_IP = '0.0.0.0'
     VS_UDP_PORT = 11111
-
-    def __init__(self, ssid: str, **kwargs):
-        if not connect_wifi(ssid):
-            raise OSError(f"Failed to connect to wifi {ssid}")
+    STATE_ADDRESS = ('', 8890)
+
+    def __init__(self, ssid: Optional[str], **kwargs):
+        """
+            The class addresses can be overridden per instance (tello_address, local_address, vs_udp_port,
+            state_address), e.g. to talk to a local simulator.TelloSimulator. Without an ssid the wifi is left alone.
+            Commands run on the shared default event loop unless an `event_loop` (EventLoopThread) is given.
+            The video modules (OpenCV) are only imported once the stream or the recorder is used.
+        """
+        self.TELLO_ADDRESS = tuple(kwargs.get('tello_address', self.TELLO_ADDRESS))
+        self.LOCAL_ADDRESS = tuple(kwargs.get('local_address', self.LOCAL_ADDRESS))
+        self.VS_UDP_PORT = int(kwargs.get('vs_udp_port', self.VS_UDP_PORT))
+        state_address = kwargs.get('state_address', self.STATE_ADDRESS)
+        self.STATE_ADDRESS = None if state_address is None else tuple(state_address)
+        if ssid:
+            self.connect(ssid)
         self.udp_address = 'udp://@' + self.VS_UDP_IP + ':' + str(self.VS_UDP_PORT)
         self.armed = False
         self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.stream = CameraStream(self.udp_address, **kwargs)
+        self.channel = CommandChannel(self.TELLO_ADDRESS, kwargs.get('event_loop'), **kwargs)
+        self.blocking = kwargs.get('blocking_commands', True)  # wait for the drone's response on every command
+        self.rc = RCScheduler(self.channel, **kwargs)  # continuous rc stream, started on demand
+        self.recorder = None
+        if kwargs.get('record_stream', False):
+            # the recorder owns the video port, the decoders read what it forwards
+            from h264_recorder import H264Recorder
+            self.recorder = H264Recorder((self.VS_UDP_IP, self.VS_UDP_PORT), **kwargs)
+            self.udp_address = self.recorder.forward_url
+        self.options = kwargs
+        self._stream = None
+        self.telemetry = TelemetryReceiver(self.STATE_ADDRESS, **kwargs)
+        self.poses = PoseStream(**kwargs)  # filled by an LSDSlamSystem started with poses=drone.poses
+        self.odometry = DeadReckoning(self.telemetry, **kwargs)
         self.is_flying = False
         self.is_streaming = False
 
+    @property
+    def stream(self):
+        if self._stream is None:
+            from camera_stream import CameraStream
+            self._stream = CameraStream(self.udp_address, **self.options)
+        return self._stream
+
+    def connect(self, ssid: str):
+        """
+            Join the drone's wifi, unless already on it.
+        """
+        if not connect_wifi(ssid):
+            raise OSError(f"Failed to connect to wifi {ssid}")
+
     def help(self):
         print('\n'.join(self.__dict__.keys()))
 
@@ -51,15 +109,18 @@ class DroneController(logger_mixin()):
         self.armed = True
         self.logger.debug("Binding sockets")
         self.command_socket.bind(self.LOCAL_ADDRESS)
+        self.channel.open(self.command_socket)
         self.logger.debug("Arming...")
-        self._send_command("command")
+        self._send_command("command", wait=True)
+        self.telemetry.start()
+        self.odometry.start()
         return self
 
     def streamon(self):
         if self.is_streaming:
             return
         self.is_streaming = True
-        self._send_command("streamon")
+        self._send_command("streamon", wait=True)
 
     def capture_stream(self, show_cam=False):
         if not self.is_streaming:
@@ -67,27 +128,57 @@ class DroneController(logger_mixin()):
         self.stream.show_cam = show_cam
         self.stream.start()
 
+    def record_stream(self):
+        """
+            Start writing the raw video stream to disk, see h264_recorder.H264Recorder.
+        """
+        if self.recorder is None:
+            raise ValueError("stream recording is off, construct with record_stream=True")
+        if not self.is_streaming:
+            self.streamon()
+        self.recorder.start()
+
     def streamoff(self):
         if not self.is_streaming:
             return
         self.is_streaming = False
-        self._send_command("streamoff")
-        self.stream.stop()
+        self._send_command("streamoff", wait=True)
+        if self._stream is not None:
+            self._stream.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
 
     def shutdown(self):
+        self.odometry.stop()
+        self.telemetry.stop()
+        self.channel.close()
         self.command_socket.close()
 
-    def takeoff(self):
+    def takeoff(self, wait: Optional[bool] = None):
         if self.is_flying:
             return
         self.is_flying = True
-        self._send_command("takeoff")
-
-    def land(self):
-        self._send_command("land")
+        self.odometry.reset()  # positions are relative to the takeoff spot
+        self.rc.pause()  # neutral sticks until the drone is up
+        result = self._send_command("takeoff", wait=wait)
+        if isinstance(result, Future):
+            result.add_done_callback(self._after_takeoff)
+        else:
+            self._after_takeoff()
+        return result
+
+    def _after_takeoff(self, _=None):
+        if self.is_flying:  # not landed meanwhile, which also cancels a takeoff still queued
+            self.rc.resume()
+
+    def land(self, wait: Optional[bool] = None):
+        self.is_flying = False  # so the next takeoff goes out, and end() doesn't land again
+        self.rc.pause()  # until the next takeoff
+        return self._send_command("land", wait=wait)
 
     def emergency(self):
-        self._send_command("emergency")
+        self.is_flying = False
+        return self._send_command("emergency")
 
     class MoveControl:
         def __init__(self, drone: "DroneController"):
@@ -96,32 +187,32 @@ class DroneController(logger_mixin()):
         def up(self, x: int):
             if x < 20 or x > 500:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"up {x}")
+            return self.drone._send_command(f"up {x}")
 
         def down(self, x: int):
             if x < 20 or x > 500:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"down {x}")
+            return self.drone._send_command(f"down {x}")
 
         def left(self, x: int):
             if x < 20 or x > 500:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"left {x}")
+            return self.drone._send_command(f"left {x}")
 
         def right(self, x: int):
             if x < 20 or x > 500:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"right {x}")
+            return self.drone._send_command(f"right {x}")
 
         def forward(self, x: int):
             if x < 20 or x > 500:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"forward {x}")
+            return self.drone._send_command(f"forward {x}")
 
         def back(self, x: int):
             if x < 20 or x > 500:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"back {x}")
+            return self.drone._send_command(f"back {x}")
 
     @property
     def move(self):
@@ -134,12 +225,12 @@ class DroneController(logger_mixin()):
         def cw(self, x: int):
             if x < 1 or x > 3600:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"cw {x}")
+            return self.drone._send_command(f"cw {x}")
 
         def ccw(self, x: int):
             if x < 1 or x > 3600:
                 raise ValueError(f"Illegal value: {x}")
-            self.drone._send_command(f"ccw {x}")
+            return self.drone._send_command(f"ccw {x}")
 
     @property
     def rotate(self):
@@ -150,80 +241,161 @@ class DroneController(logger_mixin()):
             self.drone = drone
 
         def back(self):
-            self._flip('b')
+            return self._flip('b')
 
         def right(self):
-            self._flip('r')
+            return self._flip('r')
 
         def left(self):
-            self._flip('l')
+            return self._flip('l')
 
         def forward(self):
-            self._flip('f')
+            return self._flip('f')
 
         def _flip(self, direction: str):
-            self.drone._send_command(f"flip {direction}")
+            return self.drone._send_command(f"flip {direction}")
 
     @property
     def flip(self):
         return DroneController.FlipControl(self)
 
     def go(self, p: Vec3D, speed: int):
-        self._send_command(f"go {p.x} {p.y} {p.z} {speed}")
+        return self._send_command(f"go {p.x} {p.y} {p.z} {speed}")
 
     def curve(self, p1: Vec3D, p2: Vec3D, speed: int):
-        self._send_command(f"curve {p1.x} {p2.x} {p1.y} {p2.y} {p1.z} {p2.z} {speed}")
+        return self._send_command(f"curve {p1.x} {p1.y} {p1.z} {p2.x} {p2.y} {p2.z} {speed}")
+
+    def fly_mission(self, waypoints, **kwargs) -> MissionPlan:
+        """
+            Plan and fly through `waypoints` ((x, y, z) in cm from the takeoff spot, see mission.py), starting from
+            the dead-reckoned position. Options override the controller's (mission_speed, mission_reorder...).
+        """
+        options = dict(self.options, **kwargs)
+        start = from_odometry(self.odometry.current_position(extrapolate=False))
+        plan = MissionPlanner(**options).plan(waypoints, start)
+        self.logger.info(f"flying {plan}")
+        MissionRunner(self.channel, **options).run(plan)
+        return plan
 
     def set_speed(self, x: int):
-        self._send_command(f"speed {x}")
+        return self._send_command(f"speed {x}")
 
     def set_rc(self, left_right: int, forward_backward: int, up_down: int, yaw: int):
-        self._send_command(f"rc {left_right} {forward_backward} {up_down} {yaw}")
+        return self._send_command(f"rc {left_right} {forward_backward} {up_down} {yaw}")
 
     def set_wifi_ssid(self, ssid: int, password: str):
-        self._send_command(f"wifi {ssid} {password}")
+        return self._send_command(f"wifi {ssid} {password}")
 
     def get_speed(self) -> int:
-        return int(self._send_command("speed?"))
+        return int(self._send_command("speed?", wait=True))
+
+    def state(self):
+        """
+            The latest broadcast state sample (see telemetry.TELEMETRY_DTYPE), or None if there is no fresh one.
+        """
+        return self.telemetry.fresh()
+
+    def latest_pose(self):
+        """
+            The latest SLAM pose (see pose_stream.POSE_DTYPE), or None if there is no fresh one.
+        """
+        return self.poses.fresh()
+
+    def pose_history(self, seconds: float):
+        return self.poses.window(seconds)
+
+    def current_position(self):
+        """
+            Dead-reckoned (x, y, z) in cm from the takeoff spot, see odometry.DeadReckoning.
+        """
+        return self.odometry.current_position()
+
+    def _query(self, cmd: str, count: int = 1) -> List[int]:
+        """
+            The numbers of a query's response, raises ValueError if the query failed (timeout, error response) or
+            answered fewer than `count` numbers.
+        """
+        response = self._send_command(cmd, wait=True)
+        numbers = parse_numbers(response) if isinstance(response, str) else []
+        if len(numbers) < count:
+            raise ValueError(f"'{cmd}' failed: {response!r}")
+        return numbers
 
     def get_battery(self) -> int:
+        state = self.state()
+        if state is not None:
+            return int(state['bat'])
         try:
-            return int(self._send_command("battery?"))
+            return self._query("battery?")[0]
         except ValueError:
             return 0
 
     def get_time(self) -> int:
-        return int(self._send_command("time?"))
+        state = self.state()
+        if state is not None:
+            return int(state['time'])
+        return self._query("time?")[0]
 
     def get_height(self) -> int:
-        return int(self._send_command("height?"))
+        """
+            height in cm
+        """
+        state = self.state()
+        if state is not None:
+            return int(state['h'])
+        return self._query("height?")[0] * 10
 
     def get_temp(self) -> int:
-        return int(self._send_command("temp?"))
+        state = self.state()
+        if state is not None:
+            return (int(state['templ']) + int(state['temph'])) // 2
+        return int(sum(self._query("temp?", 2)[:2]) / 2)
 
     def get_attitude(self) -> IMU:
-        return IMU(int(x) for x in self._send_command("attitude?").split())
+        state = self.state()
+        if state is not None:
+            return IMU(int(state['pitch']), int(state['roll']), int(state['yaw']))
+        return IMU(*self._query("attitude?", 3)[:3])
 
     def get_barometric(self) -> int:
-        return int(self._send_command("baro?"))
+        state = self.state()
+        if state is not None:
+            return int(state['baro'])
+        return self._query("baro?")[0]
 
     def get_acceleration(self) -> Vec3D:
-        return Vec3D(int(x) for x in self._send_command("acceleration?").split())
+        state = self.state()
+        if state is not None:
+            return Vec3D(int(state['agx']), int(state['agy']), int(state['agz']))
+        return Vec3D(*self._query("acceleration?", 3)[:3])
 
     def get_tof(self) -> int:
-        return self._send_command("tof?")
+        """
+            distance from the time-of-flight sensor in cm
+        """
+        state = self.state()
+        if state is not None:
+            return int(state['tof'])
+        return self._query("tof?")[0] // 10
 
     def get_wifi(self) -> TelloResponse:
-        return TelloResponse.OK if self._send_command("wifi?") == "ok" else TelloResponse.ERROR
-
-    def _send_command(self, cmd: str, timeout: float = 20) -> Any:
-        self.logger.debug(cmd)
-        self.command_socket.sendto(cmd.encode(encoding="utf-8"), self.TELLO_ADDRESS)
+        return TelloResponse.OK if self._send_command("wifi?", wait=True) == "ok" else TelloResponse.ERROR
+
+    def _send_command(self, cmd: str, timeout: Optional[float] = None, wait: Optional[bool] = None,
+                      retries: Optional[int] = None) -> Union[Any, Future]:
+        """
+            Queue a command on the command channel. Blocks for the response unless `wait` (default: the controller's
+            `blocking` mode) is off, in which case the pending future is returned.
+        """
+        start = time.perf_counter() if TRACER.enabled else 0
+        future = self.channel.submit(cmd, timeout, retries)
+        if not (self.blocking if wait is None else wait):
+            return future
         data = 0
         try:
-            self.command_socket.settimeout(timeout)
-            data = self.command_socket.recvfrom(1518)[0].decode(encoding="utf-8")
-            self.logger.debug(data)
+            data = future.result()
+            if TRACER.enabled:
+                TRACER.record('command.round_trip', start)
         except socket.timeout as e:
             raise e
         except Exception as e:
@@ -232,11 +404,15 @@ class DroneController(logger_mixin()):
 
     def end(self):
         self.logger.info("shutting down")
-        self.stream.stop()
+        self.rc.stop()
+        if self._stream is not None:
+            self._stream.stop()
         if self.is_flying:
             self.land()
         if self.is_streaming:
             self.streamoff()
+        self.odometry.stop()
+        self.telemetry.stop()
 
     def __repr__(self):
         return (f"<{self.__class__.__name__}: address={self.udp_address} armed={self.armed} "
@@ -1,10 +1,17 @@
 import sys
+import atexit
 import logging
+import queue
+import subprocess
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock, Thread
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from argparse import ArgumentParser, Namespace
 from ast import literal_eval
 import re
 from uuid import uuid4
+import numpy as np
 
 
 def revers_dict(d: Dict[Any, Any]) -> Dict[Any, Any]:
@@ -49,18 +56,56 @@ def set_all_loggers(fn: Callable[[logging.Logger], None]):
         fn(logger)
 
 
+class DeferredQueueHandler(QueueHandler):
+    """
+        Hands records to the log writer thread as they are: the message is only formatted (msg % args) over there,
+        so pass arguments instead of building f-strings, e.g. logger.debug("sent %s", cmd).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class LogWriter(logging.Handler):
+    """
+        Formats and writes the queued records on the listener thread, each with its logger's format.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.formatters: Dict[str, logging.Formatter] = {}
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            formatter = self.formatters.get(record.name) or self.formatter or logging.Formatter()
+            self.stream.write(formatter.format(record) + '\n')
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+__log_queue__ = queue.SimpleQueue()
+__log_writer__ = LogWriter()
+__log_listener__ = QueueListener(__log_queue__, __log_writer__)
+__log_listener__.start()
+atexit.register(__log_listener__.stop)  # writes out whatever is still queued
+
+
 def generate_logger(name: str = "", level: Union[str, int] = 'info',
                     format: str = '%(asctime)s - %(filename)s@%(lineno)d: %(message)s') -> logging.Logger:
+    """
+        Loggers write through a queue to a single background writer, so logging never blocks on the terminal.
+    """
+    name = name or __file__ + "_logger"
     logger = __generated_loggers__.get(name, None)
     if logger is not None:
         return logger
     try:
         level = __logging_level__(level) if level else __default_log_level__
-        name = name or __file__ + "_logger"
         logger = logging.getLogger(name)
-        handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter(format))
-        logger.addHandler(handler)
+        __log_writer__.formatters[name] = logging.Formatter(format)
+        logger.addHandler(DeferredQueueHandler(__log_queue__))
         logger.setLevel(level)
         __generated_loggers__[name] = logger
         return logger
@@ -69,13 +114,17 @@ def generate_logger(name: str = "", level: Union[str, int] = 'info',
 
 
 def logger_mixin(*args, **kwargs):
-    name = kwargs.get('name', None)
+    name = kwargs.pop('name', None)
+    loggers = {}  # per class, resolved once
 
     class LoggerMixin:
         @property
-        def logger(self):
-            logger_name = name or self.__class__.__name__ + "_logger"
-            return generate_logger(logger_name, *args, **kwargs)
+        def logger(self) -> logging.Logger:
+            logger = loggers.get(self.__class__)
+            if logger is None:
+                logger = loggers[self.__class__] = generate_logger(name or self.__class__.__name__ + "_logger",
+                                                                   *args, **kwargs)
+            return logger
 
     return LoggerMixin
 
@@ -92,6 +141,110 @@ def update_global(key: str, val: Any, override: bool):
 
 RUN_ID = uuid4()
 
+FLIGHT_LOG_DTYPE = np.dtype([
+    ('time', '<f8'),  # seconds since the log was opened (time.perf_counter based)
+    ('event', '<u2'),  # index into the event names
+    ('reserved', '<u2'),
+    ('values', '<f4', (4,)),  # event specific
+])
+
+
+class FlightLog(logger_mixin()):
+    """
+        Compact binary log for high-rate events (command sends and acks, rc packets, decoded frames) that would
+        swamp a text log. Records are FLIGHT_LOG_DTYPE, written to `path` in blocks by a background thread; the event
+        names are kept in `path`.events, one per line, the line number being the event id.
+        Closed by default, `record` then only costs an attribute check.
+    """
+
+    def __init__(self, block: int = 4096):
+        self.enabled = False
+        self.block = block
+        self.path = None
+        self.events: Dict[str, int] = {}
+        self.buffer = np.zeros(block, dtype=FLIGHT_LOG_DTYPE)
+        self.count = 0
+        self.origin = 0.
+        self.started = 0.
+        self.lock = Lock()
+        self.blocks = queue.SimpleQueue()
+        self.thread = None
+
+    def open(self, path: str) -> "FlightLog":
+        if self.enabled:
+            return self
+        self.path = path
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        open(path, 'wb').close()
+        with open(path + ".events", 'w') as events_file:
+            events_file.write(f"# started {self.started}\n")
+        self.thread = Thread(target=self._write, name="flight-log", daemon=True)
+        self.thread.start()
+        self.enabled = True
+        atexit.register(self.close)
+        return self
+
+    def _event_id(self, event: str) -> int:
+        event_id = self.events.get(event)
+        if event_id is None:
+            event_id = self.events[event] = len(self.events)
+            self.blocks.put(event)
+        return event_id
+
+    def record(self, event: str, a: float = 0., b: float = 0., c: float = 0., d: float = 0.):
+        if not self.enabled:
+            return
+        now = time.perf_counter() - self.origin
+        with self.lock:
+            row = self.buffer[self.count]
+            row['time'] = now
+            row['event'] = self._event_id(event)
+            row['values'] = (a, b, c, d)
+            self.count += 1
+            if self.count == self.block:
+                self._flush()
+
+    def _flush(self):
+        if self.count:
+            self.blocks.put(self.buffer[:self.count])
+            self.buffer = np.zeros(self.block, dtype=FLIGHT_LOG_DTYPE)
+            self.count = 0
+
+    def _write(self):
+        with open(self.path, 'ab') as log_file, open(self.path + ".events", 'a') as events_file:
+            while True:
+                item = self.blocks.get()
+                if item is None:
+                    break
+                if isinstance(item, str):
+                    events_file.write(item + '\n')
+                    events_file.flush()
+                else:
+                    item.tofile(log_file)
+                    log_file.flush()
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        with self.lock:
+            self._flush()
+        self.blocks.put(None)
+        self.thread.join()
+
+    @staticmethod
+    def read(path: str) -> Tuple[np.ndarray, List[str]]:
+        """
+            (records, event names) of a written log.
+        """
+        with open(path + ".events") as events_file:
+            names = [line.rstrip('\n') for line in events_file if not line.startswith('#')]
+        return np.fromfile(path, dtype=FLIGHT_LOG_DTYPE), names
+
+
+FLIGHT_LOG = FlightLog()
+
 
 class CommandLineParser(ArgumentParser, logger_mixin()):
     __DEFINES_PATTERNS__ = re.compile("([\w_][\w_\d]*)(=(.*))?")
@@ -139,7 +292,36 @@ class CommandLineParser(ArgumentParser, logger_mixin()):
         return args
 
 
+def current_wifi_ssid() -> Optional[str]:
+    """
+        The network the machine is associated with, None if unknown.
+    """
+    try:
+        if sys.platform == 'linux':
+            output = subprocess.run(['iwgetid', '-r'], capture_output=True, text=True, timeout=2).stdout.strip()
+            if output:
+                return output
+            output = subprocess.run(['nmcli', '-t', '-f', 'active,ssid', 'dev', 'wifi'], capture_output=True,
+                                    text=True, timeout=2).stdout
+            return next((line[4:] for line in output.splitlines() if line.startswith('yes:')), None)
+        elif sys.platform == 'win32' or sys.platform == 'cygwin':
+            output = subprocess.run(['netsh', 'wlan', 'show', 'interfaces'], capture_output=True, text=True,
+                                    timeout=2).stdout
+            return next((line.split(':', 1)[1].strip() for line in output.splitlines()
+                         if line.strip().startswith('SSID')), None)
+        elif sys.platform == 'darwin':
+            output = subprocess.run(['networksetup', '-getairportnetwork', 'en0'], capture_output=True, text=True,
+                                    timeout=2).stdout
+            return output.split(': ', 1)[1].strip() if ': ' in output else None
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return None
+
+
 def connect_wifi(ssid: str, password: Optional[str] = None) -> bool:
+    if current_wifi_ssid() == ssid:
+        UTIL_LOGGER.debug(f"already connected to {ssid}")
+        return True
     UTIL_LOGGER.debug(f"connecting to {ssid}")
     if sys.platform == 'linux':
         from wireless import Wireless
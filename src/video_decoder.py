@@ -0,0 +1,273 @@
+import re
+import socket
+import time
+from collections import deque
+from threading import Thread, Condition
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+from utils import logger_mixin
+
+"""
+    Decoder backends of CameraStream, picked with the `video_decoder` option. Both split reading a frame like
+    cv2.VideoCapture does: `grab` takes the next frame, `retrieve` converts it to BGR (into a given array if it fits).
+        opencv  cv2.VideoCapture with FFmpeg's defaults: it probes the stream and buffers input before the first frame
+        pyav    reads the UDP socket itself and parses the raw H.264 into an FFmpeg decoder through PyAV, without
+                probing or input buffering, with the low-delay flags and threaded decoding. Other devices (files)
+                are demuxed with av.open and the same decoder settings.
+    After each grab/retrieve, `wait_time` is how long grab blocked for the frame (s), `decode_time` how long the
+    frame took to decode and convert once its data was there, and `queue_depth` how much was waiting behind it:
+    datagrams received but not yet decoded for pyav, -1 (unknown) for opencv. VideoCapture receives and decodes
+    inside grab, so opencv's wait includes its decoding and its decode_time is the conversion in retrieve only.
+"""
+
+OPENCV = 'opencv'
+PYAV = 'pyav'
+DECODERS = (OPENCV, PYAV)
+UDP_URL = re.compile(r"^udp://@?([^:/]*):(\d+)")
+
+
+class OpenCVDecoder(logger_mixin()):
+    """
+        cv2.VideoCapture as it always was.
+    """
+
+    def __init__(self, device: str, **kwargs):
+        self.device = device
+        self.capture = cv2.VideoCapture()
+        self.wait_time = 0.
+        self.decode_time = 0.
+        self.queue_depth = -1
+        self.dropped = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.capture.isOpened()
+
+    def open(self):
+        if not self.capture.isOpened():
+            self.capture.open(self.device)
+
+    def grab(self) -> bool:
+        start = time.perf_counter()
+        grabbed = self.capture.grab()
+        self.wait_time = time.perf_counter() - start
+        self.decode_time = 0.
+        return grabbed
+
+    def retrieve(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        start = time.perf_counter()
+        retrieved, frame = self.capture.retrieve(out) if out is not None else self.capture.retrieve()
+        self.decode_time += time.perf_counter() - start
+        return retrieved, frame
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def interrupt(self):
+        pass  # VideoCapture can't be woken up from another thread, grab returns with the next packet
+
+    def close(self):
+        self.capture.release()
+
+
+class PyAVDecoder(logger_mixin()):
+    """
+        Packet-level decoder. A receiver thread drains the socket into a packet queue as datagrams arrive, a decoder
+        thread parses and decodes whatever is queued and keeps the last `decoder_queue` frames (default 2, older ones
+        are dropped) for `grab`.
+        Options: decoder_threads (FFmpeg decoding threads, default 2, 0 lets FFmpeg decide), decoder_thread_type
+        (slice, the default, splits each frame across the threads and keeps the low-delay flag; frame decodes several
+        frames at once, which FFmpeg only allows without the low-delay flag and costs a frame of delay per thread),
+        decoder_socket_buffer (SO_RCVBUF, default 1MB).
+    """
+
+    def __init__(self, device: str, **kwargs):
+        self.device = device
+        self.threads = int(kwargs.get('decoder_threads', 2))
+        self.thread_type = kwargs.get('decoder_thread_type', 'slice').upper()
+        self.max_frames = max(1, int(kwargs.get('decoder_queue', 2)))
+        self.socket_buffer = int(kwargs.get('decoder_socket_buffer', 1 << 20))
+        self.packets = deque()  # raw datagrams waiting for the decoder
+        self.frames = deque()  # (av.VideoFrame, decode time, queue depth)
+        self.condition = Condition()
+        self.current = None
+        self.wait_time = 0.
+        self.decode_time = 0.
+        self.queue_depth = 0
+        self.dropped = 0  # decoded frames nobody grabbed in time
+        self.errors = 0
+        self.running = False
+        self.finished = False  # the input ended or failed, no more frames will come
+        self.interrupted = False
+        self.socket = None
+        self.threads_started = []
+
+    @property
+    def is_open(self) -> bool:
+        with self.condition:
+            return self.running and not (self.finished and not self.frames)
+
+    def _configure(self, codec):
+        from av.codec.context import Flags, Flags2
+        codec.thread_type = self.thread_type
+        codec.thread_count = self.threads
+        if self.thread_type == 'SLICE':
+            codec.flags |= Flags.low_delay
+        codec.flags2 |= Flags2.fast
+
+    def open(self):
+        if self.running:
+            return
+        import av  # optional dependency, only needed by this backend
+        self.running = True
+        self.finished = False
+        self.interrupted = False
+        url = UDP_URL.match(self.device)
+        if url is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer)
+            self.socket.bind((url.group(1), int(url.group(2))))
+            self.socket.settimeout(0.5)
+            codec = av.CodecContext.create('h264', 'r')
+            self._configure(codec)
+            self.threads_started = [Thread(target=self._receive, name="decoder-receive", daemon=True),
+                                    Thread(target=self._decode_packets, args=(codec,), name="decoder", daemon=True)]
+        else:
+            container = av.open(self.device)
+            self._configure(container.streams.video[0].codec_context)
+            self.threads_started = [Thread(target=self._decode_container, args=(container,), name="decoder",
+                                           daemon=True)]
+        for thread in self.threads_started:
+            thread.start()
+
+    def _receive(self):
+        while self.running:
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self.condition:
+                self.packets.append(data)
+                self.condition.notify_all()
+
+    def _push(self, frame, decode_time: float, queue_depth: int):
+        with self.condition:
+            if len(self.frames) == self.max_frames:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append((frame, decode_time, queue_depth))
+            self.condition.notify_all()
+
+    def _decode_packets(self, codec):
+        import av
+        while self.running:
+            with self.condition:
+                while self.running and not self.packets:
+                    self.condition.wait(0.5)
+                if not self.running:
+                    break
+                data = b''.join(self.packets)
+                depth = len(self.packets)
+                self.packets.clear()
+            start = time.perf_counter()
+            try:
+                for packet in codec.parse(data):
+                    for frame in codec.decode(packet):
+                        now = time.perf_counter()
+                        self._push(frame, now - start, depth)
+                        start = now
+            except av.FFmpegError as e:
+                # typically data before the first keyframe
+                self.errors += 1
+                self.logger.debug("decoding failed: %s", e)
+
+    def _decode_container(self, container):
+        import av
+        try:
+            stream = container.streams.video[0]
+            start = time.perf_counter()
+            for packet in container.demux(stream):
+                if not self.running:
+                    break
+                try:
+                    for frame in packet.decode():
+                        now = time.perf_counter()
+                        self._push(frame, now - start, 0)
+                        start = now
+                except av.FFmpegError as e:
+                    self.errors += 1
+                    self.logger.debug("decoding failed: %s", e)
+                # a file is read as fast as it is consumed, not faster
+                with self.condition:
+                    while self.running and len(self.frames) >= self.max_frames:
+                        self.condition.wait(0.5)
+                start = time.perf_counter()
+        finally:
+            container.close()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def grab(self) -> bool:
+        start = time.perf_counter()
+        with self.condition:
+            while not self.frames and self.running and not self.finished and not self.interrupted:
+                self.condition.wait(0.5)
+            self.wait_time = time.perf_counter() - start
+            if not self.frames:
+                return False
+            self.current, self.decode_time, self.queue_depth = self.frames.popleft()
+            self.condition.notify_all()
+            return True
+
+    def retrieve(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        if self.current is None:
+            return False, None
+        start = time.perf_counter()
+        image = self.current.to_ndarray(format='bgr24')
+        if out is not None and out.shape == image.shape:
+            np.copyto(out, image)
+            image = out
+        self.decode_time += time.perf_counter() - start
+        return True, image
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def interrupt(self):
+        with self.condition:
+            self.interrupted = True
+            self.condition.notify_all()
+
+    def close(self):
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads_started:
+            thread.join()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.device} {self.thread_type.lower()} x{self.threads} "
+                f"dropped={self.dropped} errors={self.errors}>")
+
+
+def make_decoder(device: str, **kwargs):
+    decoder = kwargs.get('video_decoder', OPENCV)
+    if decoder == OPENCV:
+        return OpenCVDecoder(device, **kwargs)
+    if decoder == PYAV:
+        return PyAVDecoder(device, **kwargs)
+    raise ValueError(f"Unknown video decoder: {decoder}")
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from command_channel import CommandCancelled, CommandScheduler, PendingCommand  # noqa: E402
+
+
+class CommandSchedulerTest(unittest.TestCase):
+    def schedule(self, commands):
+        async def run():
+            loop = asyncio.get_running_loop()
+            scheduler = CommandScheduler()
+            for command in commands:
+                await scheduler.put(PendingCommand(command, 1., 0, loop.create_future()))
+            return [(await scheduler.get()).command for _ in range(scheduler.size)]
+        return asyncio.run(run())
+
+    def test_setters_merge_into_the_newest_command(self):
+        self.assertEqual(self.schedule(['speed 50', 'speed 20', 'forward 100']), ['speed 20', 'forward 100'])
+
+    def test_setters_do_not_move_past_flight_commands(self):
+        self.assertEqual(self.schedule(['speed 50', 'forward 100', 'speed 20']),
+                         ['speed 50', 'forward 100', 'speed 20'])
+
+    def test_safety_commands_cancel_queued_flight_commands(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            scheduler = CommandScheduler()
+            pending = [PendingCommand(command, 1., 0, loop.create_future())
+                       for command in ('takeoff', 'forward 100', 'battery?', 'land')]
+            for command in pending:
+                await scheduler.put(command)
+            sent = [(await scheduler.get()).command for _ in range(scheduler.size)]
+            return sent, pending[0].future.exception(), pending[1].future.exception()
+        sent, takeoff, forward = asyncio.run(run())
+        self.assertEqual(sent, ['land', 'battery?'])
+        self.assertIsInstance(takeoff, CommandCancelled)
+        self.assertIsInstance(forward, CommandCancelled)
+
+    def test_full_queue_keeps_order(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            scheduler = CommandScheduler(max_queued=2)
+            commands = ['speed?', 'battery?', 'speed?', 'battery?', 'speed?', 'battery?']
+            puts = [loop.create_task(scheduler.put(PendingCommand(command, 1., 0, loop.create_future())))
+                    for command in commands]
+            sent = []
+            while len(sent) < len(commands):
+                await asyncio.sleep(0)
+                if not scheduler.empty():
+                    sent.append((await scheduler.get()).command)
+            await asyncio.gather(*puts)
+            return sent
+        self.assertEqual(asyncio.run(run()), ['speed?', 'battery?', 'speed?', 'battery?', 'speed?', 'battery?'])
+
+
+if __name__ == '__main__':
+    unittest.main()
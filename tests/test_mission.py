@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from mission import MIN_MOVE, MissionPlanner  # noqa: E402
+
+
+def arc_points(a, b, c, samples=500):
+    """
+        Points along the circle arc from a through b to c.
+    """
+    ab, ac = b - a, c - a
+    normal = np.cross(ab, ac)
+    center = a + (ac @ ac * np.cross(normal, ab) + ab @ ab * np.cross(ac, normal)) / (2 * normal @ normal)
+    u = a - center
+    v = np.cross(normal / np.linalg.norm(normal), u)
+    end = np.arctan2((c - center) @ v, (c - center) @ u) % (2 * np.pi)  # b lies on the way, ab x ac orients it
+    angles = np.linspace(0, end, samples)
+    return center + np.cos(angles)[:, None] * u + np.sin(angles)[:, None] * v
+
+
+def flown_path(plan, start=(0, 0, 0), samples=500):
+    position = np.asarray(start, dtype=np.float64)
+    path = [position[None]]
+    for step in plan.steps:
+        name, *args = step.command.split()
+        values = np.array(args[:-1], dtype=np.float64)
+        if name == 'go':
+            target = position + values
+            path.append(position + np.linspace(0, 1, samples)[:, None] * values)
+        else:
+            target = position + values[3:]
+            path.append(arc_points(position, position + values[:3], target, samples))
+        position = target
+    return np.vstack(path)
+
+
+class MissionPlannerTest(unittest.TestCase):
+    def assertFlownThrough(self, plan, waypoints, tolerance):
+        path = flown_path(plan)
+        for waypoint in np.asarray(waypoints, dtype=np.float64):
+            self.assertLessEqual(np.linalg.norm(path - waypoint, axis=1).min(), tolerance,
+                                 f"{waypoint} missed by {plan.commands}")
+
+    def test_merged_waypoints_are_not_curved_away(self):
+        for waypoints in ([(100, 0, 0), (200, 0, 0), (200, -200, 0)], [(200, 0, 0), (400, 0, 0), (300, -100, -50)]):
+            for reorder in (False, True):
+                plan = MissionPlanner(mission_reorder=reorder).plan(waypoints)
+                self.assertFlownThrough(plan, waypoints, 1.)
+
+    def test_every_waypoint_stays_on_the_flown_path(self):
+        rng = np.random.default_rng(3)
+        planner = MissionPlanner()
+        # skipped waypoints are within MIN_MOVE on every axis of a flown one, plus rounding to whole cm
+        tolerance = MIN_MOVE * 3 ** 0.5 + 1.
+        for _ in range(20):
+            waypoints = rng.uniform(-600, 600, (8, 3))
+            waypoints[:4] = np.linspace(0, 1, 4)[:, None] * rng.uniform(-600, 600, 3)  # a straight run to merge
+            self.assertFlownThrough(planner.plan(waypoints), waypoints, tolerance)
+            self.assertFlownThrough(planner.plan(waypoints[:4]), waypoints[:4], tolerance)
+
+
+if __name__ == '__main__':
+    unittest.main()